@@ -0,0 +1,187 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+import numpy
+
+from radiometric_normalization import kernels
+from radiometric_normalization import normalize
+from radiometric_normalization.transformation import LinearTransformation
+
+
+'''
+Benchmarks each kernel in radiometric_normalization.kernels with its NumPy
+and (if Numba is installed) Numba backends on synthetic uint16 data:
+
+    python benchmarks/kernel_benchmarks.py --sizes 1000 5000
+
+The Numba kernels are called once before timing so compilation is not
+counted.
+'''
+
+DEFAULT_SIZES = [1000, 5000]
+
+
+def _setup_residual_mask(size, random):
+    candidate_data = random.randint(0, 10000, size * size).astype(
+        numpy.uint16)
+    reference_data = (0.8 * candidate_data + 500 + random.normal(
+        0, 50, size * size)).clip(0, 65535).astype(numpy.uint16)
+    return candidate_data, reference_data
+
+
+def _residual_mask(inputs, backend):
+    candidate_data, reference_data = inputs
+    kernels.residual_mask(candidate_data, reference_data, 0.8, 500, 100,
+                          backend=backend)
+
+
+def _setup_apply_lut(size, random):
+    band = random.randint(0, 10000, (size, size)).astype(numpy.uint16)
+    lut = normalize._linear_transformation_to_lut(
+        LinearTransformation(1.25, -625))
+    return band, lut, numpy.empty_like(band)
+
+
+def _apply_lut(inputs, backend):
+    band, lut, out = inputs
+    kernels.apply_lut(band, lut, out, backend=backend)
+
+
+def _setup_accumulate_masked(size, random):
+    band = random.randint(0, 10000, (size, size)).astype(numpy.uint16)
+    valid = random.rand(size, size) > 0.1
+    return (numpy.zeros((size, size)),
+            numpy.zeros((size, size), dtype=numpy.uint32), band, valid)
+
+
+def _accumulate_masked(inputs, backend):
+    kernels.accumulate_masked(*inputs, backend=backend)
+
+
+# Kernel name: (setup function, benchmarked function). The setup function
+# makes the inputs and is not timed.
+KERNELS = {
+    'residual_mask': (_setup_residual_mask, _residual_mask),
+    'apply_lut': (_setup_apply_lut, _apply_lut),
+    'accumulate_masked': (_setup_accumulate_masked, _accumulate_masked),
+}
+
+
+def run(sizes, kernel_names, repeats=3):
+    ''' Times every kernel with every available backend at each size.
+
+    :returns: A dict of run information and a list of per kernel results
+    '''
+    backends = [kernels.NUMPY]
+    if kernels.HAVE_NUMBA:
+        backends.append(kernels.NUMBA)
+    else:
+        logging.warning('Numba is not installed; only the NumPy kernels are '
+                        'timed')
+
+    results = []
+    for size in sizes:
+        for name in kernel_names:
+            setup, function = KERNELS[name]
+            inputs = setup(size, numpy.random.RandomState(0))
+            for backend in backends:
+                # Also compiles the Numba kernel
+                function(inputs, backend)
+                wall_times = []
+                for _ in range(repeats):
+                    start = time.time()
+                    function(inputs, backend)
+                    wall_times.append(time.time() - start)
+                result = {'kernel': name, 'size': size, 'backend': backend,
+                          'wall_time': min(wall_times)}
+                results.append(result)
+                sys.stdout.write(_format_result(result) + '\n')
+                sys.stdout.flush()
+
+    return {'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'numba': _numba_version(),
+            'results': results}
+
+
+def speedups(results):
+    ''' Compares the Numba and NumPy wall times of each (kernel, size).
+
+    :returns: A list of lines describing each kernel
+    '''
+    wall_times = dict(((r['kernel'], r['size'], r['backend']), r['wall_time'])
+                      for r in results['results'])
+    row_format = '{:<20} {:>6} {:>10} {:>10} {:>8}'
+    lines = [row_format.format('kernel', 'size', 'numpy (s)', 'numba (s)',
+                               'speedup')]
+    for kernel, size, backend in sorted(wall_times):
+        if backend != kernels.NUMPY:
+            continue
+        numpy_time = wall_times[(kernel, size, kernels.NUMPY)]
+        numba_time = wall_times.get((kernel, size, kernels.NUMBA))
+        if numba_time is None:
+            lines.append(row_format.format(
+                kernel, size, '{:.4f}'.format(numpy_time), '-', '-'))
+            continue
+        lines.append(row_format.format(
+            kernel, size, '{:.4f}'.format(numpy_time),
+            '{:.4f}'.format(numba_time),
+            '{:.1f}x'.format(numpy_time / max(numba_time, 1e-9))))
+    return lines
+
+
+def _format_result(result):
+    return '{kernel:<20} {size:>6} {backend:<6} {wall_time:>10.4f}s'.format(
+        **result)
+
+
+def _numba_version():
+    if not kernels.HAVE_NUMBA:
+        return None
+    import numba
+    return numba.__version__
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the NumPy and Numba kernels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Widths and heights of the synthetic bands')
+    parser.add_argument('--kernels', nargs='+', default=sorted(KERNELS),
+                        choices=sorted(KERNELS))
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='The best of this many calls is reported')
+    parser.add_argument('--output', help='Path to write the JSON results to')
+
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(options.sizes, options.kernels, options.repeats)
+    sys.stdout.write('\n'.join(speedups(results)) + '\n')
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,375 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from multiprocessing import Process, Queue
+
+import numpy
+from osgeo import gdal
+
+from radiometric_normalization import filtering
+from radiometric_normalization import gimage
+from radiometric_normalization import normalize
+from radiometric_normalization import pca_filter
+from radiometric_normalization import pif
+from radiometric_normalization import profiling
+from radiometric_normalization import robust
+from radiometric_normalization import time_stack
+from radiometric_normalization.transformation import LinearTransformation
+
+
+'''
+Benchmarks for each pipeline stage on synthetic uint16 GeoTIFFs.
+
+Each stage is run in its own process so its peak RSS is not polluted by the
+other stages. Results are written as JSON so that two revisions can be
+compared:
+
+    python benchmarks/pipeline_benchmarks.py run --output old.json
+    (check out the new revision)
+    python benchmarks/pipeline_benchmarks.py run --output new.json
+    python benchmarks/pipeline_benchmarks.py compare old.json new.json
+'''
+
+DEFAULT_SIZES = [1000, 5000, 10000]
+TIME_STACK_DEPTH = 3
+
+# The synthetic candidate is gain * reference + offset plus noise
+SYNTHETIC_GAIN = 0.8
+SYNTHETIC_OFFSET = 500
+
+
+def make_synthetic_image(path, size, band_count=4, noise=50.0,
+                         outlier_fraction=0.05, seed=0, reference=None,
+                         block_rows=512):
+    ''' Writes a synthetic uint16 GeoTIFF with an alpha band.
+
+    Without a reference, band values are a smooth ramp plus noise. With a
+    reference path the image is a linear transformation of the reference plus
+    noise, with outlier_fraction of the pixels replaced by random values (the
+    "changed" pixels a PIF method should reject). A 5% border is masked out in
+    the alpha band.
+
+    :param str path: Path to write the image to
+    :param int size: The width and height of the image in pixels
+    :param float noise: Standard deviation of the gaussian noise in DN
+    :param float outlier_fraction: Fraction of pixels that are outliers
+    :param int seed: Seed for the random number generator
+    :param str reference: [Optional] Path to an image made by this function
+        to derive this image from
+    '''
+    random = numpy.random.RandomState(seed)
+    gdal_ds = gimage.create_ds(path, size, size, band_count + 1)
+    reference_ds = gdal.Open(reference) if reference else None
+    border = size // 20
+
+    for yoff, rows in gimage.iter_row_blocks(size, block_rows):
+        for band_no in range(1, band_count + 1):
+            if reference_ds is None:
+                ramp = numpy.linspace(2000, 20000, size) * band_no / band_count
+                data = numpy.tile(ramp, (rows, 1))
+            else:
+                data = SYNTHETIC_GAIN * gimage.read_single_band(
+                    reference_ds, band_no, window=(0, yoff, size, rows)) + \
+                    SYNTHETIC_OFFSET
+            data = data + random.normal(0, noise, data.shape)
+            outliers = random.random_sample(data.shape) < outlier_fraction
+            data[outliers] = random.uniform(0, 30000, outliers.sum())
+            numpy.clip(data, 0, 65535, data)
+            gdal_ds.GetRasterBand(band_no).WriteArray(
+                data.astype(numpy.uint16), 0, yoff)
+
+        alpha = numpy.zeros((rows, size), dtype=numpy.uint16)
+        row_numbers = numpy.arange(yoff, yoff + rows)
+        valid_rows = numpy.logical_and(row_numbers >= border,
+                                       row_numbers < size - border)
+        alpha[valid_rows, border:size - border] = 255
+        alpha_band = gdal_ds.GetRasterBand(band_count + 1)
+        alpha_band.SetColorInterpretation(gdal.GCI_AlphaBand)
+        alpha_band.WriteArray(alpha, 0, yoff)
+
+
+def make_synthetic_data(data_dir, size, noise, outlier_fraction):
+    ''' Creates (or reuses) the synthetic images for one size.
+
+    :returns: A dict with the candidate path and a list of reference paths
+    '''
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    tag = '{}_n{}_o{}'.format(size, noise, outlier_fraction)
+    reference_paths = [
+        os.path.join(data_dir, 'reference_{}_{}.tif'.format(tag, i))
+        for i in range(TIME_STACK_DEPTH)]
+    candidate_path = os.path.join(data_dir, 'candidate_{}.tif'.format(tag))
+
+    for i, reference_path in enumerate(reference_paths):
+        if not os.path.exists(reference_path):
+            logging.info('Benchmark: Creating {}'.format(reference_path))
+            make_synthetic_image(reference_path, size, noise=noise,
+                                 outlier_fraction=0, seed=i + 1)
+    if not os.path.exists(candidate_path):
+        logging.info('Benchmark: Creating {}'.format(candidate_path))
+        make_synthetic_image(candidate_path, size, noise=noise,
+                             outlier_fraction=outlier_fraction,
+                             reference=reference_paths[0])
+
+    return {'candidate_path': candidate_path,
+            'reference_paths': reference_paths}
+
+
+def _load_valid_pixel_lists(data):
+    c_ds = gdal.Open(data['candidate_path'])
+    r_ds = gdal.Open(data['reference_paths'][0])
+    c_alpha, _ = gimage.read_alpha_and_band_count(c_ds)
+    r_alpha, _ = gimage.read_alpha_and_band_count(r_ds)
+    valid_pixels = numpy.nonzero(numpy.logical_and(c_alpha, r_alpha))
+    return (gimage.read_single_band(c_ds, 1)[valid_pixels],
+            gimage.read_single_band(r_ds, 1)[valid_pixels])
+
+
+def _setup_pixel_lists(data):
+    return _load_valid_pixel_lists(data)
+
+
+def _setup_band(data):
+    c_ds = gdal.Open(data['candidate_path'])
+    return (gimage.read_single_band(c_ds, 1),)
+
+
+def _setup_paths(data):
+    return (data['reference_paths'],)
+
+
+def _filter_by_histogram(candidate_data, reference_data):
+    filtering.filter_by_histogram_pixel_list(candidate_data, reference_data)
+
+
+def _pca_filter(candidate_data, reference_data):
+    pca_filter.pca_fit_and_filter_pixel_list(
+        candidate_data, reference_data, pif.DEFAULT_PCA_OPTIONS)
+
+
+def _robust_fit(candidate_data, reference_data):
+    robust.fit(candidate_data, reference_data)
+
+
+def _apply_using_lut(band):
+    normalize.apply_using_lut(
+        band, LinearTransformation(1 / SYNTHETIC_GAIN, -SYNTHETIC_OFFSET))
+
+
+def _mean_with_uniform_weight(image_paths):
+    time_stack.mean_with_uniform_weight(image_paths, numpy.uint16, None)
+
+
+# Stage name: (setup function, benchmarked function). The setup function
+# loads the inputs from the synthetic data and is not timed.
+STAGES = {
+    'filter_by_histogram': (_setup_pixel_lists, _filter_by_histogram),
+    'pca_filter': (_setup_pixel_lists, _pca_filter),
+    'robust_fit': (_setup_pixel_lists, _robust_fit),
+    'apply_using_lut': (_setup_band, _apply_using_lut),
+    'mean_with_uniform_weight': (_setup_paths, _mean_with_uniform_weight),
+}
+
+
+def _run_stage_in_child(stage, data, results_queue):
+    try:
+        setup, function = STAGES[stage]
+        inputs = setup(data)
+        rss_before = profiling.peak_rss()
+        start = time.time()
+        function(*inputs)
+        results_queue.put({'status': 'ok',
+                           'wall_time': time.time() - start,
+                           'peak_rss': profiling.peak_rss(),
+                           'peak_rss_before': rss_before})
+    except Exception as e:
+        results_queue.put({'status': 'error: {}'.format(e)})
+
+
+def run_stage(stage, data, timeout=None):
+    ''' Runs one stage in a fresh process.
+
+    :param str stage: A key of STAGES
+    :param dict data: The output of make_synthetic_data
+    :param float timeout: [Optional] Seconds after which the stage is killed
+
+    :returns: A dict of the stage status, wall time (s) and peak RSS (MB)
+        before and after the timed call
+    '''
+    results_queue = Queue()
+    child = Process(target=_run_stage_in_child,
+                    args=(stage, data, results_queue))
+    child.start()
+    child.join(timeout)
+    if child.is_alive():
+        child.terminate()
+        child.join()
+        return {'status': 'timeout'}
+    if results_queue.empty():
+        return {'status': 'crashed (exit code {})'.format(child.exitcode)}
+    return results_queue.get()
+
+
+def run(sizes, stages, data_dir, noise=50.0, outlier_fraction=0.05,
+        repeats=1, timeout=None):
+    ''' Runs the benchmarks for every size and stage.
+
+    :returns: A dict of run information and a list of per stage results
+    '''
+    results = []
+    for size in sizes:
+        data = make_synthetic_data(data_dir, size, noise, outlier_fraction)
+        for stage in stages:
+            for repeat in range(repeats):
+                logging.info('Benchmark: {} at {}x{} (run {})'.format(
+                    stage, size, size, repeat + 1))
+                result = run_stage(stage, data, timeout)
+                result.update({'stage': stage, 'size': size,
+                               'repeat': repeat})
+                results.append(result)
+                sys.stdout.write(_format_result(result) + '\n')
+                sys.stdout.flush()
+
+    return {'revision': _git_revision(),
+            'created': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'noise': noise,
+            'outlier_fraction': outlier_fraction,
+            'results': results}
+
+
+def compare(old, new, tolerance=0.1):
+    ''' Compares the best wall time and peak RSS of each (stage, size) between
+    two benchmark runs.
+
+    :param dict old: A benchmark run loaded from JSON
+    :param dict new: A benchmark run loaded from JSON
+    :param float tolerance: Fractional slow down above which a stage is
+        flagged as a regression
+
+    :returns: A list of lines describing each stage
+    '''
+    def best(run):
+        best_results = {}
+        for result in run['results']:
+            if result['status'] != 'ok':
+                continue
+            key = (result['stage'], result['size'])
+            if key not in best_results or \
+                    result['wall_time'] < best_results[key]['wall_time']:
+                best_results[key] = result
+        return best_results
+
+    old_best = best(old)
+    new_best = best(new)
+    row_format = '{:<26} {:>6} {:>10} {:>10} {:>7} {:>10} {:>10} {}'
+    lines = ['{} -> {}'.format(old.get('revision'), new.get('revision')),
+             row_format.format('stage', 'size', 'old (s)', 'new (s)',
+                               'ratio', 'old (MB)', 'new (MB)', '')]
+    for key in sorted(set(old_best) | set(new_best)):
+        if key not in old_best or key not in new_best:
+            lines.append(row_format.format(
+                key[0], key[1], '-', '-', '-', '-', '-', 'missing in one run'))
+            continue
+        old_result = old_best[key]
+        new_result = new_best[key]
+        ratio = new_result['wall_time'] / max(old_result['wall_time'], 1e-9)
+        lines.append(row_format.format(
+            key[0], key[1],
+            '{:.3f}'.format(old_result['wall_time']),
+            '{:.3f}'.format(new_result['wall_time']),
+            '{:.2f}'.format(ratio),
+            '{:.1f}'.format(old_result['peak_rss']),
+            '{:.1f}'.format(new_result['peak_rss']),
+            'REGRESSION' if ratio > 1 + tolerance else ''))
+    return lines
+
+
+def _format_result(result):
+    if result['status'] != 'ok':
+        return '{stage:<26} {size:>6} {status}'.format(**result)
+    return ('{stage:<26} {size:>6} {wall_time:>10.3f}s '
+            '{peak_rss:>10.1f} MB').format(**result)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip().decode()
+    except Exception:
+        return 'unknown'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark pipeline stages on synthetic rasters')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--sizes', type=int, nargs='+',
+                            default=DEFAULT_SIZES)
+    run_parser.add_argument('--stages', nargs='+', default=sorted(STAGES),
+                            choices=sorted(STAGES))
+    run_parser.add_argument('--data-dir', default='benchmark_data',
+                            help='Where synthetic images are created/reused')
+    run_parser.add_argument('--noise', type=float, default=50.0)
+    run_parser.add_argument('--outlier-fraction', type=float, default=0.05)
+    run_parser.add_argument('--repeats', type=int, default=1)
+    run_parser.add_argument('--timeout', type=float,
+                            help='Seconds after which a stage is abandoned')
+    run_parser.add_argument('--output', required=True,
+                            help='Path to write the JSON results to')
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.command == 'run':
+        results = run(options.sizes, options.stages, options.data_dir,
+                      options.noise, options.outlier_fraction,
+                      options.repeats, options.timeout)
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    elif options.command == 'compare':
+        with open(options.old) as old_file:
+            old = json.load(old_file)
+        with open(options.new) as new_file:
+            new = json.load(new_file)
+        sys.stdout.write(
+            '\n'.join(compare(old, new, options.tolerance)) + '\n')
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
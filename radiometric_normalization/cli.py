@@ -0,0 +1,408 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import argparse
+import logging
+import sys
+
+from radiometric_normalization import gimage
+from radiometric_normalization import instrumentation
+from radiometric_normalization import lazy
+from radiometric_normalization import pif
+from radiometric_normalization import profiling
+from radiometric_normalization import result_cache
+from radiometric_normalization.transformation import GriddedTransformation
+from radiometric_normalization.transformation import LutTransformation
+from radiometric_normalization.wrappers import batch_wrapper
+from radiometric_normalization.wrappers import lazy_wrapper
+from radiometric_normalization.wrappers import pipeline_wrapper
+from radiometric_normalization.wrappers import time_stack_wrapper
+
+
+def main(args=None):
+    parser = _build_parser()
+    options = parser.parse_args(args)
+
+    pairs_given = (options.candidate, options.reference, options.output)
+    if options.time_stack:
+        if options.manifest is not None or not options.candidate or \
+                not options.output:
+            parser.error('--time-stack needs --candidate and --output')
+        if options.lazy or options.compare_decimation or \
+                options.fit_decimation != 1 or options.cache_dir or \
+                options.pif_method not in ('filter_alpha', 'filter_PCA',
+                                           'filter_robust'):
+            parser.error('--time-stack cannot be combined with --lazy, '
+                         '--fit-decimation, --compare-decimation, '
+                         '--cache-dir or --pif-method filter_joint_PCA')
+    elif options.manifest is None and not all(pairs_given):
+        parser.error('Either --manifest or all of --candidate, --reference '
+                     'and --output are required')
+    if options.window is not None and options.bbox is not None:
+        parser.error('--window cannot be combined with --bbox')
+    if options.manifest is not None and any(pairs_given):
+        parser.error('--manifest cannot be combined with --candidate, '
+                     '--reference or --output')
+    if options.lazy and (options.compare_decimation or
+                         options.fit_decimation != 1):
+        parser.error('--lazy cannot be combined with --fit-decimation or '
+                     '--compare-decimation')
+    if options.lazy and options.pif_method not in ('filter_alpha',
+                                                   'filter_PCA'):
+        parser.error('--lazy only supports the filter_alpha and filter_PCA '
+                     'PIF methods')
+    if options.grid_cell_size and (options.lazy or
+                                   options.compare_decimation or
+                                   options.fit_decimation != 1):
+        parser.error('--grid-cell-size cannot be combined with --lazy, '
+                     '--fit-decimation or --compare-decimation')
+    if options.transformation_method != 'linear_relationship' and (
+            options.lazy or options.grid_cell_size or
+            options.compare_decimation):
+        parser.error('--transformation-method {} cannot be combined with '
+                     '--lazy, --grid-cell-size or '
+                     '--compare-decimation'.format(
+                         options.transformation_method))
+    if options.histogram_bin_width and (
+            options.lazy or options.time_stack or options.grid_cell_size or
+            options.compare_decimation or
+            options.transformation_method != 'linear_relationship'):
+        parser.error('--histogram-bin-width cannot be combined with --lazy, '
+                     '--time-stack, --grid-cell-size, --compare-decimation '
+                     'or --transformation-method {}'.format(
+                         options.transformation_method))
+    if options.pif_threshold is not None and \
+            options.pif_method == 'filter_alpha':
+        parser.error('--pif-threshold cannot be combined with --pif-method '
+                     'filter_alpha')
+    if options.deduplicate_pairs and (
+            options.lazy or
+            options.pif_method not in ('filter_PCA', 'filter_robust')):
+        parser.error('--deduplicate-pairs needs --pif-method filter_PCA or '
+                     'filter_robust and cannot be combined with --lazy')
+    if options.cache_dir is not None and (options.lazy or
+                                          options.compare_decimation):
+        parser.error('--cache-dir cannot be combined with --lazy or '
+                     '--compare-decimation')
+    if options.state_dir is not None and (options.manifest is None or
+                                          options.lazy):
+        parser.error('--state-dir needs --manifest and cannot be combined '
+                     'with --lazy')
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose > 1 else
+        logging.INFO if options.verbose else logging.WARNING)
+
+    if options.metrics:
+        if options.metrics.endswith('.prom'):
+            instrumentation.set_sink(
+                instrumentation.PrometheusTextfileSink(options.metrics))
+        else:
+            instrumentation.set_sink(
+                instrumentation.JsonLinesSink(options.metrics))
+    instrumentation.set_diagnostics(options.diagnostics)
+
+    run_options = dict(
+        pif_method=options.pif_method,
+        pif_options=_pif_options(options.pif_method, options.pif_threshold,
+                                 options.deduplicate_pairs),
+        transformation_method=options.transformation_method,
+        last_band_alpha=options.last_band_alpha,
+        block_rows=options.tile_size,
+        writer_options=_writer_options(options),
+        validate=not options.no_validate,
+        prefetch_depth=options.prefetch_depth,
+        window=options.window,
+        bbox=options.bbox,
+        fit_decimation=options.fit_decimation,
+        cache=_result_cache(options),
+        grid_cell_size=options.grid_cell_size,
+        grid_smoothing=options.grid_smoothing,
+        histogram_bin_width=options.histogram_bin_width)
+
+    if options.compare_decimation:
+        if options.manifest is not None:
+            parser.error('--compare-decimation needs a single pair')
+        reports = pipeline_wrapper.compare_fit_decimation(
+            options.candidate, options.reference,
+            decimations=options.compare_decimation,
+            pif_method=run_options['pif_method'],
+            pif_options=run_options['pif_options'],
+            transformation_method=run_options['transformation_method'],
+            last_band_alpha=options.last_band_alpha,
+            window=options.window, bbox=options.bbox)
+        sys.stdout.write(pipeline_wrapper.format_decimation_report(
+            reports, options.candidate) + '\n')
+        return 0
+
+    if options.time_stack:
+        results = [time_stack_wrapper.run(
+            options.candidate, options.time_stack, options.output,
+            reference_path=options.reference,
+            pif_method=run_options['pif_method'],
+            pif_options=run_options['pif_options'],
+            transformation_method=run_options['transformation_method'],
+            last_band_alpha=options.last_band_alpha,
+            block_rows=options.tile_size,
+            writer_options=run_options['writer_options'],
+            validate=run_options['validate'],
+            prefetch_depth=options.prefetch_depth, window=options.window,
+            bbox=options.bbox, grid_cell_size=options.grid_cell_size,
+            grid_smoothing=options.grid_smoothing)]
+    elif options.lazy:
+        results = _run_lazy(options, run_options)
+    elif options.state_dir is not None:
+        results = batch_wrapper.run(
+            options.manifest, options.state_dir, workers=options.workers,
+            **run_options)
+    elif options.manifest is not None:
+        results = pipeline_wrapper.run_manifest(
+            options.manifest, workers=options.workers, **run_options)
+    else:
+        results = [pipeline_wrapper.run(
+            options.candidate, options.reference, options.output,
+            **run_options)]
+
+    for result in results:
+        _print_result(result)
+        for timing in result.timings:
+            instrumentation.record_time(
+                'pipeline.{}'.format(timing.stage), timing.wall_time)
+    instrumentation.flush()
+    return 0
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        description='Normalize candidate images to reference images '
+        '(PIF generation, transformation, normalization and validation) and '
+        'report the wall time and peak RSS of each stage.')
+    parser.add_argument('--candidate', help='Path to the candidate image')
+    parser.add_argument(
+        '--reference',
+        help='Path to the reference image (with --time-stack, the path to '
+        'write the time stack mean to, which is otherwise not written)')
+    parser.add_argument(
+        '--time-stack', nargs='+', metavar='IMAGE',
+        help='Normalize to the mean of these images, averaged a strip at a '
+        'time as PIFs are generated and the transformations fitted, instead '
+        'of to --reference')
+    parser.add_argument('--output', help='Path to write the normalized image')
+    parser.add_argument(
+        '--manifest',
+        help='CSV file of candidate,reference,output rows to run instead of '
+        'a single pair')
+    parser.add_argument(
+        '--pif-method', default='filter_alpha',
+        choices=['filter_alpha', 'filter_PCA', 'filter_robust',
+                 'filter_joint_PCA'])
+    parser.add_argument(
+        '--pif-threshold', type=float,
+        help='Threshold for the filter_PCA, filter_robust and '
+        'filter_joint_PCA methods')
+    parser.add_argument(
+        '--deduplicate-pairs', action='store_true',
+        help='Fit the filter_PCA and filter_robust methods to the distinct '
+        '(candidate, reference) value pairs weighted by their pixel counts '
+        '(equivalent, but quicker for integer images)')
+    parser.add_argument(
+        '--transformation-method', default='linear_relationship',
+        choices=['linear_relationship', 'histogram_matching'])
+    parser.add_argument(
+        '--last-band-alpha', action='store_true',
+        help='Treat the last band of each image as an alpha band')
+    parser.add_argument(
+        '--window', type=int, nargs=4,
+        metavar=('XOFF', 'YOFF', 'XSIZE', 'YSIZE'),
+        help='Only normalize this pixel window of the candidate')
+    parser.add_argument(
+        '--bbox', type=float, nargs=4,
+        metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'),
+        help='Only normalize this bounding box (in the candidate\'s '
+        'coordinate system)')
+    parser.add_argument(
+        '--fit-decimation', type=int, default=1,
+        help='Generate PIFs and fit the transformations on a raster reduced '
+        'by this factor (read from overviews if the images have them); the '
+        'normalization is still at full resolution')
+    parser.add_argument(
+        '--compare-decimation', type=int, nargs='+', metavar='FACTOR',
+        help='Instead of normalizing, report the fit time and accuracy at '
+        'each of these decimation factors against the full resolution fit')
+    parser.add_argument(
+        '--grid-cell-size', type=int,
+        help='Fit a gain and offset for each cell of a grid of cells this '
+        'many pixels square and interpolate between them, to correct '
+        'illumination that varies across the scene')
+    parser.add_argument(
+        '--grid-smoothing', type=int, default=1,
+        help='Fit each grid cell to the PIFs of the cells within this many '
+        'cells of it')
+    parser.add_argument(
+        '--histogram-bin-width', type=float,
+        help='Fit the transformations to a joint histogram of the PIF values '
+        'of each band with bins this wide (1 is exact for integer images), '
+        'so the fit is over the distinct value pairs rather than every PIF')
+    parser.add_argument(
+        '--tile-size', type=int,
+        help='Write a tiled output with tiles of this size, normalizing and '
+        'writing a row of tiles at a time instead of holding the whole image '
+        'in memory')
+    parser.add_argument(
+        '--compression', default='DEFLATE',
+        choices=['DEFLATE', 'LZW', 'ZSTD', 'NONE'])
+    parser.add_argument(
+        '--compress-threads',
+        help='Number of threads used to compress the output (or ALL_CPUS)')
+    parser.add_argument(
+        '--mask-band', default='alpha', choices=['alpha', 'mask'],
+        help='Write the valid data mask as a uint16 alpha band or as a 1-bit '
+        'internal mask band')
+    parser.add_argument(
+        '--cog', action='store_true',
+        help='Write a cloud optimized GeoTIFF with internal overviews')
+    parser.add_argument(
+        '--prefetch-depth', type=int, default=1,
+        help='Number of bands (or strips) to read ahead of processing on '
+        'background threads (0 to disable read-ahead)')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of worker processes to use for a manifest')
+    parser.add_argument(
+        '--state-dir',
+        help='Record the progress of a manifest in this directory, so a '
+        'rerun skips the pairs already done and resumes interrupted '
+        '--tile-size outputs (outputs are written under a temporary name '
+        'and renamed when complete)')
+    parser.add_argument(
+        '--cache-dir',
+        help='Keep PIF masks and transformations in this directory, so a '
+        'rerun of a pair whose images and options have not changed skips '
+        'PIF generation and the fit')
+    parser.add_argument(
+        '--cache-size', type=int, default=1024,
+        help='Size in MB that --cache-dir is kept under (least recently used '
+        'entries are evicted first)')
+    parser.add_argument(
+        '--lazy', action='store_true',
+        help='Process the images a chunk at a time as Dask task graphs '
+        '(needs Dask), so images larger than memory are normalized on '
+        'several cores')
+    parser.add_argument(
+        '--scheduler', default='threads', choices=lazy.SCHEDULERS,
+        help='The Dask scheduler to run --lazy on (distributed starts a '
+        'local cluster and needs dask.distributed)')
+    parser.add_argument(
+        '--dask-workers', type=int,
+        help='Number of threads, processes or cluster workers for --lazy '
+        '(defaults to the number of cores)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=lazy.DEFAULT_CHUNKS,
+        help='Height and width of the chunks --lazy processes')
+    parser.add_argument(
+        '--no-validate', action='store_true',
+        help='Skip scoring the normalized image against the reference')
+    parser.add_argument(
+        '--metrics',
+        help='Record function timers and counters to this file: a Prometheus '
+        'textfile if it ends in .prom, otherwise JSON lines. Per function '
+        'metrics from --workers processes are only kept in JSON lines')
+    parser.add_argument(
+        '--diagnostics', action='store_true',
+        help='Compute expensive diagnostic statistics (logged at debug '
+        'level, so with -vv)')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    return parser
+
+
+def _run_lazy(options, run_options):
+    if options.manifest is not None:
+        pairs = pipeline_wrapper.read_manifest(options.manifest)
+    else:
+        pairs = [(options.candidate, options.reference, options.output)]
+    # Each pair runs on all the scheduler's workers, so pairs run in turn
+    return [lazy_wrapper.run(
+        candidate_path, reference_path, output_path,
+        pif_method=run_options['pif_method'],
+        pif_options=run_options['pif_options'],
+        transformation_method=run_options['transformation_method'],
+        last_band_alpha=options.last_band_alpha,
+        writer_options=run_options['writer_options'],
+        validate=run_options['validate'], window=options.window,
+        bbox=options.bbox, chunks=options.chunk_size,
+        scheduler=options.scheduler, workers=options.dask_workers)
+        for candidate_path, reference_path, output_path in pairs]
+
+
+def _result_cache(options):
+    if options.cache_dir is None:
+        return None
+    return result_cache.ResultCache(
+        options.cache_dir, max_bytes=options.cache_size * 1024 ** 2)
+
+
+def _writer_options(options):
+    return gimage.writer_options(
+        tiled=options.tile_size is not None or options.cog,
+        block_size=options.tile_size,
+        compression=None if options.compression == 'NONE' else
+        options.compression,
+        num_threads=options.compress_threads,
+        mask=options.mask_band,
+        cog=options.cog)
+
+
+def _pif_options(pif_method, threshold, deduplicate=False):
+    if threshold is None and not deduplicate:
+        return None
+    if pif_method == 'filter_PCA':
+        if threshold is None:
+            threshold = pif.DEFAULT_PCA_OPTIONS.threshold
+        return pif.pca_options(threshold=threshold, deduplicate=deduplicate)
+    if pif_method == 'filter_robust':
+        if threshold is None:
+            threshold = pif.DEFAULT_ROBUST_OPTIONS.threshold
+        return pif.robust_options(threshold=threshold,
+                                  deduplicate=deduplicate)
+    if pif_method == 'filter_joint_PCA' and threshold is not None:
+        return pif.joint_pca_options(threshold=threshold)
+    return None
+
+
+def _print_result(result):
+    title = '{} -> {}'.format(result.candidate_path, result.output_path)
+    sys.stdout.write(profiling.format_timings(result.timings, title) + '\n')
+    for band_no, transformation in enumerate(result.transformations, 1):
+        if isinstance(transformation, GriddedTransformation):
+            sys.stdout.write(
+                'band {}: gain {} to {}, offset {} to {} ({}x{} cells)\n'
+                .format(band_no, transformation.gain.min(),
+                        transformation.gain.max(),
+                        transformation.offset.min(),
+                        transformation.offset.max(),
+                        *transformation.gain.shape))
+            continue
+        if isinstance(transformation, LutTransformation):
+            sys.stdout.write('band {}: look up table\n'.format(band_no))
+            continue
+        sys.stdout.write('band {}: gain {}, offset {}\n'.format(
+            band_no, transformation.gain, transformation.offset))
+    if result.rmse is not None:
+        sys.stdout.write('sum of RMSE: {}\n'.format(result.rmse))
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,6 +30,24 @@ def plot_pixels(file_name, candidate_data_single_band,
     fig = plt.figure()
     plt.hexbin(
         candidate_data_single_band, reference_data_single_band, mincnt=1)
+    _finish_pixel_plot(fig, file_name, limits, fit_line)
+
+
+def plot_joint_histogram(file_name, joint_histogram, limits=None,
+                         fit_line=None):
+    ''' Draws the same plot as plot_pixels from a histogram.JointHistogram
+    of the pixels, without touching the pixels.
+    '''
+    logging.info('Display: Creating pixel plot from a joint histogram - '
+                 '{}'.format(file_name))
+    fig = plt.figure()
+    plt.hexbin(
+        joint_histogram.candidate_values, joint_histogram.reference_values,
+        C=joint_histogram.counts, reduce_C_function=numpy.sum)
+    _finish_pixel_plot(fig, file_name, limits, fit_line)
+
+
+def _finish_pixel_plot(fig, file_name, limits, fit_line):
     if not limits:
         min_value = 0
         _, ymax = plt.gca().get_ylim()
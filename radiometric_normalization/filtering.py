@@ -16,7 +16,9 @@ limitations under the License.
 import logging
 import numpy
 
+from radiometric_normalization import kernels
 from radiometric_normalization.utils import pixel_list_to_array
+from radiometric_normalization.utils import trim_pixel_list
 
 
 def filter_by_residuals_from_line(candidate_band, reference_band,
@@ -45,7 +47,7 @@ def filter_by_residuals_from_line(candidate_band, reference_band,
         line_gain, line_offset)
 
     mask = pixel_list_to_array(
-        valid_pixels, filtered_pixels, candidate_band.shape)
+        trim_pixel_list(valid_pixels, filtered_pixels), candidate_band.shape)
 
     no_passed_pixels = len(numpy.nonzero(mask)[0])
     logging.info(
@@ -73,13 +75,8 @@ def filter_by_residuals_from_line_pixel_list(candidate_data, reference_data,
     logging.info('Filtering: Filtering from line: y = '
                  '{} * x + {} @ {}'.format(line_gain, line_offset, threshold))
 
-    def _get_residual(data_1, data_2):
-        return numpy.absolute(line_gain * data_1 - data_2 + line_offset) / \
-            numpy.sqrt(1 + line_gain * line_gain)
-
-    residuals = _get_residual(candidate_data, reference_data)
-
-    return residuals < threshold
+    return kernels.residual_mask(candidate_data, reference_data, line_gain,
+                                 line_offset, threshold)
 
 
 def filter_by_histogram(candidate_band, reference_band,
@@ -141,7 +138,7 @@ def filter_by_histogram(candidate_band, reference_band,
         rough_search, number_of_total_bins_in_one_axis)
 
     mask = pixel_list_to_array(
-        valid_pixels, filtered_pixels, candidate_band.shape)
+        trim_pixel_list(valid_pixels, filtered_pixels), candidate_band.shape)
 
     no_passed_pixels = len(numpy.nonzero(mask)[0])
     logging.info(
@@ -156,7 +153,8 @@ def filter_by_histogram(candidate_band, reference_band,
 def filter_by_histogram_pixel_list(candidate_data, reference_data,
                                    threshold=0.1, number_of_valid_bins=None,
                                    rough_search=False,
-                                   number_of_total_bins_in_one_axis=10):
+                                   number_of_total_bins_in_one_axis=10,
+                                   joint_histogram=None):
     ''' Filters pixels using a 2D histogram of common values.
 
     This function is for lists of coincident candidate and reference pixel data
@@ -194,14 +192,22 @@ def filter_by_histogram_pixel_list(candidate_data, reference_data,
                                                  have the same number (i.e. a
                                                  value of 10 will mean that
                                                  there are 100 bins in total)
+    :param histogram.JointHistogram joint_histogram: [Optional] A joint
+        histogram of candidate_data and reference_data. If given, the 2D
+        histogram is rebinned from it instead of from the data
 
     :returns: A list of booleans the same length as candidate representing if
         the data point is still active after filtering or not
     '''
     logging.info('Filtering: Filtering by histogram.')
 
-    H, candidate_bins, reference_bins = numpy.histogram2d(
-        candidate_data, reference_data, bins=number_of_total_bins_in_one_axis)
+    if joint_histogram is None:
+        H, candidate_bins, reference_bins = numpy.histogram2d(
+            candidate_data, reference_data,
+            bins=number_of_total_bins_in_one_axis)
+    else:
+        H, candidate_bins, reference_bins = joint_histogram.histogram2d(
+            number_of_total_bins_in_one_axis)
 
     def get_valid_range():
         c_min = min([candidate_bins[v] for v in passed_bins[0]])
@@ -241,8 +247,23 @@ def filter_by_histogram_pixel_list(candidate_data, reference_data,
                 zip(candidate_data, reference_data)]
     else:
         logging.debug('Filtering: Exact filtering by bins')
-        candidate_bin_ids = numpy.digitize(candidate_data, candidate_bins) - 1
-        reference_bin_ids = numpy.digitize(reference_data, reference_bins) - 1
-        passed_bin_pairs = zip(passed_bins[0], passed_bins[1])
-        return [(c, r) in passed_bin_pairs for c, r in
-                zip(candidate_bin_ids, reference_bin_ids)]
+        passed_bin_table = numpy.zeros(H.shape, dtype=numpy.bool)
+        passed_bin_table[passed_bins] = True
+        candidate_bin_ids = _bin_ids(candidate_data, candidate_bins)
+        reference_bin_ids = _bin_ids(reference_data, reference_bins)
+        in_range = numpy.logical_and(candidate_bin_ids >= 0,
+                                     reference_bin_ids >= 0)
+        passed = numpy.zeros(len(candidate_bin_ids), dtype=numpy.bool)
+        passed[in_range] = passed_bin_table[
+            candidate_bin_ids[in_range], reference_bin_ids[in_range]]
+        return passed
+
+
+def _bin_ids(data, bins):
+    ''' Finds the histogram bin of each value as numpy.histogram2d bins them
+    (the last bin includes its upper edge). Values outside the bins get -1.
+    '''
+    bin_ids = numpy.digitize(data, bins) - 1
+    bin_ids[numpy.asarray(data) == bins[-1]] = len(bins) - 2
+    bin_ids[bin_ids == len(bins) - 1] = -1
+    return bin_ids
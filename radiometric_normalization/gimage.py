@@ -15,14 +15,26 @@ limitations under the License.
 '''
 import logging
 import numpy
+import os
+import sys
+import threading
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from osgeo import gdal, gdal_array
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from radiometric_normalization import instrumentation
+
 '''
 A wrapper for a geospatial image
 
-- Bands: A list of uint16 numpy arrays, each holding a band of data
+- Bands: A list of numpy arrays, each holding a band of data (in the data
+         type of the file they were read from, typically uint16)
 - Alpha: A boolean numpy array holding the alpha information
          - False is a no data pixel
          - True is a valid pixel
@@ -32,26 +44,343 @@ A wrapper for a geospatial image
 GImage = namedtuple('GImage', 'bands, alpha, metadata')
 
 
-def save(gimage, filename, nodata=None, compress=True):
-    band_count = len(gimage.bands) + 1
+'''
+Options for writing GeoTIFFs
+
+- Tiled: Write square tiles rather than strips
+- Block_size: The tile width and height (tiled) or the rows per strip
+              (striped), None for the GDAL default
+- Compression: None, 'DEFLATE', 'LZW' or 'ZSTD' (ZSTD needs GDAL >= 2.3)
+- Num_threads: The number of threads GDAL uses to compress blocks (an int or
+               'ALL_CPUS'), None to compress in the writing thread
+- Mask: 'alpha' to write the alpha as an extra uint16 alpha band or 'mask' to
+        write it as a 1-bit internal GDAL mask band
+- Cog: Write a cloud optimized GeoTIFF (tiled, with internal overviews and
+       the headers and overviews before the full resolution data)
+'''
+writer_options = namedtuple(
+    'writer_options',
+    'tiled, block_size, compression, num_threads, mask, cog')
+DEFAULT_WRITER_OPTIONS = writer_options(
+    tiled=False, block_size=None, compression='DEFLATE', num_threads=None,
+    mask='alpha', cog=False)
+
+COG_OVERVIEW_RESAMPLING = 'AVERAGE'
+
+# A pixel window of a raster (the same order as GDAL's ReadAsArray arguments)
+Window = namedtuple('Window', 'xoff, yoff, xsize, ysize')
+
+
+@instrumentation.instrumented
+def save(gimage, filename, nodata=None, compress=True, options=None):
+    ''' Saves a gimage to a GeoTIFF.
+
+    :param GImage gimage: The image to save
+    :param str filename: The path to save to
+    :param int nodata: [Optional] A nodata value to set on the image bands
+    :param bool compress: If False, overrides options to write uncompressed
+    :param writer_options options: [Optional] How to lay out the file
+    '''
+    options = _resolve_writer_options(options, compress)
     ysize, xsize = gimage.bands[0].shape
-    gdal_ds = create_ds(filename, xsize, ysize, band_count, compress)
-    _save_to_ds(gimage, gdal_ds, nodata)
+    writer = GImageWriter(filename, xsize, ysize, len(gimage.bands),
+                          gimage.metadata, nodata, options,
+                          dtype=gimage.bands[0].dtype)
+    # Writing a strip at a time lets GDAL compress and flush each strip
+    # before the next one is converted
+    with writer:
+        for yoff, rows in iter_row_blocks(ysize, writer.block_rows):
+            writer.write_block(
+                [band[yoff:yoff + rows] for band in gimage.bands],
+                gimage.alpha[yoff:yoff + rows], 0, yoff)
 
 
-def create_ds(file_name, xsize, ysize, band_count, compress=True):
-    options = ['PHOTOMETRIC=RGB']
-    if compress:
-        options.append('COMPRESS=DEFLATE')
-        options.append('PREDICTOR=2')
+@instrumentation.instrumented
+def create_ds(file_name, xsize, ysize, band_count, compress=True,
+              options=None, datatype=gdal.GDT_UInt16):
+    ''' Creates a GeoTIFF dataset (uint16 unless another GDAL datatype is
+    given).
+
+    band_count is the total number of bands in the file, including an alpha
+    band if there is one.
+    '''
+    options = _resolve_writer_options(options, compress)
 
-    datatype = gdal.GDT_UInt16
     gdal_ds = gdal.GetDriverByName('GTIFF').Create(
         file_name, xsize, ysize, band_count, datatype,
-        options=options)
+        options=_creation_options(options, datatype))
+    if gdal_ds is None:
+        raise Exception('Unable to create file "{}": {}'.format(
+            file_name, gdal.GetLastErrorMsg()))
     return gdal_ds
 
 
+def _resolve_writer_options(options, compress=True):
+    if options is None:
+        options = DEFAULT_WRITER_OPTIONS
+    if not compress:
+        options = options._replace(compression=None)
+    if options.mask not in ('alpha', 'mask'):
+        raise ValueError('The mask option must be "alpha" or "mask", not '
+                         '"{}".'.format(options.mask))
+    return options
+
+
+def _gdal_datatype(dtype):
+    ''' Converts a numpy data type to a GDAL data type
+    '''
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.bool_:
+        return gdal.GDT_Byte
+    datatype = gdal_array.NumericTypeCodeToGDALTypeCode(dtype)
+    if datatype is None:
+        raise Exception(
+            'Data type {} cannot be written to a GeoTIFF'.format(dtype))
+    return datatype
+
+
+def _creation_options(options, datatype=gdal.GDT_UInt16):
+    creation_options = ['PHOTOMETRIC=RGB', 'BIGTIFF=IF_SAFER']
+    if options.tiled:
+        creation_options.append('TILED=YES')
+        if options.block_size:
+            creation_options.append(
+                'BLOCKXSIZE={}'.format(options.block_size))
+            creation_options.append(
+                'BLOCKYSIZE={}'.format(options.block_size))
+    elif options.block_size:
+        creation_options.append('BLOCKYSIZE={}'.format(options.block_size))
+    if options.compression:
+        creation_options.append('COMPRESS={}'.format(options.compression))
+        if datatype in (gdal.GDT_Float32, gdal.GDT_Float64):
+            creation_options.append('PREDICTOR=3')
+        else:
+            creation_options.append('PREDICTOR=2')
+        if options.num_threads:
+            creation_options.append(
+                'NUM_THREADS={}'.format(options.num_threads))
+    return creation_options
+
+
+class GImageWriter(object):
+    ''' Writes a GImage to a GeoTIFF a block at a time, so the bands do not
+    need to be held in memory and blocks are compressed as they are produced.
+
+    Writing full width strips of block_rows rows matches the file's tile or
+    strip layout, so each block is compressed and flushed once:
+
+        with GImageWriter('out.tif', xsize, ysize, 4, metadata) as writer:
+            for yoff, rows in iter_row_blocks(ysize, writer.block_rows):
+                writer.write_block(band_strips, alpha_strip, 0, yoff)
+
+    A with block that raises removes the unfinished file (see abort).
+    '''
+    def __init__(self, filename, xsize, ysize, band_count, metadata=None,
+                 nodata=None, options=None, dtype=numpy.uint16,
+                 resume=False, keep_partial=False):
+        '''
+        :param str filename: The path to write to
+        :param int xsize: The width of the image
+        :param int ysize: The height of the image
+        :param int band_count: The number of image bands (excluding alpha)
+        :param dict metadata: [Optional] Georeferencing metadata to save
+        :param int nodata: [Optional] A nodata value to set on the bands
+        :param writer_options options: [Optional] How to lay out the file
+        :param dtype: The numpy data type of the bands (uint16 by default)
+        :param bool resume: Keep the blocks already written to a file left by
+            an earlier writer with the same arguments (that was not closed),
+            instead of starting a new file
+        :param bool keep_partial: If a with block using the writer raises,
+            keep the blocks written so far (for a later writer to resume
+            after) instead of removing the unfinished file
+        '''
+        self.options = _resolve_writer_options(options)
+        self.datatype = _gdal_datatype(dtype)
+        self.filename = filename
+        self.band_count = band_count
+        self.xsize = xsize
+        self.ysize = ysize
+        self.keep_partial = keep_partial
+
+        file_band_count = band_count
+        if self.options.mask == 'alpha':
+            file_band_count += 1
+
+        if self.options.cog:
+            # A COG has its overviews before the full resolution data, so the
+            # blocks are streamed to an uncompressed tiled temporary file and
+            # copied into the final layout on close
+            self._temporary_filename = '{}.tmp.tif'.format(filename)
+            block_filename = self._temporary_filename
+            block_options = self.options._replace(tiled=True,
+                                                  compression=None)
+        else:
+            block_filename = filename
+            block_options = self.options
+        self._block_filename = block_filename
+
+        # Whether the blocks already in the file were kept
+        self.resumed = resume and os.path.exists(block_filename)
+        if self.resumed:
+            self.gdal_ds = gdal.Open(block_filename, gdal.GA_Update)
+            if self.gdal_ds is None or \
+                    self.gdal_ds.RasterXSize != xsize or \
+                    self.gdal_ds.RasterYSize != ysize or \
+                    self.gdal_ds.RasterCount != file_band_count:
+                raise Exception('Unable to resume writing "{}"'.format(
+                    block_filename))
+        else:
+            self.gdal_ds = create_ds(block_filename, xsize, ysize,
+                                     file_band_count, options=block_options,
+                                     datatype=self.datatype)
+
+        if self.options.mask == 'alpha':
+            self._mask_band = self.gdal_ds.GetRasterBand(file_band_count)
+            self._mask_band.SetColorInterpretation(gdal.GCI_AlphaBand)
+        elif self.resumed:
+            self._mask_band = self.gdal_ds.GetRasterBand(1).GetMaskBand()
+        else:
+            self._mask_band = _create_internal_mask_band(self.gdal_ds)
+
+        if nodata is not None:
+            for band_no in range(1, band_count + 1):
+                self.gdal_ds.GetRasterBand(band_no).SetNoDataValue(nodata)
+        if metadata:
+            save_metadata(self.gdal_ds, metadata)
+
+        self.block_rows = self.gdal_ds.GetRasterBand(1).GetBlockSize()[1]
+        if not self.options.tiled and not self.options.block_size:
+            # Default strips are only a few rows high so write a few hundred
+            # rows at a time to keep the per call overhead low
+            self.block_rows = max(self.block_rows, 256)
+
+    def write_block(self, bands, alpha=None, xoff=0, yoff=0):
+        ''' Writes one block of every band and (optionally) of the alpha.
+
+        :param list bands: A list of 2D arrays, one for each image band
+        :param array alpha: [Optional] A 2D array, nonzero for valid pixels
+        :param int xoff: The column of the top left pixel of the block
+        :param int yoff: The row of the top left pixel of the block
+        '''
+        assert len(bands) == self.band_count
+        for band_no, band in enumerate(bands, 1):
+            self.write_band_block(band_no, band, xoff, yoff)
+        if alpha is not None:
+            self.write_alpha_block(alpha, xoff, yoff)
+
+    def write_band_block(self, band_no, band, xoff=0, yoff=0):
+        self.gdal_ds.GetRasterBand(band_no).WriteArray(band, xoff, yoff)
+        instrumentation.increment('gimage.bytes_written', band.nbytes)
+
+    def write_alpha_block(self, alpha, xoff=0, yoff=0):
+        self._mask_band.WriteArray(_alpha_to_uint8(alpha), xoff, yoff)
+
+    def flush(self):
+        ''' Writes the blocks written so far to disk (so a later writer can
+        resume after them).
+        '''
+        self.gdal_ds.FlushCache()
+
+    def close(self):
+        ''' Flushes the file to disk and releases the dataset.
+        '''
+        if self.gdal_ds is not None:
+            self._mask_band = None
+            self.gdal_ds.FlushCache()
+            if self.options.cog:
+                _write_cog(self.gdal_ds, self.filename, self.options)
+            self.gdal_ds = None
+            if self.options.cog:
+                gdal.GetDriverByName('GTIFF').Delete(self._temporary_filename)
+
+    def abort(self):
+        ''' Releases the dataset without finishing the file: a COG is not
+        copied into its final layout, and the unfinished file is removed
+        (unless keep_partial was given).
+        '''
+        if self.gdal_ds is not None:
+            self._mask_band = None
+            if self.keep_partial:
+                self.gdal_ds.FlushCache()
+            self.gdal_ds = None
+            if not self.keep_partial and \
+                    os.path.exists(self._block_filename):
+                gdal.GetDriverByName('GTIFF').Delete(self._block_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A with block that raised must not leave a file that looks finished
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _write_cog(gdal_ds, filename, options):
+    ''' Builds internal overviews on a tiled dataset and copies it to filename
+    with the cloud optimized layout (headers, then overviews from smallest to
+    largest, then full resolution data).
+    '''
+    block_size = gdal_ds.GetRasterBand(1).GetBlockSize()[0]
+    levels = overview_levels(gdal_ds.RasterXSize, gdal_ds.RasterYSize,
+                             block_size)
+    logging.info('GImage: Building overviews {} for {}'.format(
+        levels, filename))
+    if levels:
+        gdal_ds.BuildOverviews(COG_OVERVIEW_RESAMPLING, levels)
+
+    cog_options = _creation_options(
+        options._replace(tiled=True),
+        gdal_ds.GetRasterBand(1).DataType)
+    cog_options.append('COPY_SRC_OVERVIEWS=YES')
+    cog_ds = gdal.GetDriverByName('GTIFF').CreateCopy(
+        filename, gdal_ds, options=cog_options)
+    if cog_ds is None:
+        raise Exception('Unable to create file "{}": {}'.format(
+            filename, gdal.GetLastErrorMsg()))
+    cog_ds = None
+
+
+def overview_levels(xsize, ysize, block_size):
+    ''' Calculates the overview decimation factors needed for the smallest
+    overview to fit in a single block.
+
+    :param int xsize: The width of the image
+    :param int ysize: The height of the image
+    :param int block_size: The tile size
+
+    :returns: A list of decimation factors (e.g. [2, 4, 8])
+    '''
+    levels = []
+    factor = 2
+    while -(-max(xsize, ysize) // (factor // 2)) > block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def _create_internal_mask_band(gdal_ds):
+    previous = gdal.GetConfigOption('GDAL_TIFF_INTERNAL_MASK')
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    try:
+        gdal_ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+    finally:
+        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', previous)
+    return gdal_ds.GetRasterBand(1).GetMaskBand()
+
+
+def _alpha_to_uint8(alpha_array):
+    ''' Converts an alpha array (nonzero is valid) to a uint8 array of 0 and
+    255 with a single allocation
+    '''
+    alpha_uint8 = numpy.empty(numpy.shape(alpha_array), dtype=numpy.uint8)
+    numpy.not_equal(alpha_array, 0, out=alpha_uint8.view(numpy.bool_))
+    alpha_uint8 *= 255
+    return alpha_uint8
+
+
 def _save_to_ds(gimage, gdal_ds, nodata=None):
     assert gdal_ds.RasterCount == len(gimage.bands) + 1
     assert gdal_ds.RasterXSize == gimage.bands[0].shape[1]
@@ -64,6 +393,7 @@ def _save_to_ds(gimage, gdal_ds, nodata=None):
     save_metadata(gdal_ds, gimage.metadata)
 
 
+@instrumentation.instrumented
 def save_band(gdal_ds, band_array, band_no, nodata=None):
     gdal_band = gdal_ds.GetRasterBand(band_no)
     gdal_array.BandWriteArray(gdal_band, band_array)
@@ -71,13 +401,14 @@ def save_band(gdal_ds, band_array, band_no, nodata=None):
         gdal_band.SetNoDataValue(nodata)
 
 
+@instrumentation.instrumented
 def save_alpha_band(gdal_ds, alpha_array):
     alpha_band = gdal_ds.GetRasterBand(gdal_ds.RasterCount)
     alpha_band.SetColorInterpretation(gdal.GCI_AlphaBand)
-    gdal_array.BandWriteArray(alpha_band,
-                              alpha_array.astype(numpy.uint16) * 255)
+    gdal_array.BandWriteArray(alpha_band, _alpha_to_uint8(alpha_array))
 
 
+@instrumentation.instrumented
 def save_metadata(gdal_ds, metadata):
     # Save georeferencing information
     if 'projection' in metadata.keys():
@@ -88,22 +419,39 @@ def save_metadata(gdal_ds, metadata):
         gdal_ds.SetMetadata(metadata['rpc'], 'RPC')
 
 
-def load(filename, nodata=None, last_band_alpha=False):
+@instrumentation.instrumented
+def load(filename, nodata=None, last_band_alpha=False, window=None,
+         bbox=None):
+    ''' Loads an image (or the part of it in a pixel window or geographic
+    bounding box) as a GImage. The georeferencing of a window is shifted to
+    the window's origin.
+
+    :param str filename: Path to the image
+    :param int nodata: [Optional] Pixels with this value in any band are
+        masked out
+    :param bool last_band_alpha: Treat the last band as an alpha band
+    :param Window window: [Optional] The pixel window to load
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the image's coordinate system to load (instead of window)
+    '''
     logging.info('GImage: Loading {} as GImage'.format(filename))
     gdal_ds = gdal.Open(filename)
     if gdal_ds is None:
         raise Exception('Unable to open file "{}" with gdal.Open()'.format(
             filename))
 
-    alpha, band_count = read_alpha_and_band_count(gdal_ds, last_band_alpha)
-    bands = _read_all_bands(gdal_ds, band_count)
-    metadata = read_metadata(gdal_ds)
+    window = resolve_window(gdal_ds, window, bbox)
+    alpha, band_count = read_alpha_and_band_count(
+        gdal_ds, last_band_alpha, window)
+    bands = _read_all_bands(gdal_ds, band_count, window)
+    metadata = window_metadata(read_metadata(gdal_ds), window)
 
-    if nodata:
-        alpha = alpha * _nodata_to_mask(bands, nodata)
+    if nodata is not None:
+        _nodata_to_mask(bands, nodata, out=alpha)
     return GImage(bands, alpha, metadata)
 
 
+@instrumentation.instrumented
 def read_metadata(gdal_ds):
     metadata = {}
 
@@ -129,54 +477,682 @@ def read_metadata(gdal_ds):
     return metadata
 
 
-def _read_all_bands(gdal_ds, band_count):
+def _read_all_bands(gdal_ds, band_count, window=None):
     bands = []
     for band_n in range(1, band_count + 1):
-        bands.append(read_single_band(gdal_ds, band_n))
+        bands.append(read_single_band(gdal_ds, band_n, window))
     return bands
 
 
-def read_single_band(gdal_ds, band_no):
-    ''' band_no is gdal style band numbering, i.e. from 1 onwards not 0 indexed
+def resolve_window(gdal_ds, window=None, bbox=None):
+    ''' Works out the pixel window of a dataset to process from either a pixel
+    window or a geographic bounding box.
+
+    :param gdal_ds: A GDAL dataset
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the dataset's coordinate system
+
+    :returns: A Window clipped to the raster, or None for the whole raster
+    '''
+    if window is not None and bbox is not None:
+        raise Exception('Only one of window and bbox can be given')
+    if bbox is not None:
+        return bbox_to_window(gdal_ds, bbox)
+    if window is None:
+        return None
+    return _clip_window(gdal_ds, *window)
+
+
+def bbox_to_window(gdal_ds, bbox):
+    ''' Converts a geographic bounding box to the pixel window that covers
+    it. Only north up rasters (no rotation terms in the geotransform) are
+    supported.
+
+    :param gdal_ds: A GDAL dataset
+    :param tuple bbox: A (min_x, min_y, max_x, max_y) bounding box in the
+        dataset's coordinate system
+
+    :returns: A Window of every pixel that intersects the bounding box,
+        clipped to the raster
+    '''
+    min_x, min_y, max_x, max_y = bbox
+    origin_x, pixel_width, row_rotation, origin_y, column_rotation, \
+        pixel_height = gdal_ds.GetGeoTransform()
+    if row_rotation != 0 or column_rotation != 0:
+        raise Exception('Bounding boxes are only supported for north up '
+                        'rasters (the geotransform has rotation terms)')
+
+    columns = sorted([(min_x - origin_x) / pixel_width,
+                      (max_x - origin_x) / pixel_width])
+    rows = sorted([(min_y - origin_y) / pixel_height,
+                   (max_y - origin_y) / pixel_height])
+    xoff = int(numpy.floor(columns[0]))
+    yoff = int(numpy.floor(rows[0]))
+    return _clip_window(gdal_ds, xoff, yoff,
+                        int(numpy.ceil(columns[1])) - xoff,
+                        int(numpy.ceil(rows[1])) - yoff)
+
+
+def _clip_window(gdal_ds, xoff, yoff, xsize, ysize):
+    x_start = max(xoff, 0)
+    y_start = max(yoff, 0)
+    x_end = min(xoff + xsize, gdal_ds.RasterXSize)
+    y_end = min(yoff + ysize, gdal_ds.RasterYSize)
+    if x_end <= x_start or y_end <= y_start:
+        raise Exception('Window ({}, {}, {}, {}) does not intersect the '
+                        'raster'.format(xoff, yoff, xsize, ysize))
+    return Window(x_start, y_start, x_end - x_start, y_end - y_start)
+
+
+def window_metadata(metadata, window):
+    ''' Shifts the georeferencing in metadata (see read_metadata) to the
+    origin of a pixel window.
+
+    :param dict metadata: The metadata of the whole raster
+    :param Window window: The window (or None for the whole raster)
+
+    :returns: The metadata of the window
+    '''
+    if window is None or (window.xoff == 0 and window.yoff == 0):
+        return metadata
+    metadata = dict(metadata)
+    if 'geotransform' in metadata:
+        gt = metadata['geotransform']
+        metadata['geotransform'] = (
+            gt[0] + window.xoff * gt[1] + window.yoff * gt[2], gt[1], gt[2],
+            gt[3] + window.xoff * gt[4] + window.yoff * gt[5], gt[4], gt[5])
+    if 'rpc' in metadata:
+        rpc = dict(metadata['rpc'])
+        rpc['LINE_OFF'] = str(float(rpc['LINE_OFF']) - window.yoff)
+        rpc['SAMP_OFF'] = str(float(rpc['SAMP_OFF']) - window.xoff)
+        metadata['rpc'] = rpc
+    return metadata
+
+
+@instrumentation.instrumented
+def read_single_band(gdal_ds, band_no, window=None, buf_obj=None,
+                     dtype=None, decimation=1):
+    ''' Reads a band (or a window of a band) into a numpy array.
+
+    By default the array has the band's own data type, so no conversion or
+    copy is made. If a preallocated buf_obj is given the band is read
+    directly into it and GDAL converts to the buffer's data type (clamping
+    to its range) as it reads.
+
+    With a decimation factor greater than one GDAL reads a reduced raster
+    (from an overview if the file has a suitable one, otherwise by nearest
+    neighbour subsampling), so a fraction of the data is decoded.
+
+    :param gdal_ds: A GDAL dataset
+    :param int band_no: GDAL style band number, i.e. from 1 onwards not 0
+        indexed
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) tuple to
+        read only part of the band
+    :param array buf_obj: [Optional] A 2D array of the window's (decimated)
+        shape to read into
+    :param dtype: [Optional] A numpy data type to read as (ignored if buf_obj
+        is given)
+    :param int decimation: [Optional] Read every decimation-th row and
+        column (see decimated_shape)
+
+    :returns: A 2D array (buf_obj if it was given)
     '''
     band = gdal_ds.GetRasterBand(band_no)
-    array = band.ReadAsArray()
+    if window is None:
+        window = (0, 0, band.XSize, band.YSize)
+    if buf_obj is None and decimation > 1:
+        buf_obj = numpy.empty(
+            decimated_shape((window[3], window[2]), decimation),
+            dtype=band_dtype(band) if dtype is None else dtype)
+    elif buf_obj is None and dtype is not None and \
+            numpy.dtype(dtype) != band_dtype(band):
+        buf_obj = numpy.empty((window[3], window[2]), dtype=dtype)
+    array = band.ReadAsArray(*window, buf_obj=buf_obj)
     if array is None:
         raise Exception(
             'GDAL error occured : {}'.format(gdal.GetLastErrorMsg()))
-    return array.astype(numpy.uint16)
+    instrumentation.increment('gimage.bytes_read', array.nbytes)
+    return array
+
+
+def decimated_shape(shape, decimation):
+    ''' Returns the shape of a (ysize, xsize) raster read with a decimation
+    factor (sizes are rounded up, so every source pixel is represented)
+    '''
+    return tuple(-(-size // decimation) for size in shape)
+
+
+def band_dtype(gdal_band):
+    ''' Returns the numpy data type of a GDAL band
+    '''
+    return numpy.dtype(
+        gdal_array.GDALTypeCodeToNumericTypeCode(gdal_band.DataType))
+
 
+def iter_row_blocks(ysize, block_rows):
+    ''' Splits ysize rows into strips of at most block_rows rows
 
-def read_alpha_and_band_count(gdal_ds, last_band_alpha=False):
+    :param int ysize: The total number of rows
+    :param int block_rows: The maximum number of rows in a strip
+
+    :returns: A generator of (yoff, rows) tuples
+    '''
+    for yoff in range(0, ysize, block_rows):
+        yield yoff, min(block_rows, ysize - yoff)
+
+
+class BufferPool(object):
+    ''' A pool of reusable numpy arrays keyed by shape and data type.
+
+    Reading a scene band by band (or strip by strip) asks for the same few
+    array sizes over and over, so arrays that are released back to the pool
+    are handed out again instead of being reallocated. A released array must
+    not be used by the caller afterwards.
+
+    Buffers are not zeroed when they are reused.
+    '''
+    def __init__(self, max_bytes=None):
+        '''
+        :param int max_bytes: [Optional] The most memory to keep in released
+            buffers; buffers released beyond this are dropped
+        '''
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._free = {}
+        self._free_bytes = 0
+
+    def acquire(self, shape, dtype=numpy.uint16):
+        ''' Returns an uninitialized array of shape and dtype, reusing a
+        released one if there is one.
+        '''
+        key = (tuple(shape), numpy.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                array = free.pop()
+                self._free_bytes -= array.nbytes
+            else:
+                array = None
+        if array is None:
+            instrumentation.increment('gimage.buffer_pool.misses')
+            return numpy.empty(key[0], dtype=key[1])
+        instrumentation.increment('gimage.buffer_pool.hits')
+        return array
+
+    def release(self, array):
+        ''' Returns an array (from acquire) to the pool.
+        '''
+        if array is None:
+            return
+        key = (array.shape, array.dtype)
+        with self._lock:
+            if self.max_bytes is not None and \
+                    self._free_bytes + array.nbytes > self.max_bytes:
+                return
+            self._free.setdefault(key, []).append(array)
+            self._free_bytes += array.nbytes
+
+    @contextmanager
+    def buffer(self, shape, dtype=numpy.uint16):
+        ''' Context manager that acquires an array and releases it on exit.
+        '''
+        array = self.acquire(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def read_band(self, gdal_ds, band_no, window=None, decimation=1):
+        ''' Reads a band (or a window of a band) in its native data type into
+        an array from the pool. The caller releases it when done.
+        '''
+        band = gdal_ds.GetRasterBand(band_no)
+        if window is None:
+            shape = (band.YSize, band.XSize)
+        else:
+            shape = (window[3], window[2])
+        array = self.acquire(decimated_shape(shape, decimation),
+                             band_dtype(band))
+        try:
+            return read_single_band(gdal_ds, band_no, window, buf_obj=array)
+        except Exception:
+            self.release(array)
+            raise
+
+    def clear(self):
+        ''' Drops all released buffers.
+        '''
+        with self._lock:
+            self._free = {}
+            self._free_bytes = 0
+
+
+def prefetch_bands(datasets, reads, depth=1, buffer_pool=None,
+                   decimation=1):
+    ''' Reads the same bands (or windows) from several datasets, reading up
+    to depth reads ahead on background threads while the caller works on the
+    current one.
+
+    Each distinct dataset gets its own thread (GDAL releases the GIL while it
+    reads, so e.g. a candidate and a reference are read concurrently). A
+    dataset handle that appears more than once is read sequentially by one
+    thread, as GDAL handles must not be shared between threads.
+
+    :param list datasets: The GDAL datasets to read from
+    :param list reads: (band_no, window) tuples (window may be None for the
+        whole band) to read from every dataset, in order
+    :param int depth: The number of reads to buffer ahead of the caller (0
+        reads in the calling thread with no read-ahead)
+    :param BufferPool buffer_pool: [Optional] A pool to read into. The caller
+        releases the arrays it is given.
+    :param int decimation: [Optional] Read every decimation-th row and column
+        (see read_single_band)
+
+    :returns: A generator of lists of arrays (one per dataset) for each read
+    '''
+    def read(gdal_ds, band_no, window):
+        if buffer_pool is None:
+            return read_single_band(gdal_ds, band_no, window,
+                                    decimation=decimation)
+        return buffer_pool.read_band(gdal_ds, band_no, window, decimation)
+
+    reads = list(reads)
+    if depth < 1:
+        for band_no, window in reads:
+            yield [read(gdal_ds, band_no, window) for gdal_ds in datasets]
+        return
+
+    # One reader per distinct dataset handle, reading the positions it serves
+    positions = {}
+    for position, gdal_ds in enumerate(datasets):
+        positions.setdefault(id(gdal_ds), (gdal_ds, []))[1].append(position)
+
+    stop = threading.Event()
+    readers = [_PrefetchReader(gdal_ds, len(dataset_positions), reads, read,
+                               depth, stop)
+               for gdal_ds, dataset_positions in positions.values()]
+    for reader in readers:
+        reader.start()
+    try:
+        for _ in reads:
+            arrays = [None] * len(datasets)
+            for reader, (_, dataset_positions) in zip(
+                    readers, positions.values()):
+                for position, array in zip(dataset_positions, reader.get()):
+                    arrays[position] = array
+            yield arrays
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+
+class _PrefetchReader(threading.Thread):
+    ''' Reads (band_no, window) tuples from one dataset into a bounded queue
+    '''
+    def __init__(self, gdal_ds, copies, reads, read, depth, stop):
+        super(_PrefetchReader, self).__init__()
+        self.daemon = True
+        self.gdal_ds = gdal_ds
+        self.copies = copies
+        self.reads = reads
+        self.read = read
+        self.stop = stop
+        self.queue = queue.Queue(maxsize=depth)
+
+    def run(self):
+        try:
+            for band_no, window in self.reads:
+                if self.stop.is_set():
+                    return
+                arrays = [self.read(self.gdal_ds, band_no, window)
+                          for _ in range(self.copies)]
+                self._put((arrays, None))
+        except Exception:
+            self._put((None, sys.exc_info()[1]))
+
+    def _put(self, item):
+        # Gives up if the consumer has stopped, so the thread can exit
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        arrays, error = self.queue.get()
+        if error is not None:
+            raise error
+        return arrays
+
+
+@instrumentation.instrumented
+def read_alpha_and_band_count(gdal_ds, last_band_alpha=False, window=None,
+                              decimation=1):
+    alpha_band, band_count = _alpha_band_and_band_count(
+        gdal_ds, last_band_alpha)
+    shape = decimated_shape(window_shape(gdal_ds, window), decimation)
+    if alpha_band is None:
+        alpha = numpy.ones(shape, dtype=numpy.bool)
+    else:
+        alpha = numpy.empty(shape, dtype=numpy.bool)
+        # Reading a strip at a time avoids a full size copy of the alpha in
+        # its file data type; assigning to a boolean array maps nonzero values
+        # to True
+        for strip, yoff, rows in _alpha_windows(
+                gdal_ds, alpha_band, window, decimation):
+            alpha[yoff:yoff + rows] = alpha_band.ReadAsArray(*strip)
+    return alpha, band_count
+
+
+@instrumentation.instrumented
+def read_packed_alpha_and_band_count(gdal_ds, last_band_alpha=False,
+                                     window=None, decimation=1):
+    ''' Reads only the alpha (or dataset mask) of an image into a bit packed
+    mask, a strip at a time. None of the image bands are read.
+
+    The packed mask uses one bit per pixel, so combining the masks of two
+    images with numpy.bitwise_and touches an eighth of the memory of
+    combining boolean masks. Use unpack_alpha to get a boolean array.
+
+    :param gdal_ds: A GDAL dataset
+    :param bool last_band_alpha: Treat the last band as an alpha band
+    :param Window window: [Optional] Only read the alpha in this window
+    :param int decimation: [Optional] Read every decimation-th row and column
+        (see read_single_band)
+
+    :returns: A (ysize, ceil(xsize / 8)) uint8 array with each row packed with
+        numpy.packbits (set bits are valid pixels) and the band count
+        (excluding any alpha band)
+    '''
+    alpha_band, band_count = _alpha_band_and_band_count(
+        gdal_ds, last_band_alpha)
+    ysize, xsize = decimated_shape(window_shape(gdal_ds, window), decimation)
+    packed_shape = (ysize, -(-xsize // 8))
+    if alpha_band is None:
+        return numpy.full(packed_shape, 255, dtype=numpy.uint8), band_count
+
+    packed = numpy.empty(packed_shape, dtype=numpy.uint8)
+    for strip, yoff, rows in _alpha_windows(
+            gdal_ds, alpha_band, window, decimation):
+        packed[yoff:yoff + rows] = numpy.packbits(
+            alpha_band.ReadAsArray(*strip) != 0, axis=1)
+    return packed, band_count
+
+
+class DatasetCache(object):
+    ''' A least recently used cache of open datasets and their decoded alpha
+    masks.
+
+    Entries are keyed by the file's path, modification time and size, so a
+    file that is rewritten is opened again rather than served stale. Cached
+    alpha masks are read-only as they are shared by every caller. Masks of a
+    window are cut from the whole mask if it has already been decoded, and
+    are otherwise read from the window alone (and not cached).
+
+    Cached dataset handles must not be used from several threads at once, and
+    a cache should not be shared with forked worker processes.
+    '''
+    def __init__(self, max_entries=4):
+        '''
+        :param int max_entries: The number of datasets to keep open
+        '''
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def dataset(self, path):
+        ''' Returns the open dataset of an image.
+        '''
+        return self._entry(path)['gdal_ds']
+
+    def get(self, path, last_band_alpha=False, window=None, decimation=1):
+        ''' Returns the open dataset, alpha mask and band count of an image.
+
+        :returns: (gdal_ds, alpha, band_count), where alpha is a read-only
+            boolean array (of the window and decimation if given)
+        '''
+        entry = self._entry(path)
+        gdal_ds = entry['gdal_ds']
+        with entry['lock']:
+            cached = entry['masks'].get(
+                ('alpha', last_band_alpha, decimation))
+            if cached is not None and (window is None or decimation == 1):
+                instrumentation.increment('gimage.dataset_cache.alpha_hits')
+                alpha, band_count = cached
+                if window is not None:
+                    alpha = alpha[_window_slices(window)]
+                return gdal_ds, alpha, band_count
+
+            instrumentation.increment('gimage.dataset_cache.alpha_misses')
+            alpha, band_count = read_alpha_and_band_count(
+                gdal_ds, last_band_alpha, window, decimation)
+            alpha.flags.writeable = False
+            if window is None:
+                entry['masks'][('alpha', last_band_alpha, decimation)] = \
+                    (alpha, band_count)
+            return gdal_ds, alpha, band_count
+
+    def get_packed(self, path, last_band_alpha=False, window=None,
+                   decimation=1):
+        ''' Returns the open dataset, bit packed alpha mask (see
+        read_packed_alpha_and_band_count) and band count of an image.
+
+        :returns: (gdal_ds, packed_alpha, band_count), where packed_alpha is a
+            read-only uint8 array (of the window and decimation if given)
+        '''
+        entry = self._entry(path)
+        gdal_ds = entry['gdal_ds']
+        with entry['lock']:
+            cached = entry['masks'].get(
+                ('packed', last_band_alpha, decimation))
+            if cached is not None and window is None:
+                instrumentation.increment('gimage.dataset_cache.alpha_hits')
+                return (gdal_ds,) + cached
+
+            cached = entry['masks'].get(
+                ('alpha', last_band_alpha, decimation))
+            if cached is not None and (window is None or decimation == 1):
+                instrumentation.increment('gimage.dataset_cache.alpha_hits')
+                alpha, band_count = cached
+                if window is not None:
+                    alpha = alpha[_window_slices(window)]
+                packed_alpha = numpy.packbits(alpha, axis=1)
+            else:
+                instrumentation.increment(
+                    'gimage.dataset_cache.alpha_misses')
+                packed_alpha, band_count = read_packed_alpha_and_band_count(
+                    gdal_ds, last_band_alpha, window, decimation)
+            packed_alpha.flags.writeable = False
+            if window is None:
+                entry['masks'][('packed', last_band_alpha, decimation)] = \
+                    (packed_alpha, band_count)
+            return gdal_ds, packed_alpha, band_count
+
+    def clear(self):
+        ''' Closes all cached datasets.
+        '''
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                instrumentation.increment('gimage.dataset_cache.misses')
+                # Older versions of a rewritten file are never used again
+                for stale_key in [k for k in self._entries if k[0] == path]:
+                    del self._entries[stale_key]
+                gdal_ds = gdal.Open(path)
+                if gdal_ds is None:
+                    raise Exception('GDAL error occured : {}'.format(
+                        gdal.GetLastErrorMsg()))
+                entry = {'gdal_ds': gdal_ds, 'masks': {},
+                         'lock': threading.Lock()}
+            else:
+                instrumentation.increment('gimage.dataset_cache.hits')
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+DEFAULT_DATASET_CACHE = DatasetCache()
+
+
+def open_dataset(path, cache=None):
+    ''' Opens an image through a DatasetCache (DEFAULT_DATASET_CACHE unless
+    another is given).
+    '''
+    if cache is None:
+        cache = DEFAULT_DATASET_CACHE
+    return cache.dataset(path)
+
+
+def open_image_and_get_info(path, last_band_alpha=False, cache=None,
+                            window=None, decimation=1):
+    ''' Opens an image and reads its alpha mask and band count through a
+    DatasetCache (DEFAULT_DATASET_CACHE unless another is given).
+
+    :returns: (gdal_ds, alpha, band_count), where alpha is a read-only
+        boolean array (of the window and decimation if given)
+    '''
+    if cache is None:
+        cache = DEFAULT_DATASET_CACHE
+    return cache.get(path, last_band_alpha, window, decimation)
+
+
+def open_image_and_get_packed_alpha(path, last_band_alpha=False, cache=None,
+                                    window=None, decimation=1):
+    ''' Opens an image and reads its bit packed alpha mask and band count
+    through a DatasetCache (DEFAULT_DATASET_CACHE unless another is given).
+
+    :returns: (gdal_ds, packed_alpha, band_count), where packed_alpha is a
+        read-only uint8 array (of the window and decimation if given)
+    '''
+    if cache is None:
+        cache = DEFAULT_DATASET_CACHE
+    return cache.get_packed(path, last_band_alpha, window, decimation)
+
+
+def unpack_alpha(packed_alpha, xsize):
+    ''' Converts a packed mask from read_packed_alpha_and_band_count to a
+    boolean array.
+
+    :param array packed_alpha: A bit packed mask
+    :param int xsize: The width of the image
+
+    :returns: A 2D boolean array (True for valid pixels)
+    '''
+    return numpy.unpackbits(packed_alpha, axis=1)[:, :xsize].astype(
+        numpy.bool)
+
+
+def image_band_count(gdal_ds, last_band_alpha=False):
+    ''' Returns the number of image bands of a dataset (excluding any alpha
+    band), without reading any pixels.
+    '''
+    return _alpha_band_and_band_count(gdal_ds, last_band_alpha)[1]
+
+
+def _alpha_band_and_band_count(gdal_ds, last_band_alpha=False):
+    ''' Finds the band holding the alpha information.
+
+    :returns: The GDAL band to read the alpha from (None if every pixel is
+        valid) and the number of image bands
+    '''
     logging.info('GImage: Initial band count: {}'.format(
         gdal_ds.RasterCount))
     last_band = gdal_ds.GetRasterBand(gdal_ds.RasterCount)
     if last_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
         logging.info('GImage: Alpha band found, reducing band count')
-        alpha = last_band.ReadAsArray().astype(numpy.bool)
-        band_count = gdal_ds.RasterCount - 1
+        return last_band, gdal_ds.RasterCount - 1
     elif last_band_alpha:
         logging.info(
             'GImage: Forcing last band to be an alpha band, reducing band '
             'count')
-        alpha = last_band.ReadAsArray().astype(numpy.bool)
-        band_count = gdal_ds.RasterCount - 1
+        return last_band, gdal_ds.RasterCount - 1
+    elif last_band.GetMaskFlags() == gdal.GMF_PER_DATASET:
+        logging.info('GImage: Dataset mask band found')
+        return last_band.GetMaskBand(), gdal_ds.RasterCount
+    logging.info('GImage: No alpha band found')
+    return None, gdal_ds.RasterCount
+
+
+def _alpha_windows(gdal_ds, alpha_band, window=None, decimation=1):
+    ''' Yields (strip, yoff, rows) for strips of whole blocks of alpha_band
+    (within window if one is given). strip holds the ReadAsArray arguments
+    and yoff and rows are the rows of the (decimated) output the strip
+    fills.
+    '''
+    if window is None:
+        window = Window(0, 0, gdal_ds.RasterXSize, gdal_ds.RasterYSize)
     else:
-        logging.info('GImage: No alpha band found')
-        alpha = numpy.ones(
-            (gdal_ds.RasterYSize, gdal_ds.RasterXSize),
-            dtype=numpy.bool)
-        band_count = gdal_ds.RasterCount
-    return alpha, band_count
+        window = Window(*window)
+    if decimation > 1:
+        # A decimated read is small, and reading it whole samples the same
+        # pixels as a decimated read of an image band
+        buf_ysize, buf_xsize = decimated_shape(
+            (window.ysize, window.xsize), decimation)
+        yield window + (buf_xsize, buf_ysize), 0, buf_ysize
+        return
+    block_rows = max(alpha_band.GetBlockSize()[1], 256)
+    for yoff, rows in iter_row_blocks(window.ysize, block_rows):
+        yield (window.xoff, window.yoff + yoff, window.xsize, rows), \
+            yoff, rows
+
+
+def window_shape(gdal_ds, window):
+    ''' Returns the (ysize, xsize) of a window of a dataset (the whole raster
+    if window is None)
+    '''
+    if window is None:
+        return gdal_ds.RasterYSize, gdal_ds.RasterXSize
+    window = Window(*window)
+    return window.ysize, window.xsize
+
 
+def _window_slices(window):
+    window = Window(*window)
+    return (slice(window.yoff, window.yoff + window.ysize),
+            slice(window.xoff, window.xoff + window.xsize))
 
-def _nodata_to_mask(bands, nodata):
-    alpha = numpy.ones(bands[0].shape, dtype=numpy.uint16)
-    for band in bands:
-        alpha[band == nodata] = 0
-    return alpha
+
+def _nodata_to_mask(bands, nodata, out=None, block_rows=1024):
+    ''' Calculates a boolean mask that is False wherever any band is nodata.
+
+    If out is given (e.g. an existing alpha) it is updated in place, so its
+    False pixels stay False. The bands are compared a strip at a time, so the
+    only temporary is a strip sized boolean array however many bands there
+    are.
+
+    :param list bands: A list of 2D arrays
+    :param int nodata: The nodata value
+    :param array out: [Optional] A boolean array to update in place
+    :param int block_rows: The number of rows to compare at a time
+
+    :returns: A 2D boolean array (True for valid pixels)
+    '''
+    ysize = bands[0].shape[0]
+    if out is None:
+        out = numpy.ones(bands[0].shape, dtype=numpy.bool)
+    is_valid = numpy.empty((min(block_rows, ysize),) + bands[0].shape[1:],
+                           dtype=numpy.bool)
+    for yoff, rows in iter_row_blocks(ysize, block_rows):
+        out_rows = out[yoff:yoff + rows]
+        is_valid_rows = is_valid[:rows]
+        for band in bands:
+            numpy.not_equal(band[yoff:yoff + rows], nodata, out=is_valid_rows)
+            numpy.logical_and(out_rows, is_valid_rows, out=out_rows)
+    return out
 
 
+@instrumentation.instrumented
 def check_comparable(gimages, check_metadata=False):
     '''Checks that the gimages have the same number of bands, band dimensions,
     and, optionally, geospatial metadata'''
@@ -206,6 +1182,7 @@ def check_comparable(gimages, check_metadata=False):
                 '(initial: {})'.format(i + 1, image.metadata, metadata))
 
 
+@instrumentation.instrumented
 def check_equal(gimages, check_metadata=False):
     '''Checks that a list of gimages are equivalent'''
 
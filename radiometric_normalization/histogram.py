@@ -0,0 +1,255 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from radiometric_normalization import instrumentation
+
+
+'''
+Joint histograms of coincident (candidate, reference) pixel values.
+
+A band of a scene pair has far fewer distinct value pairs than pixels, so the
+statistics the other stages need (moments, covariance, 2D histograms for
+filtering, pixel plots) can be computed from a sparse histogram of the pairs
+instead of from the pixels. Histograms are built by streaming blocks of
+pixels through JointHistogram.update and can be shared between stages with a
+JointHistogramCache.
+'''
+
+# Bin numbers are offset to be positive and below 2 ** 31, so a (candidate,
+# reference) bin pair packs into one signed 64 bit key
+_BIN_OFFSET = 2 ** 30
+
+
+class JointHistogram(object):
+    ''' A sparse 2D histogram of (candidate, reference) value pairs for one
+    band.
+
+    Values are quantised to bins bin_width wide. With the default bin_width
+    of 1 the histogram of integer data is exact, i.e. it holds every distinct
+    value pair and how many pixels have it. Each bin is represented by the
+    value at its centre.
+    '''
+    def __init__(self, bin_width=1):
+        '''
+        :param number bin_width: The width of the bins in both axes
+        '''
+        self.bin_width = bin_width
+        self._keys = numpy.zeros(0, dtype=numpy.int64)
+        self._counts = numpy.zeros(0, dtype=numpy.int64)
+        self._centre_offset = None
+
+    def update(self, candidate_data, reference_data):
+        ''' Adds a block of pixels.
+
+        :param list candidate_data: A list of valid candidate data
+        :param list reference_data: A list of coincident valid reference data
+        '''
+        candidate_data = numpy.asarray(candidate_data)
+        reference_data = numpy.asarray(reference_data)
+        if self._centre_offset is None:
+            # Integer bins hold the values bin_width apart, so their centre
+            # is half a step short of the middle of the interval
+            if candidate_data.dtype.kind in 'ui':
+                self._centre_offset = (self.bin_width - 1) / 2.0
+            else:
+                self._centre_offset = self.bin_width / 2.0
+        if not len(candidate_data):
+            return
+
+        keys = (self._bins(candidate_data) << 32) | \
+            self._bins(reference_data)
+        keys, counts = numpy.unique(keys, return_counts=True)
+        self._merge(keys, counts)
+
+    def merge(self, other):
+        ''' Adds the pixels of another JointHistogram with the same bin_width.
+        '''
+        if other.bin_width != self.bin_width:
+            raise Exception('Cannot merge histograms with different bin '
+                            'widths ({} and {})'.format(self.bin_width,
+                                                        other.bin_width))
+        if self._centre_offset is None:
+            self._centre_offset = other._centre_offset
+        self._merge(other._keys, other._counts)
+
+    @property
+    def count(self):
+        ''' The number of pixels in the histogram '''
+        return int(self._counts.sum())
+
+    @property
+    def counts(self):
+        ''' The number of pixels in each occupied bin '''
+        return self._counts
+
+    @property
+    def candidate_values(self):
+        ''' The candidate value at the centre of each occupied bin '''
+        return self._values(self._keys >> 32)
+
+    @property
+    def reference_values(self):
+        ''' The reference value at the centre of each occupied bin '''
+        return self._values(self._keys & 0xffffffff)
+
+    def mean(self):
+        ''' :returns: The (candidate, reference) means '''
+        weights = self._weights()
+        return (numpy.dot(weights, self.candidate_values),
+                numpy.dot(weights, self.reference_values))
+
+    def std(self):
+        ''' :returns: The (candidate, reference) population standard
+        deviations (as numpy.std) '''
+        covariance = self.covariance()
+        return numpy.sqrt(covariance[0, 0]), numpy.sqrt(covariance[1, 1])
+
+    def covariance(self):
+        ''' :returns: The 2x2 population covariance matrix of the
+        (candidate, reference) values '''
+        weights = self._weights()
+        c_mean, r_mean = self.mean()
+        c_values = self.candidate_values - c_mean
+        r_values = self.reference_values - r_mean
+        c_var = numpy.dot(weights, c_values * c_values)
+        r_var = numpy.dot(weights, r_values * r_values)
+        cr_covar = numpy.dot(weights, c_values * r_values)
+        return numpy.array([[c_var, cr_covar], [cr_covar, r_var]])
+
+    def corrcoef(self):
+        ''' :returns: The correlation coefficient of the candidate and
+        reference values '''
+        covariance = self.covariance()
+        return covariance[0, 1] / numpy.sqrt(
+            covariance[0, 0] * covariance[1, 1])
+
+    def histogram2d(self, bins=10):
+        ''' Rebins the histogram as numpy.histogram2d would bin the pixels
+        (exactly so for an exact histogram).
+
+        :param bins: Passed through to numpy.histogram2d
+
+        :returns: H, candidate_edges, reference_edges (as numpy.histogram2d)
+        '''
+        return numpy.histogram2d(
+            self.candidate_values, self.reference_values, bins=bins,
+            weights=self._counts)
+
+    def _bins(self, data):
+        if self.bin_width == 1:
+            bins = numpy.floor(data) if data.dtype.kind == 'f' else data
+        else:
+            bins = numpy.floor_divide(data, self.bin_width)
+        bins = bins.astype(numpy.int64) + _BIN_OFFSET
+        if len(bins) and (bins.min() < 0 or bins.max() >= 2 ** 31):
+            raise Exception('Values are out of range for a joint histogram '
+                            'with a bin width of {}'.format(self.bin_width))
+        return bins
+
+    def _values(self, bins):
+        return (bins - _BIN_OFFSET) * self.bin_width + self._centre_offset
+
+    def _weights(self):
+        if not len(self._counts):
+            raise Exception('The joint histogram is empty')
+        return self._counts / float(self._counts.sum())
+
+    def _merge(self, keys, counts):
+        if not len(self._keys):
+            self._keys = keys.copy()
+            self._counts = counts.astype(numpy.int64)
+            return
+        keys, inverse = numpy.unique(
+            numpy.concatenate([self._keys, keys]), return_inverse=True)
+        self._counts = numpy.bincount(
+            inverse, weights=numpy.concatenate([self._counts, counts]),
+            minlength=len(keys)).astype(numpy.int64)
+        self._keys = keys
+
+
+def unique_pairs(candidate_data, reference_data):
+    ''' Collapses coincident candidate and reference data into its distinct
+    (candidate, reference) value pairs and how many pixels have each, so a
+    fit weighted by the counts is equivalent to a fit to every pixel.
+
+    :param list candidate_data: A list of valid candidate data
+    :param list reference_data: A list of coincident valid reference data
+
+    :returns: candidate_values, reference_values, counts (1D arrays)
+    '''
+    candidate_data = numpy.asarray(candidate_data)
+    reference_data = numpy.asarray(reference_data)
+    if candidate_data.dtype.kind in 'ui' and \
+            reference_data.dtype.kind in 'ui':
+        # An exact joint histogram packs each pair into one key, which is
+        # much quicker to sort than the rows of a 2D array
+        joint_histogram = JointHistogram()
+        joint_histogram.update(candidate_data, reference_data)
+        return (joint_histogram.candidate_values,
+                joint_histogram.reference_values, joint_histogram.counts)
+
+    pairs, counts = numpy.unique(
+        numpy.column_stack([candidate_data, reference_data]), axis=0,
+        return_counts=True)
+    return pairs[:, 0], pairs[:, 1], counts
+
+
+class JointHistogramCache(object):
+    ''' A least recently used cache of the per band JointHistograms of scene
+    pairs, so the stages that need statistics of the same pixels build them
+    only once.
+
+    Keys are built by the caller (see histogram_wrapper.generate) from
+    whatever identifies the pixels the histograms describe. Cached histograms
+    are shared by every caller, so they must not be updated.
+    '''
+    def __init__(self, max_entries=8):
+        '''
+        :param int max_entries: The number of scene pairs to keep
+        '''
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        ''' :returns: The list of JointHistograms cached for key (or None) '''
+        with self._lock:
+            histograms = self._entries.pop(key, None)
+            if histograms is None:
+                instrumentation.increment('histogram.cache.misses')
+                return None
+            instrumentation.increment('histogram.cache.hits')
+            self._entries[key] = histograms
+            return histograms
+
+    def put(self, key, histograms):
+        ''' Caches the list of JointHistograms of key '''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = histograms
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+
+DEFAULT_HISTOGRAM_CACHE = JointHistogramCache()
@@ -0,0 +1,215 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+'''
+Lightweight timers and counters for the library's public functions.
+
+Nothing is recorded until a sink is installed with set_sink, so when
+instrumentation is not in use the only cost of an instrumented call is a
+check of a module global. Sinks must provide record_time(name, seconds),
+increment(name, value) and flush().
+
+Expensive diagnostics (e.g. correlation coefficients computed only to be
+logged) are gated by set_diagnostics rather than by the logging level.
+'''
+
+_sink = None
+_diagnostics = False
+
+
+def set_sink(sink):
+    ''' Installs the sink that timers and counters are recorded to.
+
+    :param object sink: A sink (e.g. MemorySink) or None to disable recording
+
+    :returns: The previously installed sink
+    '''
+    global _sink
+    previous_sink = _sink
+    _sink = sink
+    return previous_sink
+
+
+def get_sink():
+    return _sink
+
+
+def set_diagnostics(enabled):
+    ''' Enables or disables expensive diagnostic statistics.
+    '''
+    global _diagnostics
+    _diagnostics = bool(enabled)
+
+
+def diagnostics_enabled():
+    return _diagnostics
+
+
+def increment(name, value=1):
+    ''' Adds value to the counter called name (if a sink is installed).
+    '''
+    sink = _sink
+    if sink is not None:
+        sink.increment(name, value)
+
+
+def record_time(name, seconds):
+    ''' Records a duration for the timer called name (if a sink is installed).
+    '''
+    sink = _sink
+    if sink is not None:
+        sink.record_time(name, seconds)
+
+
+def flush():
+    ''' Flushes the installed sink (if there is one).
+    '''
+    sink = _sink
+    if sink is not None:
+        sink.flush()
+
+
+@contextmanager
+def timer(name):
+    ''' Context manager that records the duration of a block of code.
+    '''
+    if _sink is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_time(name, time.time() - start)
+
+
+def instrumented(function):
+    ''' Decorator that records the duration of each call to function. The
+    timer is named <module>.<function>, e.g. 'pif.generate_pca_pifs'.
+    '''
+    name = '{}.{}'.format(function.__module__.split('.')[-1],
+                          function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _sink is None:
+            return function(*args, **kwargs)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record_time(name, time.time() - start)
+    return wrapper
+
+
+class MemorySink(object):
+    ''' Keeps the total, count and maximum of each timer and the total of each
+    counter in memory.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def record_time(self, name, seconds):
+        with self._lock:
+            total, count, maximum = self.timers.get(name, (0.0, 0, 0.0))
+            self.timers[name] = (total + seconds, count + 1,
+                                 max(maximum, seconds))
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self):
+        pass
+
+
+class JsonLinesSink(object):
+    ''' Appends one JSON object per event to a file.
+
+    The file is (re)opened in append mode by each process that writes to it,
+    so a sink installed before forking worker processes is safe to share.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def record_time(self, name, seconds):
+        self._write({'type': 'timer', 'name': name, 'seconds': seconds})
+
+    def increment(self, name, value=1):
+        self._write({'type': 'counter', 'name': name, 'value': value})
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def _write(self, event):
+        event['time'] = time.time()
+        event['pid'] = os.getpid()
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                self._file = open(self.path, 'a')
+                self._pid = os.getpid()
+            self._file.write(line)
+
+
+class PrometheusTextfileSink(MemorySink):
+    ''' Aggregates in memory and writes a Prometheus textfile collector file
+    on flush. The file is replaced atomically so the collector never reads a
+    partial file.
+    '''
+    def __init__(self, path, prefix='radiometric_normalization'):
+        super(PrometheusTextfileSink, self).__init__()
+        self.path = path
+        self.prefix = prefix
+
+    def flush(self):
+        with self._lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+
+        lines = ['# TYPE {}_call_seconds summary'.format(self.prefix)]
+        for name, (total, count, _) in timers:
+            lines.append('{}_call_seconds_sum{{name="{}"}} {}'.format(
+                self.prefix, name, total))
+            lines.append('{}_call_seconds_count{{name="{}"}} {}'.format(
+                self.prefix, name, count))
+        lines.append('# TYPE {}_call_seconds_max gauge'.format(self.prefix))
+        for name, (_, _, maximum) in timers:
+            lines.append('{}_call_seconds_max{{name="{}"}} {}'.format(
+                self.prefix, name, maximum))
+        lines.append('# TYPE {}_events_total counter'.format(self.prefix))
+        for name, value in counters:
+            lines.append('{}_events_total{{name="{}"}} {}'.format(
+                self.prefix, name, value))
+
+        temporary_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.rename(temporary_path, self.path)
@@ -0,0 +1,159 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import numpy
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+'''
+Per pixel inner loops that NumPy runs as several passes over memory (one per
+operation, with a temporary array for each).
+
+If Numba is installed each kernel is compiled into a single parallel pass;
+otherwise (or with backend='numpy') the NumPy implementation is used. Both
+backends give the same results.
+'''
+
+NUMPY = 'numpy'
+NUMBA = 'numba'
+
+
+def default_backend():
+    ''' :returns: NUMBA if Numba is installed, otherwise NUMPY '''
+    return NUMBA if HAVE_NUMBA else NUMPY
+
+
+def residual_mask(candidate_data, reference_data, gain, offset, threshold,
+                  backend=None):
+    ''' Finds the pixels whose perpendicular distance from the line
+    reference = gain * candidate + offset is less than threshold.
+
+    :param array candidate_data: A 1D array of candidate data
+    :param array reference_data: A 1D array of coincident reference data
+    :param str backend: [Optional] NUMPY or NUMBA (default_backend() if not
+        given)
+
+    :returns: A 1D boolean array
+    '''
+    candidate_data = numpy.asarray(candidate_data)
+    reference_data = numpy.asarray(reference_data)
+    # Fits can give the gain and offset as one element arrays
+    gain = numpy.asarray(gain, dtype=numpy.float64).item()
+    offset = numpy.asarray(offset, dtype=numpy.float64).item()
+    norm = numpy.sqrt(1 + gain * gain)
+    if _backend(backend) == NUMBA:
+        passed = numpy.empty(len(candidate_data), dtype=numpy.bool_)
+        _residual_mask_numba(candidate_data, reference_data, gain, offset,
+                             norm, float(threshold), passed)
+        return passed
+
+    residuals = candidate_data * gain
+    residuals -= reference_data
+    residuals += offset
+    numpy.absolute(residuals, residuals)
+    residuals /= norm
+    return residuals < threshold
+
+
+def apply_lut(band, lut, out=None, backend=None):
+    ''' Looks up each value of band in a lut that starts at the minimum of
+    band's data type (values past the end of the lut take its last entry).
+
+    :param array band: An integer array
+    :param array lut: A 1D array
+    :param array out: [Optional] An array of band's shape to write to
+    :param str backend: [Optional] NUMPY or NUMBA (default_backend() if not
+        given)
+
+    :returns: An array of band's shape (out if it was given)
+    '''
+    if out is None:
+        out = numpy.empty(band.shape, dtype=lut.dtype)
+    if _backend(backend) == NUMBA and out.flags.c_contiguous:
+        _apply_lut_numba(band.reshape(-1), lut,
+                         int(numpy.iinfo(band.dtype).min), out.reshape(-1))
+        return out
+
+    if band.dtype.kind == 'i':
+        # Flipping the sign bit maps the signed range onto the unsigned
+        # range in order, so the minimum indexes the start of the lut
+        unsigned = numpy.dtype('u{}'.format(band.dtype.itemsize))
+        sign_bit = unsigned.type(1 << (8 * band.dtype.itemsize - 1))
+        band = band.view(unsigned) ^ sign_bit
+    return numpy.take(lut, band, mode='clip', out=out)
+
+
+def accumulate_masked(sums, counts, band, valid, backend=None):
+    ''' Adds the valid pixels of band to sums and counts them, in place.
+
+    :param array sums: A float array to add to
+    :param array counts: An integer array of sums' shape of the number of
+        values added to each pixel
+    :param array band: An array of sums' shape to add
+    :param array valid: A boolean array of sums' shape (True for pixels to
+        add)
+    :param str backend: [Optional] NUMPY or NUMBA (default_backend() if not
+        given)
+    '''
+    if _backend(backend) == NUMBA and sums.flags.c_contiguous and \
+            counts.flags.c_contiguous:
+        _accumulate_masked_numba(sums.reshape(-1), counts.reshape(-1),
+                                 numpy.ravel(band), numpy.ravel(valid))
+        return
+
+    numpy.add(sums, band, out=sums, where=valid)
+    counts += valid
+
+
+def _backend(backend):
+    if backend is None:
+        return default_backend()
+    if backend == NUMBA and not HAVE_NUMBA:
+        raise Exception('The numba backend needs Numba to be installed')
+    if backend not in (NUMPY, NUMBA):
+        raise Exception('Unknown kernel backend: {}'.format(backend))
+    return backend
+
+
+if HAVE_NUMBA:
+    # Compiled on first use and cached on disk between runs
+    @numba.njit(parallel=True, cache=True)
+    def _residual_mask_numba(candidate_data, reference_data, gain, offset,
+                             norm, threshold, passed):
+        for i in numba.prange(candidate_data.shape[0]):
+            residual = abs(gain * candidate_data[i] - reference_data[i] +
+                           offset) / norm
+            passed[i] = residual < threshold
+
+    @numba.njit(parallel=True, cache=True)
+    def _apply_lut_numba(band, lut, minimum, out):
+        last = lut.shape[0] - 1
+        for i in numba.prange(band.shape[0]):
+            index = numba.int64(band[i]) - minimum
+            if index > last:
+                index = last
+            out[i] = lut[index]
+
+    @numba.njit(parallel=True, cache=True)
+    def _accumulate_masked_numba(sums, counts, band, valid):
+        for i in numba.prange(band.shape[0]):
+            if valid[i]:
+                sums[i] += band[i]
+                counts[i] += 1
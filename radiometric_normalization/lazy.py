@@ -0,0 +1,403 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import logging
+import os
+import threading
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy
+
+try:
+    import dask
+    import dask.array as da
+    HAVE_DASK = True
+except ImportError:
+    HAVE_DASK = False
+
+from radiometric_normalization import gimage
+from radiometric_normalization import normalize
+from radiometric_normalization import pca_filter
+from radiometric_normalization import pif
+from radiometric_normalization import transformation
+
+
+'''
+Lazy counterparts of the PIF, transformation, normalization and time stack
+stages, built on chunked Dask arrays so images larger than memory are
+processed a chunk at a time on several cores.
+
+Loading an image only records where its chunks are; nothing is read until a
+result is computed. Statistics that need every pixel (the PCA filter and the
+transformation fits) are computed when they are asked for, each as one pass
+over the chunks that keeps only a few numbers per chunk. Masks, normalized
+bands and time stack means stay lazy until they are written with to_file.
+
+The graphs run on whichever Dask scheduler is active (see use_scheduler).
+
+- Bands: A list of 2D dask arrays (in the data type of the file)
+- Alpha: A 2D boolean dask array (True for valid pixels)
+- Metadata: A dict containing georeferencing information (as gimage.GImage)
+'''
+LazyImage = namedtuple('LazyImage', 'bands, alpha, metadata')
+
+# The default chunk height and width. A 1024 x 1024 uint16 chunk is 2MB.
+DEFAULT_CHUNKS = 1024
+
+SCHEDULERS = ['threads', 'processes', 'synchronous', 'distributed']
+
+# The per chunk statistics gathered by masked_moments
+_MOMENT_COUNT = 6
+
+
+def _assert_have_dask():
+    if not HAVE_DASK:
+        raise Exception('Lazy processing needs Dask to be installed')
+
+
+@contextmanager
+def use_scheduler(scheduler='threads', workers=None):
+    ''' Runs the lazy stages computed inside the context on a Dask scheduler.
+
+    :param str scheduler: 'threads' (a thread pool), 'processes' (a process
+        pool), 'synchronous' (the calling thread, for debugging) or
+        'distributed' (a local dask.distributed cluster of worker processes)
+    :param int workers: [Optional] The number of threads, processes or
+        distributed workers (Dask's default if not given)
+    '''
+    _assert_have_dask()
+    if scheduler not in SCHEDULERS:
+        raise Exception('Unknown scheduler: {}'.format(scheduler))
+
+    if scheduler != 'distributed':
+        config = {'scheduler': scheduler}
+        if workers and scheduler != 'synchronous':
+            config['num_workers'] = workers
+        with dask.config.set(config):
+            yield
+        return
+
+    from dask.distributed import Client, LocalCluster
+    cluster = LocalCluster(n_workers=workers, threads_per_worker=1)
+    # A new client becomes the default scheduler until it is closed
+    client = Client(cluster)
+    logging.info('Lazy: Running on a local cluster ({})'.format(
+        client.dashboard_link))
+    try:
+        yield
+    finally:
+        client.close()
+        cluster.close()
+
+
+class _ImageReader(object):
+    ''' An array-like view of one band (or the alpha) of a window of an image
+    that only reads the pixels it is sliced with, so Dask can read it a chunk
+    at a time.
+
+    It holds the image's path rather than an open dataset, so it can be sent
+    to worker processes; each worker thread opens its own dataset.
+    '''
+    def __init__(self, path, window, dtype, band_no=None,
+                 last_band_alpha=False):
+        '''
+        :param str path: The path to the image
+        :param Window window: The window of the image to view
+        :param dtype: The numpy data type of the band
+        :param int band_no: The GDAL band number (None for the alpha)
+        :param bool last_band_alpha: Treat the last band as an alpha band
+        '''
+        self.path = os.path.abspath(path)
+        self.window = gimage.Window(*window)
+        self.dtype = numpy.dtype(dtype)
+        self.band_no = band_no
+        self.last_band_alpha = last_band_alpha
+        self.shape = (self.window.ysize, self.window.xsize)
+        self.ndim = 2
+
+    def __getitem__(self, key):
+        (ystart, ystop, ystep), (xstart, xstop, xstep) = [
+            index.indices(size) for index, size in zip(key, self.shape)]
+        if ystop <= ystart or xstop <= xstart:
+            return numpy.empty((0, 0), dtype=self.dtype)
+
+        read_window = gimage.Window(
+            self.window.xoff + xstart, self.window.yoff + ystart,
+            xstop - xstart, ystop - ystart)
+        gdal_ds = _open_dataset(self.path)
+        if self.band_no is None:
+            array, _ = gimage.read_alpha_and_band_count(
+                gdal_ds, self.last_band_alpha, read_window)
+        else:
+            array = gimage.read_single_band(gdal_ds, self.band_no,
+                                            read_window)
+        return array[::ystep, ::xstep]
+
+    def __dask_tokenize__(self):
+        # Like gimage.DatasetCache, a rewritten file gets new chunks
+        stat = os.stat(self.path)
+        return (self.path, stat.st_mtime, stat.st_size, tuple(self.window),
+                self.band_no, self.last_band_alpha)
+
+
+_THREAD_DATASETS = threading.local()
+
+
+def _open_dataset(path):
+    # Dataset handles must not be shared between threads
+    cache = getattr(_THREAD_DATASETS, 'cache', None)
+    if cache is None:
+        cache = _THREAD_DATASETS.cache = gimage.DatasetCache()
+    return cache.dataset(path)
+
+
+def load(filename, last_band_alpha=False, window=None, bbox=None,
+         chunks=DEFAULT_CHUNKS):
+    ''' Loads an image (or the part of it in a pixel window or geographic
+    bounding box) as a LazyImage. Only the image's size, data type and
+    metadata are read.
+
+    :param str filename: Path to the image
+    :param bool last_band_alpha: Treat the last band as an alpha band
+    :param Window window: [Optional] The pixel window to load
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the image's coordinate system to load (instead of window)
+    :param int chunks: The height and width of the chunks (a tuple of
+        (height, width) is also accepted)
+
+    :returns: A LazyImage
+    '''
+    _assert_have_dask()
+    logging.info('Lazy: Loading {} as LazyImage'.format(filename))
+    gdal_ds = gimage.open_dataset(filename)
+    window = gimage.resolve_window(gdal_ds, window, bbox)
+    if window is None:
+        window = gimage.Window(0, 0, gdal_ds.RasterXSize, gdal_ds.RasterYSize)
+    band_count = gimage.image_band_count(gdal_ds, last_band_alpha)
+    metadata = gimage.window_metadata(gimage.read_metadata(gdal_ds), window)
+
+    def from_reader(reader):
+        return da.from_array(reader, chunks=chunks, lock=False,
+                             meta=numpy.empty((0, 0), dtype=reader.dtype))
+
+    bands = [from_reader(_ImageReader(
+        filename, window, gimage.band_dtype(gdal_ds.GetRasterBand(band_no)),
+        band_no)) for band_no in range(1, band_count + 1)]
+    alpha = from_reader(_ImageReader(filename, window, bool,
+                                     last_band_alpha=last_band_alpha))
+    return LazyImage(bands, alpha, metadata)
+
+
+def masked_moments(candidate_band, reference_band, mask):
+    ''' Builds the graph of the joint statistics of the masked pixels of two
+    bands. Each chunk is reduced to its count, means and sums of squared
+    deviations, which are combined exactly (see _combine_moments), so the
+    statistics take one pass and do not lose precision on large images.
+
+    :param array candidate_band: A 2D dask array of candidate data
+    :param array reference_band: A 2D dask array of reference data
+    :param array mask: A 2D boolean dask array of the pixels to include
+
+    :returns: A dask array of the pixel count, the candidate and reference
+        means, the candidate and reference variances and their covariance
+    '''
+    block_chunks = tuple((1,) * blocks for blocks in candidate_band.numblocks)
+    block_moments = da.map_blocks(
+        _block_moments, candidate_band, reference_band, mask, new_axis=2,
+        chunks=block_chunks + ((_MOMENT_COUNT,),), dtype=numpy.float64)
+    return block_moments.rechunk(block_moments.shape).map_blocks(
+        _combine_moments, drop_axis=[0, 1], chunks=((_MOMENT_COUNT,),),
+        dtype=numpy.float64)
+
+
+def _block_moments(candidate_block, reference_block, mask_block):
+    candidate_data = candidate_block[mask_block].astype(numpy.float64)
+    reference_data = reference_block[mask_block].astype(numpy.float64)
+    moments = numpy.zeros(_MOMENT_COUNT)
+    if len(candidate_data):
+        c_mean = candidate_data.mean()
+        r_mean = reference_data.mean()
+        candidate_data -= c_mean
+        reference_data -= r_mean
+        moments[:] = (len(candidate_data), c_mean, r_mean,
+                      numpy.dot(candidate_data, candidate_data),
+                      numpy.dot(reference_data, reference_data),
+                      numpy.dot(candidate_data, reference_data))
+    return moments.reshape(1, 1, _MOMENT_COUNT)
+
+
+def _combine_moments(block_moments):
+    ''' Combines the per chunk statistics from _block_moments with the
+    pairwise update of Chan, Golub and LeVeque
+    '''
+    counts, c_means, r_means, c_sums, r_sums, cr_sums = \
+        block_moments.reshape(-1, _MOMENT_COUNT).T
+    count = counts.sum()
+    if count == 0:
+        return numpy.zeros(_MOMENT_COUNT)
+
+    c_mean = numpy.dot(counts, c_means) / count
+    r_mean = numpy.dot(counts, r_means) / count
+    c_deviations = c_means - c_mean
+    r_deviations = r_means - r_mean
+    return numpy.array([
+        count, c_mean, r_mean,
+        (c_sums.sum() + numpy.dot(counts, c_deviations ** 2)) / count,
+        (r_sums.sum() + numpy.dot(counts, r_deviations ** 2)) / count,
+        (cr_sums.sum() +
+         numpy.dot(counts, c_deviations * r_deviations)) / count])
+
+
+def pif_mask(candidate, reference, method='filter_alpha',
+             method_options=None):
+    ''' Builds the graph of a PIF mask of two LazyImages.
+
+    'filter_PCA' fits each band to the pixels that passed the bands before
+    it (as pif_wrapper.generate does). Each band's fit is computed as it is
+    reached, reading that band and the bands before it again, so no more than
+    a few chunks are held in memory at once.
+
+    :param LazyImage candidate: The candidate image
+    :param LazyImage reference: The reference image
+    :param str method: 'filter_alpha' or 'filter_PCA'
+    :param pif.pca_options method_options: [Optional] The options for
+        'filter_PCA' (pif.DEFAULT_PCA_OPTIONS if not given)
+
+    :returns: A 2D boolean dask array (True for the PIF)
+    '''
+    _assert_consistent(candidate, reference)
+    combined_alpha = da.logical_and(candidate.alpha, reference.alpha)
+    if method == 'filter_alpha':
+        return combined_alpha
+    elif method == 'filter_PCA':
+        parameters = method_options or pif.DEFAULT_PCA_OPTIONS
+        mask = combined_alpha
+        for band_no, (c_band, r_band) in enumerate(
+                zip(candidate.bands, reference.bands), 1):
+            moments = masked_moments(c_band, r_band, mask).compute()
+            logging.info('Lazy: Fitted the PCA of band {} to {} '
+                         'pixels'.format(band_no, int(moments[0])))
+            mask = da.map_blocks(
+                _pca_filter_block, c_band, r_band, mask, dtype=bool,
+                moments=moments, threshold=parameters.threshold)
+        return mask
+    else:
+        raise NotImplementedError('Only "filter_alpha" and "filter_PCA" '
+                                  'methods are implemented for lazy images.')
+
+
+def _pca_filter_block(candidate_block, reference_block, mask_block, moments,
+                      threshold):
+    _, c_mean, r_mean, c_var, r_var, covariance = moments
+    passed = numpy.zeros(mask_block.shape, dtype=bool)
+    passed[mask_block] = pca_filter.filter_by_minor_axis(
+        (c_mean, r_mean), [[c_var, covariance], [covariance, r_var]],
+        candidate_block[mask_block], reference_block[mask_block], threshold)
+    return passed
+
+
+def linear_relationships(candidate, reference, pif_mask):
+    ''' Fits a linear relationship (see
+    transformation.generate_linear_relationship) to the PIFs of each band,
+    computing every band's statistics in one pass.
+
+    :param LazyImage candidate: The candidate image
+    :param LazyImage reference: The reference image
+    :param array pif_mask: A 2D boolean dask array of the PIFs
+
+    :returns: A list of LinearTransformations (one for each band)
+    '''
+    _assert_consistent(candidate, reference)
+    all_moments = dask.compute(*[
+        masked_moments(c_band, r_band, pif_mask)
+        for c_band, r_band in zip(candidate.bands, reference.bands)])
+    return [transformation.linear_relationship_from_moments(
+        c_mean, r_mean, numpy.sqrt(c_var), numpy.sqrt(r_var))
+        for _, c_mean, r_mean, c_var, r_var, _ in all_moments]
+
+
+def normalize_image(image, per_band_transformation):
+    ''' Builds the graph of an image with a linear transformation applied to
+    each band (see normalize.apply).
+
+    :param LazyImage image: The image to normalize
+    :param list per_band_transformation: A list of LinearTransformations
+        (one for each band)
+
+    :returns: A LazyImage
+    '''
+    assert len(image.bands) == len(per_band_transformation)
+    bands = [band.map_blocks(normalize.apply, dtype=band.dtype,
+                             transformation=band_transformation)
+             for band, band_transformation in zip(
+                 image.bands, per_band_transformation)]
+    return LazyImage(bands, image.alpha, image.metadata)
+
+
+def mean_with_uniform_weight(images, output_datatype=numpy.uint16):
+    ''' Builds the graph of the mean of each band of a time stack, weighting
+    each valid pixel equally (see time_stack.mean_with_uniform_weight).
+
+    :param list images: A list of LazyImages on the same grid
+    :param output_datatype: The data type of the mean bands
+
+    :returns: A LazyImage that is valid where any image is valid
+    '''
+    gimage.check_comparable(images, check_metadata=True)
+
+    counts = sum(image.alpha.astype(numpy.uint32) for image in images)
+    bands = []
+    for band_index in range(len(images[0].bands)):
+        band_sum = sum(
+            da.where(image.alpha, image.bands[band_index], 0).astype(
+                numpy.float64)
+            for image in images)
+        bands.append(da.where(
+            counts > 0, band_sum / da.maximum(counts, 1), 0).astype(
+                output_datatype))
+    return LazyImage(bands, counts > 0, images[0].metadata)
+
+
+def to_file(image, filename, options=None, block_rows=None):
+    ''' Computes a LazyImage and writes it to a GeoTIFF, a strip of rows at a
+    time. The chunks of each strip are computed in parallel and written by
+    the calling thread.
+
+    :param LazyImage image: The image to write
+    :param str filename: The path to write to
+    :param gimage.writer_options options: [Optional] How to lay out the file
+    :param int block_rows: [Optional] The number of rows to compute at a time
+        (defaults to the chunk height)
+    '''
+    ysize, xsize = image.alpha.shape
+    if block_rows is None:
+        block_rows = image.alpha.chunks[0][0]
+
+    writer = gimage.GImageWriter(filename, xsize, ysize, len(image.bands),
+                                 image.metadata, options=options,
+                                 dtype=image.bands[0].dtype)
+    with writer:
+        for yoff, rows in gimage.iter_row_blocks(ysize, block_rows):
+            strips = dask.compute(*[
+                array[yoff:yoff + rows]
+                for array in image.bands + [image.alpha]])
+            writer.write_block(list(strips[:-1]), strips[-1], 0, yoff)
+
+
+def _assert_consistent(candidate, reference):
+    assert len(candidate.bands) == len(reference.bands)
+    assert candidate.alpha.shape == reference.alpha.shape
@@ -16,25 +16,38 @@ limitations under the License.
 import logging
 import numpy
 
+from radiometric_normalization import instrumentation
+from radiometric_normalization import kernels
+from radiometric_normalization.transformation import LutTransformation
 
-def apply(input_band, transformation, method='lut'):
+# The number of rows apply_gridded interpolates the grid over at a time
+_GRID_BLOCK_ROWS = 256
+
+
+@instrumentation.instrumented
+def apply(input_band, transformation, method='lut', out=None):
     '''Applies a linear transformation to an array. Wrapper function around
     the two methods.
 
     :param array input_band: A 2D array representing the image data of the
         a single band
     :param LinearTransformation transformation: A LinearTransformation
-        (gain and offset)
+        (gain and offset) or a LutTransformation (always applied as a look up
+        table)
+    :param array out: [Optional] An array to write the output to (see the
+        chosen method for the data type it must have)
 
     :returns: A 2D array of of the input_band with the transformation applied
     '''
-    if method == 'direct':
-        return apply_directly(input_band, transformation)
+    if method == 'direct' and not isinstance(transformation,
+                                             LutTransformation):
+        return apply_directly(input_band, transformation, out=out)
     else:
-        return apply_using_lut(input_band, transformation)
+        return apply_using_lut(input_band, transformation, out=out)
 
 
-def apply_directly(input_band, transformation):
+@instrumentation.instrumented
+def apply_directly(input_band, transformation, out=None):
     '''Applies a linear transformation to an array directly. It will output
     an array of float values. This is not very memory efficient.
 
@@ -42,47 +55,169 @@ def apply_directly(input_band, transformation):
         a single band
     :param LinearTransformation transformation: A LinearTransformation
         (gain and offset)
+    :param array out: [Optional] A float array of the same shape as
+        input_band to write the output to
 
     :returns: A 2D array of of the input_band with the transformation applied
     '''
     logging.info('Normalize: Applying linear transformation to band (float)')
     gain = transformation.gain
     offset = transformation.offset
-    return input_band.astype('float') * gain + offset
+    if out is None:
+        return input_band.astype('float') * gain + offset
+    numpy.multiply(input_band, gain, out=out)
+    out += offset
+    return out
 
 
-def apply_using_lut(input_band, transformation):
+@instrumentation.instrumented
+def apply_using_lut(input_band, transformation, out=None):
     '''Applies a linear transformation to an array using a look up table.
-    This creates a uint16 array as the output and clips the output band
-    to the range of a uint16.
+    The output array has the same data type as input_band and is clipped to
+    the range of that data type.
+
+    Look up tables are only used for integer bands of 16 bits or fewer; wider
+    integer and float bands are transformed directly (and clipped and cast
+    back to their own data type).
+
+    A LutTransformation (e.g. from transformation.generate_histogram_matching)
+    is applied with its own look up table, which must be of the band's data
+    type.
 
     :param array input_band: A 2D array representing the image data of the
         a single band
     :param LinearTransformation transformation: A LinearTransformation
-        (gain and offset)
+        (gain and offset) or a LutTransformation
+    :param array out: [Optional] An array of the same shape and data type as
+        input_band to write the output to
 
     :returns: A 2D array of of the input_band with the transformation applied
     '''
-    logging.info('Normalize: Applying linear transformation to band (uint16)')
+    instrumentation.increment('normalize.pixels', input_band.size)
+    if isinstance(transformation, LutTransformation):
+        logging.info(
+            'Normalize: Applying look up table to band ({})'.format(
+                input_band.dtype))
+        return _apply_lut(input_band, transformation.lut, out)
+
+    logging.info(
+        'Normalize: Applying linear transformation to band ({})'.format(
+            input_band.dtype))
+
+    if not _lut_dtype(input_band.dtype):
+        return _apply_directly_as_dtype(input_band, transformation, out)
+    lut = _linear_transformation_to_lut(transformation,
+                                        dtype=input_band.dtype)
+    return _apply_lut(input_band, lut, out)
+
+
+@instrumentation.instrumented
+def apply_gridded(input_band, transformation, yoff=0, xoff=0, out=None):
+    '''Applies a gridded transformation to an array (or a block of a band),
+    interpolating the gain and offset at each pixel bilinearly from the
+    centres of the cells around it. The output array has the same data type
+    as input_band and is clipped to the range of that data type.
 
-    def _apply_lut(band, lut):
-        '''Changes band intensity values based on intensity look up table (lut)
-        '''
-        if lut.dtype != band.dtype:
-            raise Exception(
-                'Band ({}) and lut ({}) must be the same data type.').format(
-                band.dtype, lut.dtype)
-        return numpy.take(lut, band, mode='clip')
+    :param array input_band: A 2D array representing the image data of the
+        a single band (or of a block of it)
+    :param GriddedTransformation transformation: A GriddedTransformation
+        (gain and offset per cell)
+    :param int yoff: The row of the band input_band starts at
+    :param int xoff: The column of the band input_band starts at
+    :param array out: [Optional] An array of the same shape and data type as
+        input_band to write the output to
 
-    lut = _linear_transformation_to_lut(transformation)
-    return _apply_lut(input_band, lut)
+    :returns: A 2D array of of the input_band with the transformation applied
+    '''
+    logging.info(
+        'Normalize: Applying gridded transformation to band ({})'.format(
+            input_band.dtype))
+
+    instrumentation.increment('normalize.pixels', input_band.size)
+    if out is None:
+        out = numpy.empty_like(input_band)
+    rows, columns = input_band.shape
+    # The per pixel gains and offsets are made a few rows at a time, so they
+    # take little memory however large the band is
+    for block_yoff in range(0, rows, _GRID_BLOCK_ROWS):
+        block = input_band[block_yoff:block_yoff + _GRID_BLOCK_ROWS]
+        output = block * _interpolate_grid(
+            transformation.gain, transformation.cell_size,
+            yoff + block_yoff, block.shape[0], xoff, columns)
+        output += _interpolate_grid(
+            transformation.offset, transformation.cell_size,
+            yoff + block_yoff, block.shape[0], xoff, columns)
+        if input_band.dtype.kind in 'ui':
+            info = numpy.iinfo(input_band.dtype)
+            numpy.clip(output, info.min, info.max, output)
+        out[block_yoff:block_yoff + block.shape[0]] = output
+    return out
+
+
+def _interpolate_grid(values, cell_size, yoff, rows, xoff, columns):
+    '''Bilinearly interpolates values at the centres of a grid of cells to a
+    block of pixels (values beyond the outer centres are those of the outer
+    cells)'''
+    top, bottom, y_weight = _grid_neighbours(yoff, rows, cell_size,
+                                             values.shape[0])
+    left, right, x_weight = _grid_neighbours(xoff, columns, cell_size,
+                                             values.shape[1])
+    y_weight = y_weight[:, numpy.newaxis]
+    row_values = values[top] * (1 - y_weight) + values[bottom] * y_weight
+    return row_values[:, left] * (1 - x_weight) + \
+        row_values[:, right] * x_weight
+
+
+def _grid_neighbours(start, length, cell_size, cells):
+    '''The cells either side of each pixel along one axis and the weight of
+    the second one'''
+    position = (numpy.arange(start, start + length) + 0.5) / cell_size - 0.5
+    numpy.clip(position, 0, cells - 1, position)
+    first = numpy.floor(position).astype(numpy.intp)
+    second = numpy.minimum(first + 1, cells - 1)
+    return first, second, position - first
+
+
+def _lut_dtype(dtype):
+    '''Whether a band of this data type is small enough to look up'''
+    dtype = numpy.dtype(dtype)
+    return dtype.kind in 'ui' and dtype.itemsize <= 2
+
+
+def _apply_lut(band, lut, out=None):
+    '''Changes band intensity values based on intensity look up table (lut)
+
+    The lut covers the whole range of the data type, starting at its minimum
+    (see kernels.apply_lut).
+    '''
+    if lut.dtype != band.dtype:
+        raise Exception(
+            'Band ({}) and lut ({}) must be the same data type.'.format(
+                band.dtype, lut.dtype))
+    return kernels.apply_lut(band, lut, out)
+
+
+def _apply_directly_as_dtype(band, transformation, out=None):
+    '''Applies a linear transformation directly, clipping and casting the
+    output to the data type of band'''
+    output = band.astype(numpy.float64)
+    output *= transformation.gain
+    output += transformation.offset
+    if band.dtype.kind in 'ui':
+        info = numpy.iinfo(band.dtype)
+        numpy.clip(output, info.min, info.max, output)
+    if out is None:
+        return output.astype(band.dtype)
+    out[...] = output
+    return out
 
 
 def _linear_transformation_to_lut(linear_transformation,
                                   max_value=None, dtype=numpy.uint16):
-    min_value = 0
+    info = numpy.iinfo(dtype)
+    min_value = info.min
     if max_value is None:
-        max_value = numpy.iinfo(dtype).max
+        max_value = info.max
 
     def gain_offset_to_lut(gain, offset):
         logging.debug(
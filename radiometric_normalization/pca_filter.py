@@ -15,11 +15,15 @@ limitations under the License.
 '''
 import itertools
 import numpy
+from collections import namedtuple
 
 from sklearn.decomposition import PCA
 
+from radiometric_normalization import histogram
 
-def pca_fit_and_filter_pixel_list(candidate_data, reference_data, parameters):
+
+def pca_fit_and_filter_pixel_list(candidate_data, reference_data, parameters,
+                                  joint_histogram=None, deduplicate=False):
     ''' Performs PCA analysis, on the valid pixels and filters according
     to the distance from the principle eigenvector, for a single band.
 
@@ -27,9 +31,33 @@ def pca_fit_and_filter_pixel_list(candidate_data, reference_data, parameters):
     :param list reference_band: A list of coincident valid reference data
     :param pca_options parameters: Method specific parameters. Currently:
         threshold (float): Representing the width of the PCA filter
+    :param histogram.JointHistogram joint_histogram: [Optional] A joint
+        histogram of the valid data. If given, the PCA is fitted to its
+        covariance instead of to the data
+    :param bool deduplicate: Fit the PCA to the distinct (candidate,
+        reference) pairs weighted by how many pixels have them, which is
+        equivalent but much quicker when there are many more pixels than
+        distinct pairs
 
     :returns: A boolean list representing the pif pixels within valid_pixels
     '''
+    if joint_histogram is not None:
+        c_mean, r_mean = joint_histogram.mean()
+        return filter_by_minor_axis(
+            (c_mean, r_mean), joint_histogram.covariance(), candidate_data,
+            reference_data, parameters.threshold)
+
+    if deduplicate:
+        c_values, r_values, counts = histogram.unique_pairs(
+            candidate_data, reference_data)
+        mean = (numpy.average(c_values, weights=counts),
+                numpy.average(r_values, weights=counts))
+        covariance = numpy.cov(c_values, r_values, fweights=counts,
+                               bias=True)
+        return filter_by_minor_axis(
+            mean, covariance, candidate_data, reference_data,
+            parameters.threshold)
+
     fitted_pca = _pca_fit_single_band(candidate_data, reference_data)
     return _pca_filter_single_band(
         fitted_pca, candidate_data, reference_data, parameters.threshold)
@@ -95,6 +123,24 @@ def _pca_filter_single_band(pca, cand_valid, ref_valid, threshold):
     return pixels_pass_filter
 
 
+def filter_by_minor_axis(mean, covariance, cand_valid, ref_valid,
+                         threshold):
+    ''' Filters by the distance from the principle eigenvector of a fitted
+    mean and covariance (e.g. from a joint histogram or from statistics
+    gathered a chunk at a time)
+    '''
+    c_mean, r_mean = mean
+    # eigh returns the eigenvalues in ascending order, so the first
+    # eigenvector is the minor one
+    _, eigenvectors = numpy.linalg.eigh(covariance)
+    c_centred = numpy.asarray(cand_valid, dtype=numpy.float64) - c_mean
+    r_centred = numpy.asarray(ref_valid, dtype=numpy.float64) - r_mean
+    minor_values = \
+        c_centred * eigenvectors[0, 0] + r_centred * eigenvectors[1, 0]
+
+    return numpy.absolute(minor_values) <= threshold
+
+
 def _pca_transform_get_only_major_values(pca, cand_valid, ref_valid):
     ''' Transforms cand_valid and ref_valid but only returns the values in the
     major eigenvector's direction (the y-values)
@@ -102,3 +148,108 @@ def _pca_transform_get_only_major_values(pca, cand_valid, ref_valid):
     X = _numpy_array_from_2arrays(cand_valid, ref_valid)
     X_trans = pca.transform(X)
     return numpy.array([x[1] for x in X_trans])
+
+
+# The mean and principal axes of the joint (candidate bands, reference bands)
+# pixel vectors. components holds the principal axes as columns and
+# minor_components the axes orthogonal to the principal subspace.
+JointPCA = namedtuple('JointPCA', 'mean, components, minor_components')
+
+
+class JointCovariance(object):
+    ''' Accumulates the covariance of joint pixel vectors (the candidate value
+    of every band followed by the reference value of every band) a block of
+    pixels at a time, so a whole image can be fitted in one streaming pass.
+
+    Values are accumulated relative to the mean of the first block, which
+    keeps the sums of products small enough to avoid losing precision to
+    cancellation.
+    '''
+    def __init__(self, band_count):
+        self.band_count = band_count
+        self.count = 0
+        self._shift = None
+        self._sum = numpy.zeros(2 * band_count)
+        self._sum_of_products = numpy.zeros((2 * band_count, 2 * band_count))
+
+    def update(self, candidate_data, reference_data):
+        ''' Adds a block of pixels.
+
+        :param list candidate_data: A list (one per band) of 1D arrays of
+            candidate values
+        :param list reference_data: A list (one per band) of 1D arrays of the
+            coincident reference values
+        '''
+        X = joint_vectors(candidate_data, reference_data)
+        if not len(X):
+            return
+        if self._shift is None:
+            self._shift = X.mean(axis=0)
+        X -= self._shift
+        self.count += len(X)
+        self._sum += X.sum(axis=0)
+        self._sum_of_products += numpy.dot(X.T, X)
+
+    def fit(self):
+        ''' Finds the principal subspace of the accumulated pixels. It has one
+        dimension per band, as the candidate and reference values of an
+        invariant pixel are linearly related band by band.
+
+        :returns: A JointPCA
+        '''
+        if self.count < 2:
+            raise Exception('At least two pixels are needed to fit a joint '
+                            'PCA ({} given)'.format(self.count))
+        mean = self._sum / self.count
+        covariance = (self._sum_of_products -
+                      self.count * numpy.outer(mean, mean)) / (self.count - 1)
+        # eigh returns the eigenvalues in ascending order
+        _, eigenvectors = numpy.linalg.eigh(covariance)
+        return JointPCA(mean + self._shift,
+                        eigenvectors[:, self.band_count:],
+                        eigenvectors[:, :self.band_count])
+
+
+def joint_vectors(candidate_data, reference_data):
+    ''' Stacks per band pixel lists into an (N, 2 * bands) float array of
+    joint pixel vectors (candidate bands, then reference bands)
+    '''
+    bands = list(candidate_data) + list(reference_data)
+    X = numpy.empty((len(bands[0]), len(bands)), dtype=numpy.float64)
+    for index, band in enumerate(bands):
+        X[:, index] = band
+    return X
+
+
+def joint_pca_distance(joint_pca, candidate_data, reference_data):
+    ''' Calculates the distance of each joint pixel vector from the principal
+    subspace of a JointPCA
+
+    :returns: A 1D array of distances
+    '''
+    X = joint_vectors(candidate_data, reference_data)
+    X -= joint_pca.mean
+    minor_values = numpy.dot(X, joint_pca.minor_components)
+    return numpy.sqrt(numpy.einsum('ij,ij->i', minor_values, minor_values))
+
+
+def joint_pca_fit_and_filter_pixel_list(candidate_data, reference_data,
+                                        parameters):
+    ''' Performs a joint PCA analysis of all bands on the valid pixels and
+    filters according to the distance from the principal subspace.
+
+    :param list candidate_data: A list (one per band) of valid candidate data
+    :param list reference_data: A list (one per band) of coincident valid
+        reference data
+    :param joint_pca_options parameters: Method specific parameters.
+        Currently:
+        threshold (float): The largest distance from the principal subspace
+            of a PIF pixel
+
+    :returns: A boolean list representing the pif pixels within valid_pixels
+    '''
+    covariance = JointCovariance(len(candidate_data))
+    covariance.update(candidate_data, reference_data)
+    joint_pca = covariance.fit()
+    return joint_pca_distance(
+        joint_pca, candidate_data, reference_data) <= parameters.threshold
@@ -20,18 +20,26 @@ from collections import namedtuple
 from radiometric_normalization import pca_filter
 from radiometric_normalization import robust
 from radiometric_normalization import filtering
+from radiometric_normalization import instrumentation
 
-from radiometric_normalization.utils import pixel_list_to_array
-from radiometric_normalization.utils import trim_pixel_list
 
-
-pca_options = namedtuple('pca_options', 'threshold')
+# deduplicate fits to the distinct (candidate, reference) pairs weighted by
+# their pixel counts, which is equivalent but quicker for integer data
+pca_options = namedtuple('pca_options', 'threshold, deduplicate')
+pca_options.__new__.__defaults__ = (False,)
 DEFAULT_PCA_OPTIONS = pca_options(threshold=30)
 
-robust_options = namedtuple('robust_options', 'threshold')
+robust_options = namedtuple('robust_options', 'threshold, deduplicate')
+robust_options.__new__.__defaults__ = (False,)
 DEFAULT_ROBUST_OPTIONS = robust_options(threshold=100)
 
+# The threshold is a distance in the joint space of all the bands, so it
+# grows with the band count
+joint_pca_options = namedtuple('joint_pca_options', 'threshold')
+DEFAULT_JOINT_PCA_OPTIONS = joint_pca_options(threshold=60)
+
 
+@instrumentation.instrumented
 def generate_mask_pifs(combined_mask):
     ''' Creates the pseudo-invariant features from the reference and candidate
     valid data masks (filtering out pixels where either the candidate or
@@ -46,24 +54,15 @@ def generate_mask_pifs(combined_mask):
     logging.info('PIF: Pseudo invariant feature generation is using: '
                  'Filtering using the valid data mask.')
 
-    # Only analyse valid pixels
-    valid_pixels = numpy.nonzero(combined_mask)
+    # Every valid pixel is a PIF
+    pif_mask = numpy.array(combined_mask, dtype=numpy.bool)
 
-    pif_mask = numpy.zeros(combined_mask.shape, dtype=numpy.bool)
-    pif_mask[valid_pixels] = True
-
-    if logging.getLogger().getEffectiveLevel() <= logging.INFO:
-        pif_pixels = numpy.nonzero(pif_mask)
-        no_pif_pixels = len(pif_pixels[0])
-        no_total_pixels = combined_mask.size
-        valid_percent = 100.0 * no_pif_pixels / no_total_pixels
-        logging.info(
-            'PIF: Found {} final PIFs out of {} pixels ({}%)'.format(
-                no_pif_pixels, no_total_pixels, valid_percent))
+    _info_logging(combined_mask.size, numpy.count_nonzero(pif_mask))
 
     return pif_mask
 
 
+@instrumentation.instrumented
 def generate_robust_pifs(candidate_band, reference_band, combined_mask,
                          parameters=DEFAULT_ROBUST_OPTIONS):
     ''' Performs a robust fit to the valid pixels and filters according
@@ -82,25 +81,14 @@ def generate_robust_pifs(candidate_band, reference_band, combined_mask,
 
     :returns: A 2D boolean array representing pseudo invariant features
     '''
-    valid_pixels = numpy.nonzero(combined_mask)
-
-    pif_pixels = generate_robust_pifs_from_pixel_list(
-        candidate_band[valid_pixels], reference_band[valid_pixels], parameters)
-
-    pif_mask = pixel_list_to_array(
-        trim_pixel_list(valid_pixels, pif_pixels), candidate_band.shape)
-
-    _info_logging(candidate_band.size, numpy.nonzero(pif_mask))
-
-    if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-        _debug_logging(candidate_band, reference_band,
-                       valid_pixels, numpy.nonzero(pif_mask))
-
-    return pif_mask
+    return _generate_single_band_pifs(
+        candidate_band, reference_band, combined_mask,
+        generate_robust_pifs_pixel_list, parameters)
 
 
+@instrumentation.instrumented
 def generate_robust_pifs_pixel_list(candidate_data, reference_data,
-                                         parameters=DEFAULT_ROBUST_OPTIONS):
+                                    parameters=DEFAULT_ROBUST_OPTIONS):
     ''' Performs a robust fit to the valid pixels and filters according
     to the distance from the fit line.
 
@@ -109,6 +97,7 @@ def generate_robust_pifs_pixel_list(candidate_data, reference_data,
     :param robust_options parameters: Method specific parameters. Currently:
         threshold (float): Representing the distance from the fit line
                            to look for PIF pixels
+        deduplicate (bool): Fit to the distinct value pairs
 
     :returns: A boolean list representing the pif pixels within valid_pixels
     '''
@@ -116,7 +105,8 @@ def generate_robust_pifs_pixel_list(candidate_data, reference_data,
                  'Filtering using a robust fit.')
 
     # Robust fit
-    gain, offset = robust.fit(candidate_data, reference_data)
+    gain, offset = robust.fit(candidate_data, reference_data,
+                              parameters.deduplicate)
 
     # Filter using the robust fit
     return filtering.filter_by_residuals_from_line_pixel_list(
@@ -124,6 +114,7 @@ def generate_robust_pifs_pixel_list(candidate_data, reference_data,
         threshold=parameters.threshold, line_gain=gain, line_offset=offset)
 
 
+@instrumentation.instrumented
 def generate_pca_pifs(candidate_band, reference_band, combined_mask,
                       parameters=DEFAULT_PCA_OPTIONS):
     ''' Performs PCA analysis on the valid pixels and filters according
@@ -141,25 +132,15 @@ def generate_pca_pifs(candidate_band, reference_band, combined_mask,
 
     :returns: A 2D boolean array representing pseudo invariant features
     '''
-    valid_pixels = numpy.nonzero(combined_mask)
-
-    pif_pixels = generate_pca_pifs_pixel_list(
-        candidate_band[valid_pixels], reference_band[valid_pixels], parameters)
-
-    pif_mask = pixel_list_to_array(
-        trim_pixel_list(valid_pixels, pif_pixels), candidate_band.shape)
-
-    _info_logging(candidate_band.size, numpy.nonzero(pif_mask))
-
-    if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-        _debug_logging(candidate_band, reference_band,
-                       valid_pixels, numpy.nonzero(pif_mask))
-
-    return pif_mask
+    return _generate_single_band_pifs(
+        candidate_band, reference_band, combined_mask,
+        generate_pca_pifs_pixel_list, parameters)
 
 
+@instrumentation.instrumented
 def generate_pca_pifs_pixel_list(candidate_data, reference_data,
-                                 parameters=DEFAULT_PCA_OPTIONS):
+                                 parameters=DEFAULT_PCA_OPTIONS,
+                                 joint_histogram=None):
     ''' Performs PCA analysis on the valid pixels and filters according
     to the distance from the principle eigenvector.
 
@@ -167,6 +148,10 @@ def generate_pca_pifs_pixel_list(candidate_data, reference_data,
     :param list reference_band: A list of coincident valid reference data
     :param pca_options parameters: Method specific parameters. Currently:
         threshold (float): Representing the width of the PCA filter
+        deduplicate (bool): Fit to the distinct value pairs
+    :param histogram.JointHistogram joint_histogram: [Optional] A joint
+        histogram of the valid data to fit the PCA to (see
+        histogram_wrapper.generate)
 
     :returns: A boolean list representing the pif pixels within valid_pixels
     '''
@@ -174,14 +159,153 @@ def generate_pca_pifs_pixel_list(candidate_data, reference_data,
                  'Filtering using PCA.')
 
     return pca_filter.pca_fit_and_filter_pixel_list(
+        candidate_data, reference_data, parameters, joint_histogram,
+        parameters.deduplicate)
+
+
+@instrumentation.instrumented
+def generate_joint_pca_pifs(candidate_bands, reference_bands, combined_mask,
+                            parameters=DEFAULT_JOINT_PCA_OPTIONS):
+    ''' Performs a PCA analysis of the joint (candidate bands, reference
+    bands) vector of each valid pixel and filters according to the distance
+    from the principal subspace. Unlike generate_pca_pifs, which is applied
+    band by band, a pixel is judged on all of its bands at once.
+
+    :param list candidate_bands: A list of 2D arrays representing the image
+                                 data of the candidate bands
+    :param list reference_bands: A list of 2D arrays representing the image
+                                 data of the reference bands
+    :param array combined_mask: A 2D array representing a mask of the valid
+                                pixels in both the candidate array and
+                                reference array
+    :param joint_pca_options parameters: Method specific parameters.
+        Currently:
+        threshold (float): The largest distance from the principal subspace
+                           of a PIF pixel
+
+    :returns: A 2D boolean array representing pseudo invariant features
+    '''
+    valid_indices = mask_to_pif_indices(combined_mask)
+    candidate_data = [numpy.take(band, valid_indices)
+                      for band in candidate_bands]
+    reference_data = [numpy.take(band, valid_indices)
+                      for band in reference_bands]
+    passed = generate_joint_pca_pifs_pixel_list(
+        candidate_data, reference_data, parameters)
+    pif_indices = valid_indices[passed]
+
+    _info_logging(combined_mask.size, len(pif_indices))
+
+    return pif_indices_to_mask(pif_indices, combined_mask.shape)
+
+
+@instrumentation.instrumented
+def generate_joint_pca_pifs_pixel_list(candidate_data, reference_data,
+                                       parameters=DEFAULT_JOINT_PCA_OPTIONS):
+    ''' Performs a PCA analysis of the joint (candidate bands, reference
+    bands) vector of each valid pixel and filters according to the distance
+    from the principal subspace.
+
+    :param list candidate_data: A list (one per band) of valid candidate data
+    :param list reference_data: A list (one per band) of coincident valid
+                                reference data
+    :param joint_pca_options parameters: Method specific parameters.
+        Currently:
+        threshold (float): The largest distance from the principal subspace
+                           of a PIF pixel
+
+    :returns: A boolean array representing the pif pixels within valid_pixels
+    '''
+    logging.info('PIF: Pseudo invariant feature generation is using: '
+                 'Filtering using a joint PCA of all bands.')
+
+    return pca_filter.joint_pca_fit_and_filter_pixel_list(
         candidate_data, reference_data, parameters)
 
 
-def _info_logging(no_total_pixels, pif_pixels):
+def mask_to_pif_indices(mask):
+    ''' Converts a 2D boolean mask to the flat indices of its True pixels.
+
+    Multi-band PIF generation works on these indices, filtering them band by
+    band, so each band only evaluates the pixels that passed the bands before
+    it. Images with fewer than 2 ** 32 pixels use uint32 indices to halve
+    their memory.
+
+    :param array mask: A 2D boolean array
+
+    :returns: A 1D array of indices into the flattened mask
+    '''
+    pif_indices = numpy.flatnonzero(mask)
+    if mask.size < 2 ** 32:
+        pif_indices = pif_indices.astype(numpy.uint32)
+    return pif_indices
+
+
+def pif_indices_to_mask(pif_indices, shape):
+    ''' Scatters flat pixel indices (see mask_to_pif_indices) to a 2D boolean
+    mask.
+
+    :param array pif_indices: A 1D array of flat indices
+    :param tuple shape: The (height, width) of the mask
+
+    :returns: A 2D boolean array that is True at pif_indices
+    '''
+    pif_mask = numpy.zeros(shape, dtype=numpy.bool)
+    pif_mask.flat[pif_indices] = True
+    return pif_mask
+
+
+@instrumentation.instrumented
+def filter_pif_indices(candidate_band, reference_band, pif_indices,
+                       pixel_list_filter, parameters):
+    ''' Filters a set of pixels using one band, keeping the pixels that pass
+    a pixel list PIF filter (e.g. generate_pca_pifs_pixel_list).
+
+    Only the pixels in pif_indices are gathered from the bands, so in a
+    multi-band loop each band only evaluates the pixels that survived the
+    previous bands.
+
+    :param array candidate_band: A 2D array representing the image data of the
+                                 candidate band
+    :param array reference_band: A 2D array representing the image data of the
+                                 reference band
+    :param array pif_indices: Flat indices of the pixels to evaluate (see
+                              mask_to_pif_indices)
+    :param function pixel_list_filter: A function of (candidate_data,
+        reference_data, parameters) returning a boolean list of the pixels
+        that pass
+    :param parameters: Passed through to pixel_list_filter
+
+    :returns: The subset of pif_indices that passed the filter
+    '''
+    candidate_data = numpy.take(candidate_band, pif_indices)
+    reference_data = numpy.take(reference_band, pif_indices)
+    passed = pixel_list_filter(candidate_data, reference_data, parameters)
+    return pif_indices[numpy.asarray(passed, dtype=numpy.bool)]
+
+
+def _generate_single_band_pifs(candidate_band, reference_band, combined_mask,
+                               pixel_list_filter, parameters):
+    valid_indices = mask_to_pif_indices(combined_mask)
+    pif_indices = filter_pif_indices(
+        candidate_band, reference_band, valid_indices, pixel_list_filter,
+        parameters)
+
+    _info_logging(candidate_band.size, len(pif_indices))
+
+    if instrumentation.diagnostics_enabled():
+        _debug_logging(candidate_band, reference_band,
+                       valid_indices, pif_indices)
+
+    return pif_indices_to_mask(pif_indices, candidate_band.shape)
+
+
+def _info_logging(no_total_pixels, no_pif_pixels):
     ''' Optional logging information
     '''
-    if pif_pixels[0] != [] and pif_pixels[1] != []:
-        no_pif_pixels = len(pif_pixels[0])
+    instrumentation.increment('pif.pixels', no_total_pixels)
+    instrumentation.increment('pif.pif_pixels', no_pif_pixels)
+    if no_pif_pixels:
         valid_percent = 100.0 * no_pif_pixels / no_total_pixels
         logging.info(
             'PIF: Found {} final PIFs out of {} pixels ({}%)'.format(
@@ -190,12 +314,16 @@ def _info_logging(no_total_pixels, pif_pixels):
         logging.info('PIF: No PIF pixels found.')
 
 
-def _debug_logging(c_band, r_band, valid_pixels, pif_pixels):
-    ''' Optional logging information
+def _debug_logging(c_band, r_band, valid_indices, pif_indices):
+    ''' Optional diagnostic information. This is expensive (it computes
+    correlation coefficients over all the valid pixels) so it is only run when
+    instrumentation.set_diagnostics(True) has been called.
     '''
     logging.debug('PIF: Original corrcoef = {}'.format(
-        numpy.corrcoef(c_band[valid_pixels], r_band[valid_pixels])[0, 1]))
+        numpy.corrcoef(numpy.take(c_band, valid_indices),
+                       numpy.take(r_band, valid_indices))[0, 1]))
 
-    if pif_pixels[0] != [] and pif_pixels[1] != []:
+    if len(pif_indices):
         logging.debug('PIF: Filtered corrcoef = {}'.format(
-            numpy.corrcoef(c_band[pif_pixels], r_band[pif_pixels])[0, 1]))
+            numpy.corrcoef(numpy.take(c_band, pif_indices),
+                           numpy.take(r_band, pif_indices))[0, 1]))
@@ -0,0 +1,112 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import logging
+import resource
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+
+# Wall time is in seconds and peak_rss is in megabytes
+StageTiming = namedtuple('StageTiming', 'stage, wall_time, peak_rss')
+
+
+def reset_peak_rss():
+    ''' Resets the peak resident set size of the current process to its
+    current resident set size, so peak_rss measures from now on.
+
+    This is only possible on Linux (by writing 5 to /proc/self/clear_refs).
+
+    :returns: True if the peak was reset, False if it could not be
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss():
+    ''' Returns the peak resident set size of the current process.
+
+    On Linux this is VmHWM, which reset_peak_rss resets. Elsewhere the peak is
+    a high water mark for the whole process.
+
+    :returns: The peak resident set size in megabytes (float)
+    '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on OS X and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+@contextmanager
+def timed_stage(stage, timings):
+    ''' Context manager that times a block of code and appends a StageTiming
+    to timings when the block exits.
+
+    The peak RSS is the stage's own peak where reset_peak_rss can reset it
+    (Linux). Elsewhere it is the peak so far, so a stage after a heavier one
+    repeats the heavier one's peak, and the log says so.
+
+    :param str stage: The name of the stage
+    :param list timings: A list that the StageTiming is appended to
+    '''
+    per_stage = reset_peak_rss()
+    start = time.time()
+    try:
+        yield
+    finally:
+        timing = StageTiming(stage, time.time() - start, peak_rss())
+        logging.info(
+            'Profiling: {} took {:.3f}s (peak RSS {}{:.1f} MB)'.format(
+                timing.stage, timing.wall_time,
+                '' if per_stage else 'so far ', timing.peak_rss))
+        timings.append(timing)
+
+
+def format_timings(timings, title=None):
+    ''' Formats a list of StageTimings as a plain text table with a total row.
+
+    :param list timings: A list of StageTimings
+    :param str title: [Optional] A line to print above the table
+
+    :returns: The table as a string
+    '''
+    row_format = '{:<16} {:>14} {:>14}'
+    lines = []
+    if title:
+        lines.append(title)
+    lines.append(row_format.format('stage', 'wall time (s)', 'peak RSS (MB)'))
+    for timing in timings:
+        lines.append(row_format.format(
+            timing.stage, '{:.3f}'.format(timing.wall_time),
+            '{:.1f}'.format(timing.peak_rss)))
+    if timings:
+        lines.append(row_format.format(
+            'total', '{:.3f}'.format(sum(t.wall_time for t in timings)),
+            '{:.1f}'.format(max(t.peak_rss for t in timings))))
+    return '\n'.join(lines)
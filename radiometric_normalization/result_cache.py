@@ -0,0 +1,247 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+from radiometric_normalization import instrumentation
+from radiometric_normalization.transformation import LinearTransformation
+
+
+'''
+An on-disk cache of PIF masks and transformations, so a rerun of a pair whose
+images and options have not changed skips PIF generation and the fit.
+
+Entries are addressed by a hash of what they were computed from: the identity
+of each input file (its path, size and modification time, or optionally a
+checksum of its contents), the method and its options. A changed input gives
+a new address, so stale entries are never served; they are evicted, least
+recently used first, once the cache is larger than its size limit.
+
+Masks are stored bit packed and compressed (about a 64th of a boolean
+array's size for typical masks) and transformations as JSON.
+'''
+
+# Changing the format of the entries (or what they depend on) must change
+# this so old entries are not read
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+class ResultCache(object):
+    ''' A size bounded, content addressed cache of PIF masks and
+    transformations in a directory (which may be shared between processes).
+    '''
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES,
+                 checksum=False):
+        '''
+        :param str cache_dir: The directory to keep the entries in
+        :param int max_bytes: The size the entries are evicted down to
+        :param bool checksum: Identify input files by a checksum of their
+            contents instead of by their size and modification time (slower,
+            but survives files being copied or touched)
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        self._lock = threading.Lock()
+        self._checksums = {}
+
+    def __getstate__(self):
+        # Sent to worker processes without the lock or the checksums
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['_checksums'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, kind, paths, **parameters):
+        ''' Addresses a result computed from a set of files.
+
+        :param str kind: The kind of result (e.g. 'pif_mask')
+        :param list paths: The input files
+        :param parameters: Everything else the result depends on (numbers,
+            strings, None, tuples or namedtuples of them, or boolean arrays)
+
+        :returns: A hex digest
+        '''
+        identity = {
+            'kind': kind,
+            'version': CACHE_VERSION,
+            'files': [self._file_identity(path) for path in paths],
+            'parameters': dict((name, _jsonable(value))
+                               for name, value in parameters.items())}
+        return hashlib.sha1(json.dumps(
+            identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_mask(self, key):
+        ''' :returns: The cached boolean mask or None '''
+        path = self._entry_path(key, '.npz')
+        if not self._hit(path):
+            return None
+        with numpy.load(path) as entry:
+            shape = tuple(entry['shape'])
+            mask = numpy.unpackbits(entry['packed'])[:int(numpy.prod(shape))]
+        return mask.reshape(shape).astype(bool)
+
+    def put_mask(self, key, mask):
+        ''' Caches a boolean mask. '''
+        mask = numpy.asarray(mask, dtype=bool)
+        self._write(self._entry_path(key, '.npz'), lambda entry_file:
+                    numpy.savez_compressed(
+                        entry_file, packed=numpy.packbits(mask),
+                        shape=numpy.array(mask.shape)))
+
+    def get_transformations(self, key):
+        ''' :returns: The cached list of LinearTransformations or None '''
+        path = self._entry_path(key, '.json')
+        if not self._hit(path):
+            return None
+        with open(path) as entry_file:
+            return [LinearTransformation(gain, offset)
+                    for gain, offset in json.load(entry_file)]
+
+    def put_transformations(self, key, transformations):
+        ''' Caches a list of LinearTransformations. '''
+        values = [[_float(t.gain), _float(t.offset)] for t in transformations]
+        self._write(self._entry_path(key, '.json'), lambda entry_file:
+                    entry_file.write(json.dumps(values).encode('utf-8')))
+
+    def size(self):
+        ''' :returns: The total size of the entries in bytes '''
+        return sum(entry_size for _, _, entry_size in self._entries())
+
+    def clear(self):
+        ''' Removes every entry. '''
+        for path, _, _ in self._entries():
+            _remove(path)
+
+    def _hit(self, path):
+        if not os.path.exists(path):
+            instrumentation.increment('result_cache.misses')
+            return False
+        instrumentation.increment('result_cache.hits')
+        # The access time is not updated on every filesystem, so a hit
+        # refreshes the modification time that eviction goes by
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return True
+
+    def _write(self, path, write):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another process
+                pass
+        temporary_path = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.current_thread().ident)
+        with open(temporary_path, 'wb') as entry_file:
+            write(entry_file)
+        os.rename(temporary_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            total = sum(entry_size for _, _, entry_size in entries)
+            for path, _, entry_size in entries:
+                if total <= self.max_bytes:
+                    break
+                _remove(path)
+                total -= entry_size
+                instrumentation.increment('result_cache.evictions')
+
+    def _entries(self):
+        # (path, modification time, size) of each entry
+        entries = []
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(('.npz', '.json')):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _entry_path(self, key, extension):
+        # A level of subdirectories keeps directory listings short
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def _file_identity(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if not self.checksum:
+            return [path, stat.st_size, stat.st_mtime]
+        stat_key = (path, stat.st_size, stat.st_mtime)
+        if stat_key not in self._checksums:
+            logging.debug('ResultCache: Checksumming {}'.format(path))
+            self._checksums[stat_key] = _file_checksum(path)
+        return [stat.st_size, self._checksums[stat_key]]
+
+
+def mask_digest(mask):
+    ''' :returns: A hex digest of a boolean mask (to key results fitted to
+        it) '''
+    mask = numpy.asarray(mask, dtype=bool)
+    digest = hashlib.sha1(numpy.packbits(mask).tobytes())
+    digest.update(str(mask.shape).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _jsonable(value):
+    if isinstance(value, numpy.ndarray):
+        return mask_digest(value)
+    if hasattr(value, '_asdict'):
+        return dict((name, _jsonable(item))
+                    for name, item in value._asdict().items())
+    if isinstance(value, (tuple, list)):
+        return [_jsonable(item) for item in value]
+    return value
+
+
+def _float(value):
+    # Some fits give their gain and offset as one element arrays
+    return numpy.asarray(value, dtype=numpy.float64).item()
+
+
+def _file_checksum(path, block_size=1024 ** 2):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
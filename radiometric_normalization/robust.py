@@ -18,8 +18,10 @@ import numpy
 
 from sklearn import linear_model
 
+from radiometric_normalization import histogram
 
-def fit(candidate_data, reference_data):
+
+def fit(candidate_data, reference_data, deduplicate=False):
     ''' Tries a variety of robust fitting methods in what is considered
     descending order of how good the fits are with this type of data set
     (found empirically).
@@ -28,40 +30,59 @@ def fit(candidate_data, reference_data):
                                 data of the candidate band
     :param list reference_data: A 1D list or array representing only the image
                                 data of the reference band
+    :param bool deduplicate: Fit to the distinct (candidate, reference) pairs
+                             weighted by how many pixels have them, which is
+                             equivalent but much quicker when there are many
+                             more pixels than distinct pairs
 
     :returns: A gain and an offset (tuple of floats)
     '''
+    if deduplicate:
+        candidate_data, reference_data, counts = histogram.unique_pairs(
+            candidate_data, reference_data)
+        logging.debug('Robust: Fitting to {} distinct pairs'.format(
+            len(counts)))
+    else:
+        counts = None
+
     try:
         logging.debug('Robust: Trying HuberRegressor with epsilon 1.01')
         gain, offset = _huber_regressor(
-            candidate_data, reference_data, 1.01)
+            candidate_data, reference_data, 1.01, sample_weight=counts)
     except:
         try:
             logging.debug('Robust: Trying HuberRegressor with epsilon 1.05')
             gain, offset = _huber_regressor(
-                candidate_data, reference_data, 1.05)
+                candidate_data, reference_data, 1.05, sample_weight=counts)
         except:
             try:
                 logging.debug('Robust: Trying HuberRegressor with epsilon 1.1')
                 gain, offset = _huber_regressor(
-                    candidate_data, reference_data, 1.1)
+                    candidate_data, reference_data, 1.1, sample_weight=counts)
             except:
                 try:
                     logging.debug('Robust: Trying HuberRegressor with epsilon '
                                  '1.35')
                     gain, offset = _huber_regressor(
-                        candidate_data, reference_data, 1.35)
+                        candidate_data, reference_data, 1.35,
+                        sample_weight=counts)
                 except:
                     logging.debug('Robust: Trying RANSAC')
+                    if counts is not None:
+                        # RANSAC samples pixels at random, so a weighted
+                        # fit to the pairs would not be equivalent
+                        candidate_data = numpy.repeat(candidate_data, counts)
+                        reference_data = numpy.repeat(reference_data, counts)
                     gain, offset = _ransac_regressor(
                         candidate_data, reference_data)
     return gain, offset
 
 
-def _huber_regressor(candidate_data, reference_data, epsilon, max_iter=10000):
+def _huber_regressor(candidate_data, reference_data, epsilon, max_iter=10000,
+                     sample_weight=None):
     model = linear_model.HuberRegressor(epsilon=epsilon, max_iter=max_iter)
     model.fit(numpy.array([[c] for c in candidate_data]),
-              numpy.array(reference_data))
+              numpy.array(reference_data), sample_weight=sample_weight)
     gain = model.coef_
     offset = model.intercept_
 
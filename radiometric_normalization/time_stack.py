@@ -17,11 +17,14 @@ import numpy
 import logging
 
 from radiometric_normalization import gimage
+from radiometric_normalization import instrumentation
+from radiometric_normalization import kernels
 
 
+@instrumentation.instrumented
 def generate(image_paths, output_path,
              method='mean_with_uniform_weight',
-             image_nodata=None):
+             image_nodata=None, window=None, bbox=None):
     '''Synthesizes a time stack image set into a single reference image.
 
     All images in time stack must:
@@ -40,14 +43,22 @@ def generate(image_paths, output_path,
         image_paths (list of str): A list of paths for input time stack images
         output_path (str): A path to write the file to
         method (str): Time stack analysis method [Identity]
-        image_nodata (int): [Optional] Manually provide a no data value
+        image_nodata (int): [Optional] Manually provide a no data value (for
+            every image). A pixel with this value in any band of an image is
+            left out of the mean for that image. Before this was only done
+            for the first image, so means of stacks whose other images have
+            the value change.
+        window (tuple): [Optional] An (xoff, yoff, xsize, ysize) pixel window
+            to process instead of the whole images
+        bbox (tuple): [Optional] A (min_x, min_y, max_x, max_y) bounding box
+            in the images' coordinate system to process (instead of window)
     '''
 
     output_datatype = numpy.uint16
 
     if method == 'mean_with_uniform_weight':
         output_gimage = mean_with_uniform_weight(
-            image_paths, output_datatype, image_nodata)
+            image_paths, output_datatype, image_nodata, window, bbox)
     else:
         raise NotImplementedError("Only 'mean_with_uniform_weight'"
                                   "method is implemented")
@@ -55,58 +66,6 @@ def generate(image_paths, output_path,
     gimage.save(output_gimage, output_path, compress=False)
 
 
-def _sum_masked_array_list(sum_masked_arrays,
-                           frequency_arrays,
-                           new_masked_arrays):
-    ''' Calculates the sum of two lists of masked arrays
-
-    Input:
-        sum_masked_arrays (list of masked arrays): A list of masked
-            arrays (one for each band)
-        frequency_arrays (list of arrays of ints): Keeping track of
-            how many times each pixel is summed (one for each band)
-        new_masked_arrays (list of masked arrays): A list of masked
-            arrays (one for each band)
-    Output:
-        sum_masked_array (masked array): A list of masked
-            arrays (one for each band)
-    '''
-    no_bands = len(sum_masked_arrays)
-    for band_index in xrange(no_bands):
-        sum_masked_arrays[band_index] = \
-            numpy.ma.sum([sum_masked_arrays[band_index],
-                          new_masked_arrays[band_index]],
-                         axis=0)
-        frequency_arrays[band_index] = frequency_arrays[band_index] + \
-            numpy.logical_not(new_masked_arrays[band_index].mask).astype('int')
-
-    return sum_masked_arrays, frequency_arrays
-
-
-def _masked_arrays_from_gimg(input_gimg, working_datatype):
-    '''A gimage as input and outputs a masked array of output_datatype.
-
-    Input:
-        input_gimg (a gimage): A gimage to convert
-        working_datatype (numpy datatype): The datatype in use for
-            the calculations
-
-    Output:
-        all_bands (list of numpy arrays): A list of each band of the gimage
-            as a masked array
-    '''
-    no_bands = len(input_gimg.bands)
-    all_bands_masked_array_list = []
-    for band_index in xrange(no_bands):
-        one_band_masked_array = \
-            numpy.ma.masked_array(
-                input_gimg.bands[band_index].astype(working_datatype),
-                input_gimg.alpha == 0)
-        all_bands_masked_array_list.append(one_band_masked_array)
-
-    return all_bands_masked_array_list
-
-
 def _uniform_weight_alpha(sum_masked_arrays, output_datatype):
     '''Calculates the cumulative mask of a list of masked array
 
@@ -165,7 +124,9 @@ def _mean_from_sum(sum_masked_arrays,
     return output_mean
 
 
-def mean_with_uniform_weight(image_paths, output_datatype, image_nodata):
+@instrumentation.instrumented
+def mean_with_uniform_weight(image_paths, output_datatype, image_nodata,
+                             window=None, bbox=None):
     ''' Calculates the reference image as the mean of each band with uniform
     weighting (zero for nodata pixels, 2 ** 16 - 1 for valid pixels)
 
@@ -180,6 +141,12 @@ def mean_with_uniform_weight(image_paths, output_datatype, image_nodata):
     Input:
         image_paths (list of strings): A list of image paths for each image
         output_datatype (numpy datatype): Data type for the output image
+        image_nodata (int): [Optional] Pixels with this value in any band of
+            an image are not averaged (in every image)
+        window (tuple): [Optional] An (xoff, yoff, xsize, ysize) pixel window
+            of the images to average
+        bbox (tuple): [Optional] A (min_x, min_y, max_x, max_y) bounding box
+            of the images to average (instead of window)
 
     Output:
         output_gimage (gimage): The mean for each band and the weighting in a
@@ -190,24 +157,36 @@ def mean_with_uniform_weight(image_paths, output_datatype, image_nodata):
 
     working_datatype = numpy.double
     no_images = len(image_paths)
-    first_gimg = gimage.load(image_paths[0], image_nodata)
-
-    sum_masked_arrays = _masked_arrays_from_gimg(first_gimg,
-                                                 working_datatype)
-
-    no_bands = len(sum_masked_arrays)
-    frequency_arrays = \
-        [numpy.logical_not(sum_masked_arrays[band_index].mask).astype('int')
-         for band_index in xrange(no_bands)]
-
-    for image_index in xrange(1, no_images):
-        new_gimg = gimage.load(image_paths[image_index])
-        gimage.check_comparable([first_gimg, new_gimg], check_metadata=True)
-
-        new_masked_arrays = _masked_arrays_from_gimg(new_gimg,
-                                                     working_datatype)
-        sum_masked_arrays, frequency_arrays = _sum_masked_array_list(
-            sum_masked_arrays, frequency_arrays, new_masked_arrays)
+    instrumentation.increment('time_stack.images', no_images)
+    first_gimg = gimage.load(image_paths[0], image_nodata, window=window,
+                             bbox=bbox)
+
+    # Each image's valid pixels are added to the sums and counted in one
+    # pass per band (see kernels.accumulate_masked)
+    sums = [numpy.zeros(band.shape, dtype=working_datatype)
+            for band in first_gimg.bands]
+    frequency_arrays = [numpy.zeros(band.shape, dtype=numpy.uint32)
+                        for band in first_gimg.bands]
+
+    for image_index in xrange(no_images):
+        if image_index == 0:
+            new_gimg = first_gimg
+        else:
+            new_gimg = gimage.load(image_paths[image_index], image_nodata,
+                                   window=window, bbox=bbox)
+            gimage.check_comparable([first_gimg, new_gimg],
+                                    check_metadata=True)
+
+        valid = new_gimg.alpha != 0
+        for band_sum, frequency_array, band in zip(
+                sums, frequency_arrays, new_gimg.bands):
+            kernels.accumulate_masked(band_sum, frequency_array, band, valid)
+        del new_gimg
+
+    # Pixels that are not valid in any image stay masked
+    sum_masked_arrays = [
+        numpy.ma.masked_array(band_sum, frequency_array == 0)
+        for band_sum, frequency_array in zip(sums, frequency_arrays)]
 
     output_alpha = _uniform_weight_alpha(sum_masked_arrays, output_datatype)
     output_bands = _mean_from_sum(sum_masked_arrays, frequency_arrays,
@@ -217,3 +196,89 @@ def mean_with_uniform_weight(image_paths, output_datatype, image_nodata):
                                   first_gimg.metadata)
 
     return output_gimage
+
+
+def mean_with_uniform_weight_blocks(image_paths, output_datatype=numpy.uint16,
+                                    image_nodata=None, window=None,
+                                    block_rows=256):
+    ''' Calculates the same mean as mean_with_uniform_weight (image_nodata
+    included) a strip of rows at a time, so the reference can be used (or
+    written) as it is made without holding the time stack's sums in memory.
+
+    Every image is kept open and one strip of each is read in turn.
+
+    Input:
+        image_paths (list of strings): A list of image paths for each image
+        output_datatype (numpy datatype): Data type for the output bands
+        image_nodata (int): [Optional] Pixels with this value in any band of
+            an image are not averaged (in every image)
+        window (Window): [Optional] The pixel window of the images to average
+        block_rows (int): The number of rows in each strip
+
+    Output:
+        A generator of (yoff, bands, alpha) tuples for each strip, where yoff
+        is the row of the window the strip starts at, bands is a list of the
+        mean of each band and alpha is 0 for a no data pixel and the
+        maximum of output_datatype otherwise
+    '''
+    logging.info('Time stack analysis is using: Mean with uniform weight, '
+                 'a strip at a time.')
+
+    instrumentation.increment('time_stack.images', len(image_paths))
+    dataset_cache = gimage.DatasetCache(max_entries=len(image_paths))
+    datasets = [dataset_cache.dataset(path) for path in image_paths]
+    first_ds = datasets[0]
+    band_count = gimage.image_band_count(first_ds)
+    first_metadata = gimage.read_metadata(first_ds)
+    for path, gdal_ds in zip(image_paths[1:], datasets[1:]):
+        if (gdal_ds.RasterXSize, gdal_ds.RasterYSize) != \
+                (first_ds.RasterXSize, first_ds.RasterYSize) or \
+                gimage.image_band_count(gdal_ds) != band_count or \
+                gimage.read_metadata(gdal_ds) != first_metadata:
+            raise Exception('{} is not comparable to {}'.format(
+                path, image_paths[0]))
+
+    if window is None:
+        window = gimage.Window(0, 0, first_ds.RasterXSize,
+                               first_ds.RasterYSize)
+    alpha_value = numpy.iinfo(output_datatype).max
+    for yoff, rows in gimage.iter_row_blocks(window.ysize, block_rows):
+        # Timed a strip at a time, as the generator is suspended (while the
+        # caller uses each strip) between strips
+        with instrumentation.timer(
+                'time_stack.mean_with_uniform_weight_blocks'):
+            output_bands, output_alpha = _strip_mean(
+                datasets, band_count, image_nodata, output_datatype,
+                alpha_value, gimage.Window(window.xoff, window.yoff + yoff,
+                                           window.xsize, rows))
+        yield yoff, output_bands, output_alpha
+
+
+def _strip_mean(datasets, band_count, image_nodata, output_datatype,
+                alpha_value, strip):
+    # The mean of each band and the alpha of one strip of the time stack
+    sums = [numpy.zeros((strip.ysize, strip.xsize), dtype=numpy.double)
+            for _ in range(band_count)]
+    frequency_arrays = [numpy.zeros((strip.ysize, strip.xsize),
+                                    dtype=numpy.uint32)
+                        for _ in range(band_count)]
+    for gdal_ds in datasets:
+        valid, _ = gimage.read_alpha_and_band_count(gdal_ds, window=strip)
+        bands = [gimage.read_single_band(gdal_ds, band_no, strip)
+                 for band_no in range(1, band_count + 1)]
+        if image_nodata is not None:
+            for band in bands:
+                valid &= band != image_nodata
+        for band_sum, frequency_array, band in zip(
+                sums, frequency_arrays, bands):
+            kernels.accumulate_masked(band_sum, frequency_array, band, valid)
+
+    # Every band has the same counts
+    has_data = frequency_arrays[0] != 0
+    output_bands = []
+    for band_sum, frequency_array in zip(sums, frequency_arrays):
+        numpy.maximum(frequency_array, 1, out=frequency_array)
+        output_bands.append(
+            (band_sum / frequency_array).astype(output_datatype))
+    output_alpha = has_data.astype(output_datatype) * alpha_value
+    return output_bands, output_alpha
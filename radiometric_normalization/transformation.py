@@ -16,15 +16,30 @@ limitations under the License.
 import numpy
 import logging
 from collections import namedtuple
+from scipy.ndimage import uniform_filter
 from scipy.stats import linregress
 
+from radiometric_normalization import histogram
 from radiometric_normalization import robust
+from radiometric_normalization import instrumentation
 
 
 # Gain and offset are floats
 LinearTransformation = namedtuple('LinearTransformation', 'gain, offset')
 
+# Lut is an array with an output value for every value of an integer data
+# type of 16 bits or fewer, starting at its minimum (see
+# normalize.apply_using_lut)
+LutTransformation = namedtuple('LutTransformation', 'lut')
 
+# Gain and offset are 2D arrays of the values at the centres of a grid of
+# cells cell_size pixels square (the cells on the right and bottom edges can
+# be smaller), interpolated between the centres (see normalize.apply_gridded)
+GriddedTransformation = namedtuple('GriddedTransformation',
+                                   'gain, offset, cell_size')
+
+
+@instrumentation.instrumented
 def generate_linear_relationship(candidate_band, reference_band, pif_mask):
     ''' Performs PCA analysis on the valid pixels and filters according
     to the distance from the principle eigenvector.
@@ -44,6 +59,7 @@ def generate_linear_relationship(candidate_band, reference_band, pif_mask):
         candidate_pifs, reference_pifs)
 
 
+@instrumentation.instrumented
 def generate_linear_relationship_pixel_list(candidate_pifs, reference_pifs):
     ''' Performs PCA analysis on the valid pixels and filters according
     to the distance from the principle eigenvector.
@@ -64,6 +80,153 @@ def generate_linear_relationship_pixel_list(candidate_pifs, reference_pifs):
     r_std = numpy.std(reference_pifs)
     logging.debug('Stddev: candidate - {}, reference {}'.format(c_std, r_std))
 
+    return linear_relationship_from_moments(c_mean, r_mean, c_std, r_std)
+
+
+@instrumentation.instrumented
+def generate_linear_relationship_histogram(joint_histogram):
+    ''' Calculates the linear relationship transformation from the moments
+    of a joint histogram of the PIF pixels, without touching the pixels.
+
+    :param histogram.JointHistogram joint_histogram: A joint histogram of the
+        candidate and reference PIF data
+
+    :returns: A LinearTransformation object (gain and offset)
+    '''
+    logging.info('Transformation: Calculating linear relationship '
+                 'transformations from a joint histogram')
+
+    c_mean, r_mean = joint_histogram.mean()
+    logging.debug('Means: candidate - {}, reference {}'.format(c_mean, r_mean))
+
+    c_std, r_std = joint_histogram.std()
+    logging.debug('Stddev: candidate - {}, reference {}'.format(c_std, r_std))
+
+    return linear_relationship_from_moments(c_mean, r_mean, c_std, r_std)
+
+
+class CellMoments(object):
+    ''' The sums of the candidate and reference PIF values (and of their
+    squares) in each cell of a grid over a band, from which a linear
+    relationship is fitted per cell.
+
+    Blocks of the band are added with update, so the statistics are gathered
+    in one pass over the images without holding them in memory.
+    '''
+    def __init__(self, shape, cell_size):
+        '''
+        :param tuple shape: The (rows, columns) of the band
+        :param int cell_size: The width and height of the cells in pixels
+        '''
+        self.cell_size = cell_size
+        self.grid_shape = tuple(-(-size // cell_size) for size in shape)
+        # The count, candidate sum, reference sum, candidate sum of squares
+        # and reference sum of squares of each cell
+        self._sums = numpy.zeros((5,) + self.grid_shape)
+
+    def update(self, candidate_block, reference_block, pif_mask_block,
+               yoff=0, xoff=0):
+        ''' Adds the PIFs of a block of the band.
+
+        :param array candidate_block: A 2D array of candidate data
+        :param array reference_block: A 2D array of coincident reference data
+        :param array pif_mask_block: A 2D array of the PIF pixels in the block
+        :param int yoff: The row of the band the block starts at
+        :param int xoff: The column of the band the block starts at
+        '''
+        rows, columns = numpy.nonzero(pif_mask_block)
+        cells = ((rows + yoff) // self.cell_size) * self.grid_shape[1] + \
+            (columns + xoff) // self.cell_size
+        candidate_pifs = candidate_block[rows, columns].astype(numpy.float64)
+        reference_pifs = reference_block[rows, columns].astype(numpy.float64)
+
+        cell_count = self._sums[0].size
+        for sums, weights in zip(self._sums, (
+                None, candidate_pifs, reference_pifs,
+                candidate_pifs * candidate_pifs,
+                reference_pifs * reference_pifs)):
+            sums += numpy.bincount(cells, weights, cell_count).reshape(
+                self.grid_shape)
+
+    def merge(self, other):
+        ''' Adds the PIFs of another CellMoments over the same grid. '''
+        if other.grid_shape != self.grid_shape or \
+                other.cell_size != self.cell_size:
+            raise Exception('Cannot merge cell moments of different grids')
+        self._sums += other._sums
+
+    @property
+    def counts(self):
+        ''' The number of PIFs in each cell '''
+        return self._sums[0]
+
+
+@instrumentation.instrumented
+def generate_gridded_linear_relationship(cell_moments, smoothing=1,
+                                         min_pifs=100):
+    ''' Calculates a linear relationship for each cell of a grid from the
+    moments of its PIFs.
+
+    Each cell is fitted to the PIFs of the cells within smoothing cells of it
+    (a box filter over the sums), so the transformation varies smoothly and
+    sparse cells borrow PIFs from their neighbours. Cells with fewer than
+    min_pifs PIFs even so (or with none) get the relationship of the whole
+    band.
+
+    :param CellMoments cell_moments: The PIF moments of each cell of a band
+    :param int smoothing: How many cells either side of a cell to fit it to
+        (0 to fit each cell to its own PIFs)
+    :param int min_pifs: The fewest PIFs a cell is fitted to (a cell is
+        never fitted to no PIFs, even if this is 0)
+
+    :returns: A GriddedTransformation object (gain and offset per cell)
+    '''
+    logging.info('Transformation: Calculating linear relationship '
+                 'transformations on a {}x{} grid'.format(
+                     *cell_moments.grid_shape))
+
+    if smoothing:
+        # uniform_filter gives the mean over each neighbourhood, so scaling
+        # by the neighbourhood's size gives its sums
+        size = 2 * smoothing + 1
+        sums = size ** 2 * numpy.array([
+            uniform_filter(plane, size, mode='constant')
+            for plane in cell_moments._sums])
+        # The counts are whole numbers, less the filter's rounding error
+        sums[0] = numpy.round(sums[0])
+    else:
+        sums = cell_moments._sums.copy()
+    band_sums = cell_moments._sums.sum(axis=(1, 2))
+    if band_sums[0] == 0:
+        raise Exception('There are no PIFs to fit to')
+    sparse = sums[0] < max(min_pifs, 1)
+    sums[:, sparse] = band_sums[:, numpy.newaxis]
+    logging.debug('Transformation: {} of {} cells have too few PIFs'.format(
+        sparse.sum(), sparse.size))
+
+    count, c_sum, r_sum, c_square_sum, r_square_sum = sums
+    c_mean = c_sum / count
+    r_mean = r_sum / count
+    c_std = numpy.sqrt(numpy.maximum(c_square_sum / count - c_mean ** 2, 0))
+    r_std = numpy.sqrt(numpy.maximum(r_square_sum / count - r_mean ** 2, 0))
+
+    # As linear_relationship_from_moments, constant cells get a gain of 1
+    gain = numpy.ones(count.shape)
+    numpy.divide(r_std, c_std, out=gain, where=c_std > 0)
+    offset = r_mean - gain * c_mean
+
+    logging.info('Transformation: gain {} to {}, offset {} to {}'.format(
+        gain.min(), gain.max(), offset.min(), offset.max()))
+
+    return GriddedTransformation(gain, offset, cell_moments.cell_size)
+
+
+def linear_relationship_from_moments(c_mean, r_mean, c_std, r_std):
+    ''' Calculates the linear relationship from the means and standard
+    deviations of the candidate and reference PIFs.
+
+    :returns: A LinearTransformation object (gain and offset)
+    '''
     def calculate_gain(c_std, r_std):
         # if c_std is zero it is a constant image so default gain to 1
         if c_std == 0:
@@ -78,7 +241,92 @@ def generate_linear_relationship_pixel_list(candidate_pifs, reference_pifs):
     return LinearTransformation(gain, offset)
 
 
-def generate_ols_regression(candidate_band, reference_band, pif_mask):
+@instrumentation.instrumented
+def generate_histogram_matching(candidate_band, reference_band, pif_mask):
+    ''' Calculates a look up table that matches the histogram of the
+    candidate PIFs to the histogram of the reference PIFs.
+
+    :param array candidate_band: A 2D array representing the image data of the
+                                 candidate band
+    :param array reference_band: A 2D array representing the image data of the
+                                  reference image
+    :param array pif_mask: A 2D array representing the PIF pixels in the images
+
+    :returns: A LutTransformation object (with a look up table of the
+        candidate band's data type)
+    '''
+    candidate_pifs = candidate_band[numpy.nonzero(pif_mask)]
+    reference_pifs = reference_band[numpy.nonzero(pif_mask)]
+
+    return generate_histogram_matching_pixel_list(
+        candidate_pifs, reference_pifs)
+
+
+@instrumentation.instrumented
+def generate_histogram_matching_pixel_list(candidate_pifs, reference_pifs):
+    ''' Calculates a look up table that maps each candidate value to the
+    reference value at the same point of the cumulative distribution, so the
+    transformed candidate PIFs have the histogram of the reference PIFs.
+
+    The distributions are counted with numpy.bincount over every value of
+    the data type, so the cost is linear in the number of PIFs (plus the
+    number of values) rather than that of sorting them.
+
+    :param list candidate_pifs: A list of candidate PIF data (integers of 16
+        bits or fewer)
+    :param list reference_pifs: A list of coincident reference PIF data
+        (values outside the range of the candidate data's type are clipped
+        to it)
+
+    :returns: A LutTransformation object (with a look up table of the
+        candidate data's type)
+    '''
+    logging.info('Transformation: Calculating histogram matching '
+                 'transformations')
+
+    candidate_pifs = numpy.asarray(candidate_pifs)
+    dtype = candidate_pifs.dtype
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        raise Exception('Histogram matching needs integer data of 16 bits '
+                        'or fewer, not {}'.format(dtype))
+    if not len(candidate_pifs):
+        raise Exception('There are no PIFs to fit to')
+    info = numpy.iinfo(dtype)
+    value_count = int(info.max) - int(info.min) + 1
+
+    def cdf(pifs):
+        # The values are offset to start at 0 for bincount. Reference values
+        # the candidate's type cannot hold are clipped to its range, as the
+        # look up table could not map to them.
+        values = numpy.clip(numpy.asarray(pifs, dtype=numpy.int64),
+                            int(info.min), int(info.max))
+        counts = numpy.bincount(values - int(info.min),
+                                minlength=value_count)
+        return numpy.cumsum(counts) / float(len(pifs))
+
+    candidate_cdf = cdf(candidate_pifs)
+    reference_cdf = cdf(reference_pifs)
+    # The lowest reference value whose cumulative frequency reaches each
+    # candidate value's
+    lut = numpy.searchsorted(reference_cdf, candidate_cdf)
+    numpy.minimum(lut, value_count - 1, out=lut)
+    lut += int(info.min)
+    c_min = int(candidate_pifs.min())
+    c_max = int(candidate_pifs.max())
+    # Values below the lowest candidate PIF have a cumulative frequency of 0,
+    # which would map them to the minimum of the type, so they are mapped to
+    # the lowest reference PIF instead (the entry of the lowest candidate PIF)
+    lut[:c_min - int(info.min)] = lut[c_min - int(info.min)]
+    logging.debug('Transformation: Candidate range [{}, {}] maps to [{}, {}]'
+                  .format(c_min, c_max, lut[c_min - int(info.min)],
+                          lut[c_max - int(info.min)]))
+
+    return LutTransformation(lut.astype(dtype))
+
+
+@instrumentation.instrumented
+def generate_ols_regression(candidate_band, reference_band, pif_mask,
+                            deduplicate=False):
     ''' Performs PCA analysis on the valid pixels and filters according
     to the distance from the principle eigenvector.
 
@@ -93,32 +341,47 @@ def generate_ols_regression(candidate_band, reference_band, pif_mask):
     candidate_pifs = candidate_band[numpy.nonzero(pif_mask)]
     reference_pifs = reference_band[numpy.nonzero(pif_mask)]
 
-    return generate_ols_regression_pixel_list(candidate_pifs, reference_pifs)
+    return generate_ols_regression_pixel_list(candidate_pifs, reference_pifs,
+                                              deduplicate)
 
 
-def generate_ols_regression_pixel_list(candidate_pifs, reference_pifs):
+@instrumentation.instrumented
+def generate_ols_regression_pixel_list(candidate_pifs, reference_pifs,
+                                       deduplicate=False):
     ''' Performs PCA analysis on the valid pixels and filters according
     to the distance from the principle eigenvector.
 
     :param list candidate_pifs: A list of candidate PIF data
     :param list reference_pifs: A list of coincident reference PIF data
+    :param bool deduplicate: Fit to the distinct (candidate, reference) pairs
+                             weighted by how many pixels have them (see
+                             robust.fit)
 
     :returns: A LinearTransformation object (gain and offset)
     '''
     logging.info('Transformation: Calculating ordinary least squares '
                  'regression transformations')
 
-    gain, offset, r_value, p_value, std_err = linregress(
-        candidate_pifs, reference_pifs)
-    logging.debug(
-        'Fit statistics: r_value = {}, p_value = {}, std_err = {}'.format(
-            r_value, p_value, std_err))
+    if deduplicate:
+        gain, offset, r_value, std_err = _weighted_linregress(
+            *histogram.unique_pairs(candidate_pifs, reference_pifs))
+        logging.debug(
+            'Fit statistics: r_value = {}, std_err = {}'.format(
+                r_value, std_err))
+    else:
+        gain, offset, r_value, p_value, std_err = linregress(
+            candidate_pifs, reference_pifs)
+        logging.debug(
+            'Fit statistics: r_value = {}, p_value = {}, std_err = {}'.format(
+                r_value, p_value, std_err))
     logging.info("Transformation: gain {}, offset {}".format(gain, offset))
 
     return LinearTransformation(gain, offset)
 
 
-def generate_robust_fit(candidate_band, reference_band, pif_mask):
+@instrumentation.instrumented
+def generate_robust_fit(candidate_band, reference_band, pif_mask,
+                        deduplicate=False):
     ''' Performs a robust fit on the valid pixels.
 
     :param array candidate_band: A 2D array representing the image data of the
@@ -132,21 +395,106 @@ def generate_robust_fit(candidate_band, reference_band, pif_mask):
     candidate_pifs = candidate_band[numpy.nonzero(pif_mask)]
     reference_pifs = reference_band[numpy.nonzero(pif_mask)]
 
-    return generate_robust_fit_pixel_list(candidate_pifs, reference_pifs)
+    return generate_robust_fit_pixel_list(candidate_pifs, reference_pifs,
+                                          deduplicate)
 
 
-def generate_robust_fit_pixel_list(candidate_pifs, reference_pifs):
+@instrumentation.instrumented
+def generate_robust_fit_pixel_list(candidate_pifs, reference_pifs,
+                                   deduplicate=False):
     ''' Performs a robust fit on the valid pixels.
 
     :param list candidate_pifs: A list of candidate PIF data
     :param list reference_pifs: A list of coincident reference PIF data
+    :param bool deduplicate: Fit to the distinct (candidate, reference) pairs
+                             weighted by how many pixels have them (see
+                             robust.fit)
 
     :returns: A LinearTransformation object (gain and offset)
     '''
     logging.info('Transformation: Calculating robust fit '
                  'transformations')
 
-    gain, offset = robust.fit(candidate_pifs, reference_pifs)
+    gain, offset = robust.fit(candidate_pifs, reference_pifs, deduplicate)
     logging.info("Transformation: gain {}, offset {}".format(gain, offset))
 
     return LinearTransformation(gain, offset)
+
+
+def transformation_to_json(transformation):
+    ''' Converts a transformation of any type to a value that can be written
+    as JSON (see transformation_from_json).
+
+    :param transformation: A LinearTransformation, LutTransformation or
+        GriddedTransformation
+
+    :returns: A dict of the transformation's type and values
+    '''
+    if isinstance(transformation, LutTransformation):
+        return {'type': 'lut',
+                'dtype': numpy.asarray(transformation.lut).dtype.name,
+                'lut': numpy.asarray(transformation.lut).tolist()}
+    if isinstance(transformation, GriddedTransformation):
+        return {'type': 'gridded',
+                'gain': numpy.asarray(transformation.gain,
+                                      dtype=numpy.float64).tolist(),
+                'offset': numpy.asarray(transformation.offset,
+                                        dtype=numpy.float64).tolist(),
+                'cell_size': int(transformation.cell_size)}
+    # Some fits give their gain and offset as one element arrays
+    return {'type': 'linear',
+            'gain': numpy.asarray(transformation.gain,
+                                  dtype=numpy.float64).item(),
+            'offset': numpy.asarray(transformation.offset,
+                                    dtype=numpy.float64).item()}
+
+
+def transformation_from_json(value):
+    ''' Rebuilds a transformation from transformation_to_json's value.
+
+    :param value: The dict from transformation_to_json (or a [gain, offset]
+        list, as linear transformations were written before there were other
+        types)
+
+    :returns: A LinearTransformation, LutTransformation or
+        GriddedTransformation
+    '''
+    if isinstance(value, (list, tuple)):
+        gain, offset = value
+        return LinearTransformation(gain, offset)
+    if value['type'] == 'lut':
+        return LutTransformation(numpy.array(value['lut'],
+                                             dtype=value['dtype']))
+    if value['type'] == 'gridded':
+        return GriddedTransformation(numpy.array(value['gain']),
+                                     numpy.array(value['offset']),
+                                     value['cell_size'])
+    if value['type'] == 'linear':
+        return LinearTransformation(value['gain'], value['offset'])
+    raise Exception('Unknown transformation type {}'.format(value['type']))
+
+
+def _weighted_linregress(candidate_values, reference_values, counts):
+    ''' An ordinary least squares fit to values weighted by integer counts,
+    equivalent to scipy.stats.linregress on the values repeated count times.
+
+    :returns: gain, offset, r_value, std_err
+    '''
+    n = counts.sum()
+    c_mean = numpy.dot(counts, candidate_values) / float(n)
+    r_mean = numpy.dot(counts, reference_values) / float(n)
+    c_centred = candidate_values - c_mean
+    r_centred = reference_values - r_mean
+    ssxm = numpy.dot(counts, c_centred * c_centred)
+    ssym = numpy.dot(counts, r_centred * r_centred)
+    ssxym = numpy.dot(counts, c_centred * r_centred)
+
+    gain = ssxym / ssxm
+    offset = r_mean - gain * c_mean
+    if ssxm == 0 or ssym == 0:
+        r_value = 0.0
+    else:
+        r_value = max(-1.0, min(1.0, ssxym / numpy.sqrt(ssxm * ssym)))
+    std_err = numpy.sqrt((1 - r_value ** 2) * ssym / ssxm / (n - 2)) \
+        if n > 2 else float('nan')
+    return gain, offset, r_value, std_err
@@ -0,0 +1,156 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import argparse
+import json
+import logging
+import sys
+
+from radiometric_normalization import cli
+from radiometric_normalization import instrumentation
+from radiometric_normalization.wrappers import worker_wrapper
+
+
+def main(args=None):
+    parser = _build_parser()
+    options = parser.parse_args(args)
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose > 1 else
+        logging.INFO if options.verbose else logging.WARNING)
+
+    if options.command == 'serve':
+        if options.metrics:
+            instrumentation.set_sink(
+                instrumentation.JsonLinesSink(options.metrics))
+        if options.requeue:
+            worker_wrapper.requeue_running(options.queue)
+        worker_wrapper.serve(
+            options.queue, workers=options.workers,
+            poll_interval=options.poll_interval, max_jobs=options.max_jobs,
+            idle_timeout=options.idle_timeout,
+            dataset_cache_size=options.dataset_cache_size)
+    elif options.command == 'submit':
+        if options.window is not None and options.bbox is not None:
+            parser.error('--window cannot be combined with --bbox')
+        job_id = worker_wrapper.submit(
+            options.queue, options.candidate, options.reference,
+            options.output, max_pending=options.max_pending,
+            pif_method=options.pif_method,
+            pif_options=cli._pif_options(
+                options.pif_method, options.pif_threshold,
+                options.deduplicate_pairs),
+            transformation_method=options.transformation_method,
+            last_band_alpha=options.last_band_alpha,
+            block_rows=options.tile_size,
+            writer_options=cli._writer_options(options),
+            validate=not options.no_validate,
+            window=options.window, bbox=options.bbox,
+            fit_decimation=options.fit_decimation)
+        sys.stdout.write(job_id + '\n')
+    elif options.job:
+        state, job = worker_wrapper.read_job(options.queue, options.job)
+        if state is None:
+            parser.error('Job {} is not in {}'.format(
+                options.job, options.queue))
+        sys.stdout.write(json.dumps(dict(job, state=state), indent=2,
+                                    sort_keys=True) + '\n')
+    else:
+        counts = worker_wrapper.status(options.queue)
+        for state in worker_wrapper.QUEUE_STATES:
+            sys.stdout.write('{}: {}\n'.format(state, counts[state]))
+    return 0
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        description='Run a long lived normalization worker on a directory '
+        'job queue, submit jobs to it and check on them.')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve = subparsers.add_parser(
+        'serve', help='Run queued jobs until stopped')
+    serve.add_argument('queue', help='The queue directory')
+    serve.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of jobs to run at once, each in a long lived process')
+    serve.add_argument(
+        '--poll-interval', type=float, default=0.1,
+        help='Seconds between checks of an idle queue')
+    serve.add_argument(
+        '--max-jobs', type=int, help='Stop after running this many jobs')
+    serve.add_argument(
+        '--idle-timeout', type=float,
+        help='Stop once the queue has been empty for this many seconds')
+    serve.add_argument(
+        '--dataset-cache-size', type=int, default=16,
+        help='Number of images each process keeps open between jobs')
+    serve.add_argument(
+        '--requeue', action='store_true',
+        help='Move jobs left running by a stopped worker back to pending '
+        'before serving (only if no other worker serves the queue)')
+    serve.add_argument(
+        '--metrics',
+        help='Append job latencies and per function metrics to this JSON '
+        'lines file')
+
+    submit = subparsers.add_parser(
+        'submit', help='Queue a job (the options are as for the '
+        'radiometric_normalization command)')
+    submit.add_argument('queue', help='The queue directory')
+    submit.add_argument('--candidate', required=True,
+                        help='Path to the candidate image')
+    submit.add_argument('--reference', required=True,
+                        help='Path to the reference image')
+    submit.add_argument('--output', required=True,
+                        help='Path to write the normalized image')
+    submit.add_argument(
+        '--max-pending', type=int,
+        help='Fail instead of queueing if this many jobs are already pending')
+    submit.add_argument(
+        '--pif-method', default='filter_alpha',
+        choices=['filter_alpha', 'filter_PCA', 'filter_robust',
+                 'filter_joint_PCA'])
+    submit.add_argument('--pif-threshold', type=float)
+    submit.add_argument('--deduplicate-pairs', action='store_true')
+    submit.add_argument(
+        '--transformation-method', default='linear_relationship',
+        choices=['linear_relationship'])
+    submit.add_argument('--last-band-alpha', action='store_true')
+    submit.add_argument('--window', type=int, nargs=4,
+                        metavar=('XOFF', 'YOFF', 'XSIZE', 'YSIZE'))
+    submit.add_argument('--bbox', type=float, nargs=4,
+                        metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'))
+    submit.add_argument('--fit-decimation', type=int, default=1)
+    submit.add_argument('--tile-size', type=int)
+    submit.add_argument('--compression', default='DEFLATE',
+                        choices=['DEFLATE', 'LZW', 'ZSTD', 'NONE'])
+    submit.add_argument('--compress-threads')
+    submit.add_argument('--mask-band', default='alpha',
+                        choices=['alpha', 'mask'])
+    submit.add_argument('--cog', action='store_true')
+    submit.add_argument('--no-validate', action='store_true')
+
+    status = subparsers.add_parser(
+        'status', help='Count the jobs in each state, or show one job')
+    status.add_argument('queue', help='The queue directory')
+    status.add_argument('--job', help='Show this job\'s record')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import json
+import logging
+import os
+import time
+import traceback
+from multiprocessing import Pool
+
+from radiometric_normalization import profiling
+from radiometric_normalization import result_cache
+from radiometric_normalization import transformation
+from radiometric_normalization.wrappers import pipeline_wrapper
+
+
+'''
+A restartable version of pipeline_wrapper.run_manifest, for batches large
+enough that starting over after a failure is expensive.
+
+Progress is kept in a state directory:
+
+- One completion record (<pair key>.json) per finished pair, holding its
+  transformations (of any type, see transformation.transformation_to_json),
+  RMSE and timings and what it was computed from (the size
+  and modification time of its images and the pipeline options)
+- One checkpoint (<pair key>.<inputs key>.checkpoint.json) per unfinished
+  pair written a strip at a time, recording the strips already on disk
+- A result cache (cache/) of PIF masks and transformations
+
+A pair is written to <output_path>.partial and renamed to output_path once
+it is complete, so output_path is never a partial image, and the completion
+record is written (atomically) after the rename. A rerun skips every pair
+with a record whose images and options are unchanged and whose output
+exists, resumes an interrupted pair after its last checkpointed strip, and
+reads an interrupted pair's PIF mask and transformations from the cache, so
+it only does the work that was not finished.
+'''
+
+# Pipeline options that do not change the output
+_UNRECORDED_OPTIONS = ('cache', 'prefetch_depth')
+
+
+def run(manifest_path, state_dir, workers=1, **kwargs):
+    ''' Runs the pipeline for every pair in a manifest that has not already
+    been run (see pipeline_wrapper.run_manifest for the manifest format).
+
+    Pairs that fail are logged and left unfinished while the rest of the
+    batch runs; an exception listing them is raised at the end, and a rerun
+    retries them.
+
+    :param str manifest_path: Path to the manifest
+    :param str state_dir: The directory to keep progress in (made if it does
+        not exist)
+    :param int workers: The number of worker processes
+    :param kwargs: Passed through to pipeline_wrapper.run (a result cache in
+        state_dir is used if no cache is given). checkpoint_path cannot be
+        given, as each pair's checkpoint is kept in state_dir.
+
+    :returns: A list of PipelineResults in manifest order (those of pairs
+        finished by an earlier run are read from their records, so have the
+        timings of that run)
+    '''
+    if 'checkpoint_path' in kwargs:
+        raise ValueError('The checkpoint of each pair is kept in the state '
+                         'directory, so checkpoint_path cannot be given.')
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    if kwargs.get('cache') is None:
+        kwargs['cache'] = result_cache.ResultCache(
+            os.path.join(state_dir, 'cache'))
+
+    pairs = pipeline_wrapper.read_manifest(manifest_path)
+    results = [completed(state_dir, pair, **kwargs) for pair in pairs]
+    jobs = [(state_dir, pair, kwargs)
+            for pair, result in zip(pairs, results) if result is None]
+    logging.info('Batch: {} of {} pairs already done, running {} with {} '
+                 'workers'.format(len(pairs) - len(jobs), len(pairs),
+                                  len(jobs), workers))
+
+    if workers <= 1:
+        outcomes = [_run_job(job) for job in jobs]
+    else:
+        # maxtasksperchild keeps the peak RSS of one pair from leaking into
+        # the next pair's report
+        pool = Pool(workers, maxtasksperchild=1)
+        try:
+            outcomes = pool.map(_run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failures = []
+    outcomes = iter(outcomes)
+    for index, result in enumerate(results):
+        if result is not None:
+            continue
+        result, error = next(outcomes)
+        if error is not None:
+            logging.error('Batch: {} failed:\n{}'.format(
+                pairs[index][0], error))
+            failures.append(pairs[index][0])
+        results[index] = result
+    if failures:
+        raise Exception('{} of {} pairs failed: {}'.format(
+            len(failures), len(pairs), ', '.join(failures)))
+    return results
+
+
+def completed(state_dir, pair, **kwargs):
+    ''' Finds a pair's completion record, if it is still valid.
+
+    :param str state_dir: The batch's state directory
+    :param tuple pair: A (candidate_path, reference_path, output_path) tuple
+    :param kwargs: The options the pair is to be run with
+
+    :returns: The PipelineResult of the recorded run, or None if the pair
+        has not been run (or its images or options have changed since, or its
+        output is missing)
+    '''
+    try:
+        with open(_record_path(state_dir, pair)) as record_file:
+            record = json.load(record_file)
+        inputs = _input_identity(pair, kwargs)
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.exists(pair[2]) or record['inputs'] != inputs:
+        return None
+    return pipeline_wrapper.PipelineResult(
+        pair[0], pair[1], pair[2],
+        [transformation.transformation_from_json(value)
+         for value in record['transformations']],
+        record['rmse'],
+        [profiling.StageTiming(**timing) for timing in record['timings']])
+
+
+def _run_job(job):
+    # Runs in a pool process (or inline), so errors are returned rather than
+    # raised to let the rest of the batch finish
+    state_dir, pair, kwargs = job
+    candidate_path, reference_path, output_path = pair
+    partial_path = '{}.partial'.format(output_path)
+    try:
+        # The inputs are identified before the run so a record is never
+        # written for images that changed during it
+        inputs = _input_identity(pair, kwargs)
+        result = pipeline_wrapper.run(
+            candidate_path, reference_path, partial_path,
+            checkpoint_path=_checkpoint_path(state_dir, pair, inputs),
+            **kwargs)
+        os.rename(partial_path, output_path)
+        result = result._replace(output_path=output_path)
+        _write_record(state_dir, pair, {
+            'inputs': inputs,
+            'transformations': [transformation.transformation_to_json(t)
+                                for t in result.transformations],
+            'rmse': result.rmse,
+            'timings': [dict(timing._asdict()) for timing in result.timings],
+            'finished_at': time.time()})
+    except Exception:
+        return None, traceback.format_exc()
+    logging.info('Batch: Finished {}'.format(candidate_path))
+    return result, None
+
+
+def _input_identity(pair, kwargs):
+    # What a pair's output is computed from
+    options = dict((name, repr(value)) for name, value in kwargs.items()
+                   if name not in _UNRECORDED_OPTIONS)
+    images = []
+    for path in pair[:2]:
+        stat = os.stat(path)
+        images.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    return {'images': images, 'options': options}
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(
+        value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _pair_key(pair):
+    return _digest([os.path.abspath(path) for path in pair])
+
+
+def _record_path(state_dir, pair):
+    return os.path.join(state_dir, '{}.json'.format(_pair_key(pair)))
+
+
+def _checkpoint_path(state_dir, pair, inputs):
+    # Strips written from other images or with other options are not resumed
+    return os.path.join(state_dir, '{}.{}.checkpoint.json'.format(
+        _pair_key(pair), _digest(inputs)[:12]))
+
+
+def _write_record(state_dir, pair, record):
+    # Renamed into place so a record is never seen half written
+    path = _record_path(state_dir, pair)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as record_file:
+        json.dump(record, record_file, indent=2, sort_keys=True)
+    os.rename(temporary_path, path)
@@ -14,18 +14,28 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 import numpy
-from osgeo import gdal
 
 from radiometric_normalization import display
 from radiometric_normalization import gimage
 
 
 def create_pixel_plots(candidate_path, reference_path, base_name,
-                       last_band_alpha=False, limits=None, custom_alpha=None):
-    c_ds, c_alpha, c_band_count = _open_image_and_get_info(
-        candidate_path, last_band_alpha)
-    r_ds, r_alpha, r_band_count = _open_image_and_get_info(
-        reference_path, last_band_alpha)
+                       last_band_alpha=False, limits=None, custom_alpha=None,
+                       buffer_pool=None, prefetch_depth=1, window=None,
+                       bbox=None, joint_histograms=None):
+    if joint_histograms is not None:
+        # The histograms already hold the pixels to plot
+        for band_no, joint_histogram in enumerate(joint_histograms, 1):
+            file_name = '{}_{}.png'.format(base_name, band_no)
+            display.plot_joint_histogram(file_name, joint_histogram, limits)
+        return
+
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+    c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window)
+    r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+        reference_path, last_band_alpha, window=window)
 
     _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
 
@@ -35,20 +45,30 @@ def create_pixel_plots(candidate_path, reference_path, base_name,
         combined_alpha = numpy.logical_and(c_alpha, r_alpha)
     valid_pixels = numpy.nonzero(combined_alpha)
 
-    for band_no in range(1, c_band_count + 1):
-        c_band = gimage.read_single_band(c_ds, band_no)
-        r_band = gimage.read_single_band(r_ds, band_no)
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+    band_reads = [(band_no, window) for band_no in range(1, c_band_count + 1)]
+    for (band_no, _), (c_band, r_band) in zip(
+            band_reads, gimage.prefetch_bands(
+                [c_ds, r_ds], band_reads, prefetch_depth, buffer_pool)):
         file_name = '{}_{}.png'.format(base_name, band_no)
         display.plot_pixels(file_name, c_band[valid_pixels],
                             r_band[valid_pixels], limits)
+        buffer_pool.release(c_band)
+        buffer_pool.release(r_band)
 
 
 def create_all_bands_histograms(candidate_path, reference_path, base_name,
                                 last_band_alpha=False,
                                 color_order=['b', 'g', 'r', 'y'],
-                                x_limits=None, y_limits=None):
-    c_gimg = gimage.load(candidate_path, last_band_alpha=last_band_alpha)
-    r_gimg = gimage.load(reference_path, last_band_alpha=last_band_alpha)
+                                x_limits=None, y_limits=None, window=None,
+                                bbox=None):
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+    c_gimg = gimage.load(candidate_path, last_band_alpha=last_band_alpha,
+                         window=window)
+    r_gimg = gimage.load(reference_path, last_band_alpha=last_band_alpha,
+                         window=window)
 
     gimage.check_comparable([c_gimg, r_gimg])
 
@@ -63,13 +83,6 @@ def create_all_bands_histograms(candidate_path, reference_path, base_name,
         color_order, x_limits, y_limits)
 
 
-def _open_image_and_get_info(path, last_band_alpha):
-    gdal_ds = gdal.Open(path)
-    alpha_band, band_count = gimage.read_alpha_and_band_count(
-        gdal_ds, last_band_alpha=last_band_alpha)
-    return gdal_ds, alpha_band, band_count
-
-
 def _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count):
     assert r_band_count == c_band_count
     assert r_alpha.shape == c_alpha.shape
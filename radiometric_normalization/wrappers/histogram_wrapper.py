@@ -0,0 +1,105 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import hashlib
+import logging
+import os
+
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization import histogram
+
+
+def generate(candidate_path, reference_path, mask=None, bin_width=1,
+             last_band_alpha=False, buffer_pool=None, prefetch_depth=1,
+             window=None, bbox=None, decimation=1, cache=None):
+    ''' Builds a joint histogram of the candidate and reference values of each
+    band, reading each band once. The histograms are cached (in
+    histogram.DEFAULT_HISTOGRAM_CACHE unless another cache is given), so a
+    later call for the same pixels does not read the images again.
+
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param array mask: [Optional] A boolean array of the pixels to include
+        (e.g. a PIF mask). If not given, the pixels that are valid in both
+        images are included
+    :param number bin_width: The width of the histogram bins (1 keeps every
+        distinct pair of integer values)
+    :param gimage.BufferPool buffer_pool: [Optional] A pool to read bands
+        into (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of bands to read ahead on background
+        threads (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to process instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to process (instead of window)
+    :param int decimation: [Optional] Work on a reduced raster of every
+        decimation-th row and column (read from overviews where the files
+        have them)
+    :param histogram.JointHistogramCache cache: [Optional] The cache to use
+
+    :returns: A list of histogram.JointHistograms (one for each band)
+    '''
+    if cache is None:
+        cache = histogram.DEFAULT_HISTOGRAM_CACHE
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+
+    c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window, decimation=decimation)
+    r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+        reference_path, last_band_alpha, window=window, decimation=decimation)
+
+    _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
+    if mask is None:
+        mask = numpy.logical_and(c_alpha, r_alpha)
+
+    key = (_file_key(candidate_path), _file_key(reference_path),
+           last_band_alpha, window, decimation, bin_width, mask.shape,
+           hashlib.sha1(numpy.packbits(mask)).hexdigest())
+    histograms = cache.get(key)
+    if histograms is not None:
+        logging.info('Histogram: Using cached joint histograms')
+        return histograms
+
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+    histograms = []
+    band_reads = [(band_no, window) for band_no in range(1, c_band_count + 1)]
+    for c_band, r_band in gimage.prefetch_bands(
+            [c_ds, r_ds], band_reads, prefetch_depth, buffer_pool,
+            decimation):
+        joint_histogram = histogram.JointHistogram(bin_width)
+        joint_histogram.update(c_band[mask], r_band[mask])
+        histograms.append(joint_histogram)
+        buffer_pool.release(c_band)
+        buffer_pool.release(r_band)
+    logging.info('Histogram: Built joint histograms with {} occupied bins '
+                 'for {} pixels'.format(
+                     [len(h.counts) for h in histograms],
+                     numpy.count_nonzero(mask)))
+
+    cache.put(key, histograms)
+    return histograms
+
+
+def _file_key(path):
+    # Like gimage.DatasetCache, a rewritten file is not served stale
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count):
+    assert r_band_count == c_band_count
+    assert r_alpha.shape == c_alpha.shape
@@ -0,0 +1,127 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import logging
+
+from radiometric_normalization import gimage
+from radiometric_normalization import instrumentation
+from radiometric_normalization import lazy
+from radiometric_normalization import profiling
+from radiometric_normalization import validation
+from radiometric_normalization.wrappers import pipeline_wrapper
+
+
+def run(candidate_path, reference_path, output_path,
+        pif_method='filter_alpha', pif_options=None,
+        transformation_method='linear_relationship',
+        last_band_alpha=False, writer_options=None, validate=True,
+        window=None, bbox=None, chunks=lazy.DEFAULT_CHUNKS,
+        scheduler='threads', workers=None):
+    ''' Runs the pipeline (as pipeline_wrapper.run) for a single
+    candidate/reference pair with the lazy stages in
+    radiometric_normalization.lazy, so the images are processed a chunk at a
+    time on a Dask scheduler.
+
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param str output_path: Path to write the normalized candidate image to
+    :param str pif_method: 'filter_alpha' or 'filter_PCA'
+    :param pif.pca_options pif_options: [Optional] Options for 'filter_PCA'
+    :param str transformation_method: 'linear_relationship'
+    :param gimage.writer_options writer_options: [Optional] How to lay out
+        the normalized image file
+    :param bool validate: Whether to score the normalized image against the
+        reference image
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        of the candidate to normalize instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to normalize (instead of window)
+    :param int chunks: The height and width of the chunks
+    :param str scheduler: The Dask scheduler to run on (see
+        lazy.use_scheduler)
+    :param int workers: [Optional] The number of scheduler workers
+
+    :returns: A pipeline_wrapper.PipelineResult (rmse is None if validate is
+        False)
+    '''
+    if transformation_method != 'linear_relationship':
+        raise NotImplementedError('Only "linear_relationship" is implemented '
+                                  'for lazy images.')
+
+    timings = []
+    # The reference is on the same grid as the candidate, so one window
+    # serves both
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+    candidate = lazy.load(candidate_path, last_band_alpha, window,
+                          chunks=chunks)
+    reference = lazy.load(reference_path, last_band_alpha, window,
+                          chunks=chunks)
+
+    with lazy.use_scheduler(scheduler, workers):
+        with profiling.timed_stage('pif', timings):
+            pif_mask = lazy.pif_mask(candidate, reference, pif_method,
+                                     pif_options)
+
+        with profiling.timed_stage('transformation', timings):
+            transformations = lazy.linear_relationships(
+                candidate, reference, pif_mask)
+
+        with profiling.timed_stage('normalize', timings):
+            lazy.to_file(lazy.normalize_image(candidate, transformations),
+                         output_path, options=writer_options)
+
+    rmse = None
+    if validate:
+        with profiling.timed_stage('validate', timings):
+            # The normalized image always has an alpha band
+            normalized_gimg = gimage.load(output_path)
+            reference_gimg = gimage.load(
+                reference_path, last_band_alpha=last_band_alpha,
+                window=window)
+            rmse = validation.sum_of_rmse(normalized_gimg, reference_gimg)
+
+    instrumentation.flush()
+
+    return pipeline_wrapper.PipelineResult(
+        candidate_path, reference_path, output_path, transformations, rmse,
+        timings)
+
+
+def time_stack(image_paths, output_path, window=None, bbox=None,
+               writer_options=None, chunks=lazy.DEFAULT_CHUNKS,
+               scheduler='threads', workers=None):
+    ''' Averages a time stack (see time_stack.generate) into a reference
+    image with the lazy stages, so every image is read a chunk at a time
+    instead of being loaded whole.
+
+    :param list image_paths: Paths of the images in the time stack
+    :param str output_path: A path to write the mean image to
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to process instead of the whole images
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the images' coordinate system to process (instead of window)
+    :param gimage.writer_options writer_options: [Optional] How to lay out
+        the output file
+    :param int chunks: The height and width of the chunks
+    :param str scheduler: The Dask scheduler to run on (see
+        lazy.use_scheduler)
+    :param int workers: [Optional] The number of scheduler workers
+    '''
+    logging.info('Lazy: Averaging {} images'.format(len(image_paths)))
+    window = gimage.resolve_window(
+        gimage.open_dataset(image_paths[0]), window, bbox)
+    images = [lazy.load(path, window=window, chunks=chunks)
+              for path in image_paths]
+    with lazy.use_scheduler(scheduler, workers):
+        lazy.to_file(lazy.mean_with_uniform_weight(images), output_path,
+                     options=writer_options)
@@ -10,41 +10,193 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-from osgeo import gdal
+import hashlib
+import json
+import logging
+import os
+
+import numpy
 
 from radiometric_normalization import gimage
 from radiometric_normalization import normalize
+from radiometric_normalization.transformation import GriddedTransformation
 
 
-def generate(image_path, per_band_transformation, last_band_alpha=False):
+def generate(image_path, per_band_transformation, last_band_alpha=False,
+             buffer_pool=None, prefetch_depth=1, window=None, bbox=None):
     '''Applies a set of linear transformations to a gimage
 
     :param str image_path: The path to an image
     :param list per_band_transformation: A list of of LinearTransformations
-        (length equal to the number of bands in the image)
+        or GriddedTransformations (length equal to the number of bands in
+        the image)
+    :param gimage.BufferPool buffer_pool: [Optional] A pool to read bands
+        into (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of bands to read ahead on a
+        background thread (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to normalize instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the image's coordinate system to normalize (instead of window)
     :param output: A gimage that represents input_gimage with transformations
-        applied
+        applied (the window of it if one is given)
     '''
-    img_ds, img_alpha, band_count = _open_image_and_get_info(
-        image_path, last_band_alpha)
-    img_metadata = gimage.read_metadata(img_ds)
+    window = gimage.resolve_window(
+        gimage.open_dataset(image_path), window, bbox)
+    img_ds, img_alpha, band_count = gimage.open_image_and_get_info(
+        image_path, last_band_alpha, window=window)
+    img_metadata = gimage.window_metadata(
+        gimage.read_metadata(img_ds), window)
 
     _assert_consistent(band_count, per_band_transformation)
 
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
     output_bands = []
-    for band_no, transformation in zip(
-        range(1, band_count + 1), per_band_transformation):
-        band = gimage.read_single_band(img_ds, band_no)
-        output_bands.append(normalize.apply(band, transformation))
+    band_reads = [(band_no, window) for band_no in range(1, band_count + 1)]
+    for transformation, (band,) in zip(
+            per_band_transformation, gimage.prefetch_bands(
+                [img_ds], band_reads, prefetch_depth, buffer_pool)):
+        output_bands.append(_apply(band, transformation))
+        buffer_pool.release(band)
 
     return gimage.GImage(output_bands, img_alpha, img_metadata)
 
 
-def _open_image_and_get_info(path, last_band_alpha):
-    gdal_ds = gdal.Open(path)
-    alpha_band, band_count = gimage.read_alpha_and_band_count(
-        gdal_ds, last_band_alpha=last_band_alpha)
-    return gdal_ds, alpha_band, band_count
+def generate_to_file(image_path, output_path, per_band_transformation,
+                     last_band_alpha=False, block_rows=None, options=None,
+                     buffer_pool=None, prefetch_depth=1, window=None,
+                     bbox=None, checkpoint_path=None):
+    '''Applies a set of linear transformations to an image and writes the
+    result to disk one strip of rows at a time, so only a strip of each band
+    is held in memory
+
+    :param str image_path: The path to an image
+    :param str output_path: The path to write the transformed image to
+    :param list per_band_transformation: A list of of LinearTransformations
+        or GriddedTransformations (length equal to the number of bands in
+        the image)
+    :param int block_rows: [Optional] The number of rows to read, transform
+        and write at a time (defaults to the output file's block height)
+    :param gimage.writer_options options: [Optional] How to lay out the
+        output file
+    :param gimage.BufferPool buffer_pool: [Optional] A pool for the strip
+        buffers (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of strips to read ahead on a
+        background thread (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to normalize instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the image's coordinate system to normalize (instead of window)
+    :param str checkpoint_path: [Optional] A file to record the rows written
+        so far in. If it records rows of an unfinished call with the same
+        output_path and transformations, the call resumes after them
+        instead of starting over. It is removed once the image is written.
+    '''
+    window = gimage.resolve_window(
+        gimage.open_dataset(image_path), window, bbox)
+    img_ds, img_alpha, band_count = gimage.open_image_and_get_info(
+        image_path, last_band_alpha, window=window)
+    img_metadata = gimage.window_metadata(
+        gimage.read_metadata(img_ds), window)
+
+    _assert_consistent(band_count, per_band_transformation)
+
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+
+    rows_done = 0
+    if checkpoint_path is not None:
+        checkpoint = _checkpoint(output_path, per_band_transformation)
+        rows_done = _read_checkpoint(checkpoint_path, checkpoint)
+
+    if window is None:
+        window = gimage.Window(0, 0, img_ds.RasterXSize, img_ds.RasterYSize)
+    dtype = gimage.band_dtype(img_ds.GetRasterBand(1))
+    writer = gimage.GImageWriter(output_path, window.xsize, window.ysize,
+                                 band_count, img_metadata, options=options,
+                                 dtype=dtype, resume=rows_done > 0,
+                                 keep_partial=checkpoint_path is not None)
+    if not writer.resumed:
+        rows_done = 0
+    elif rows_done:
+        logging.info('Normalize: Resuming {} after {} rows'.format(
+            output_path, rows_done))
+    with writer:
+        # A strip that was partly written before is written again
+        strips = [(yoff, rows) for yoff, rows in gimage.iter_row_blocks(
+            window.ysize, block_rows or writer.block_rows)
+            if yoff + rows > rows_done]
+        # Reading every band of a strip before the next strip lets the next
+        # strip be read while this one is transformed and written
+        strip_reads = [(band_no, (window.xoff, window.yoff + yoff,
+                                  window.xsize, rows))
+                       for yoff, rows in strips
+                       for band_no in range(1, band_count + 1)]
+        band_iterator = gimage.prefetch_bands(
+            [img_ds], strip_reads, prefetch_depth * band_count, buffer_pool)
+        try:
+            for yoff, rows in strips:
+                output_bands = []
+                for transformation in per_band_transformation:
+                    band, = next(band_iterator)
+                    output_bands.append(_apply(
+                        band, transformation, yoff,
+                        out=buffer_pool.acquire(band.shape, band.dtype)))
+                    buffer_pool.release(band)
+                writer.write_block(output_bands, img_alpha[yoff:yoff + rows],
+                                   0, yoff)
+                for output_band in output_bands:
+                    buffer_pool.release(output_band)
+                if checkpoint_path is not None:
+                    writer.flush()
+                    _write_checkpoint(checkpoint_path,
+                                      dict(checkpoint, rows=yoff + rows))
+        finally:
+            band_iterator.close()
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def _apply(band, band_transformation, yoff=0, out=None):
+    # Gridded transformations vary across the image, so need to know where
+    # the band (or strip) is
+    if isinstance(band_transformation, GriddedTransformation):
+        return normalize.apply_gridded(band, band_transformation, yoff=yoff,
+                                       out=out)
+    return normalize.apply(band, band_transformation, out=out)
+
+
+def _checkpoint(output_path, per_band_transformation):
+    # What the rows in a checkpoint were written from
+    digest = hashlib.sha1()
+    for band_transformation in per_band_transformation:
+        for value in band_transformation:
+            digest.update(numpy.asarray(value, dtype=numpy.float64).tobytes())
+    return {'output_path': os.path.abspath(output_path),
+            'transformations': digest.hexdigest()}
+
+
+def _read_checkpoint(checkpoint_path, checkpoint):
+    # The rows that can be kept from an earlier call (0 unless there is a
+    # checkpoint from a call like this one and the file it wrote)
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            recorded = json.load(checkpoint_file)
+    except (IOError, OSError, ValueError):
+        return 0
+    rows = recorded.pop('rows', 0)
+    if recorded != checkpoint:
+        return 0
+    return rows
+
+
+def _write_checkpoint(checkpoint_path, checkpoint):
+    # Renamed into place so a checkpoint is never seen half written
+    temporary_path = '{}.{}.tmp'.format(checkpoint_path, os.getpid())
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(temporary_path, checkpoint_path)
 
 
 def _assert_consistent(band_count, per_band_transformation):
@@ -13,15 +13,19 @@ limitations under the License.
 import logging
 import numpy
 
-from osgeo import gdal
-
 from radiometric_normalization import gimage
+from radiometric_normalization import pca_filter
 from radiometric_normalization import pif
 
 
+# The number of rows of every band held at once by filter_joint_PCA
+JOINT_PCA_BLOCK_ROWS = 256
+
+
 def generate(candidate_path, reference_path,
              method='filter_alpha', method_options=None,
-             last_band_alpha=False):
+             last_band_alpha=False, buffer_pool=None, prefetch_depth=1,
+             window=None, bbox=None, decimation=1, cache=None):
     ''' Generates psuedo invariant features as a mask
 
     :param str candidate_path: Path to the candidate image
@@ -31,25 +35,67 @@ def generate(candidate_path, reference_path,
         options for the method chosen:
             - Not applicable for 'filter_alpha'
             - The width of the filter for 'filter_PCA'
+            - The distance from the principal subspace for
+              'filter_joint_PCA'
+    :param gimage.BufferPool buffer_pool: [Optional] A pool to read bands
+        into (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of bands to read ahead on background
+        threads (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to process instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to process (instead of window)
+    :param int decimation: [Optional] Work on a reduced raster of every
+        decimation-th row and column (read from overviews where the files
+        have them)
+    :param result_cache.ResultCache cache: [Optional] A cache to serve the
+        mask from if it has been generated from the same images and options
+        before (and to store it in otherwise)
 
     :returns: A boolean array in the same coordinate system of the
-        candidate/reference image (True for the PIF)
+        candidate/reference image (or of the window, decimated) (True for
+        the PIF)
     '''
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+
+    if cache is not None:
+        cache_key = cache.key(
+            'pif_mask', [candidate_path, reference_path], method=method,
+            method_options=method_options, last_band_alpha=last_band_alpha,
+            window=window, decimation=decimation)
+        pif_mask = cache.get_mask(cache_key)
+        if pif_mask is not None:
+            logging.info('PIF: Using the cached PIF mask')
+            return pif_mask
+
     if method == 'filter_alpha':
-        _, c_alpha, c_band_count = _open_image_and_get_info(
-            candidate_path, last_band_alpha)
-        _, r_alpha, r_band_count = _open_image_and_get_info(
-            reference_path, last_band_alpha)
+        # Only the alpha bands are needed, so read them bit packed without
+        # touching the image bands
+        c_ds, c_alpha, c_band_count = gimage.open_image_and_get_packed_alpha(
+            candidate_path, last_band_alpha, window=window,
+            decimation=decimation)
+        r_ds, r_alpha, r_band_count = gimage.open_image_and_get_packed_alpha(
+            reference_path, last_band_alpha, window=window,
+            decimation=decimation)
 
         _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
-        combined_alpha = numpy.logical_and(c_alpha, r_alpha)
+        assert c_ds.RasterXSize == r_ds.RasterXSize
+        _, xsize = gimage.decimated_shape(
+            gimage.window_shape(c_ds, window), decimation)
+        combined_alpha = gimage.unpack_alpha(
+            numpy.bitwise_and(c_alpha, r_alpha), xsize)
 
-        pif_mask = pif.generate_alpha_band_pifs(combined_alpha)
+        pif_mask = pif.generate_mask_pifs(combined_alpha)
     elif method == 'filter_PCA':
-        c_ds, c_alpha, c_band_count = _open_image_and_get_info(
-            candidate_path, last_band_alpha)
-        r_ds, r_alpha, r_band_count = _open_image_and_get_info(
-            reference_path, last_band_alpha)
+        c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+            candidate_path, last_band_alpha, window=window,
+            decimation=decimation)
+        r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+            reference_path, last_band_alpha, window=window,
+            decimation=decimation)
 
         _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
         combined_alpha = numpy.logical_and(c_alpha, r_alpha)
@@ -59,26 +105,23 @@ def generate(candidate_path, reference_path,
         else:
             parameters = pif.DEFAULT_PCA_OPTIONS
 
-        pif_mask = numpy.ones(c_alpha.shape, dtype=numpy.bool)
-        for band_no in range(1, c_band_count + 1):
-            logging.info('PIF: Band {}'.format(band_no))
-            c_band = gimage.read_single_band(c_ds, band_no)
-            r_band = gimage.read_single_band(r_ds, band_no)
-            pif_band_mask = pif.generate_pca_pifs(
-                c_band, r_band, combined_alpha, parameters)
-            pif_mask = numpy.logical_and(pif_mask, pif_band_mask)
+        pif_mask, no_valid_pixels = _generate_multiband_pifs(
+            c_ds, r_ds, combined_alpha, c_band_count,
+            pif.generate_pca_pifs_pixel_list, parameters, window, decimation,
+            buffer_pool, prefetch_depth)
 
         no_total_pixels = c_alpha.size
-        no_valid_pixels = len(numpy.nonzero(pif_mask)[0])
         valid_percent = 100.0 * no_valid_pixels / no_total_pixels
         logging.info(
             'PIF: Found {} final pifs out of {} pixels ({}%) for all '
             'bands'.format(no_valid_pixels, no_total_pixels, valid_percent))
     elif method == 'filter_robust':
-        c_ds, c_alpha, c_band_count = _open_image_and_get_info(
-            candidate_path, last_band_alpha)
-        r_ds, r_alpha, r_band_count = _open_image_and_get_info(
-            reference_path, last_band_alpha)
+        c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+            candidate_path, last_band_alpha, window=window,
+            decimation=decimation)
+        r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+            reference_path, last_band_alpha, window=window,
+            decimation=decimation)
 
         _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
         combined_alpha = numpy.logical_and(c_alpha, r_alpha)
@@ -88,33 +131,155 @@ def generate(candidate_path, reference_path,
         else:
             parameters = pif.DEFAULT_ROBUST_OPTIONS
 
-        pif_mask = numpy.ones(c_alpha.shape, dtype=numpy.bool)
-        for band_no in range(1, c_band_count + 1):
-            logging.info('PIF: Band {}'.format(band_no))
-            c_band = gimage.read_single_band(c_ds, band_no)
-            r_band = gimage.read_single_band(r_ds, band_no)
-            pif_band_mask = pif.generate_robust_pifs(
-                c_band, r_band, combined_alpha, parameters)
-            pif_mask = numpy.logical_and(pif_mask, pif_band_mask)
+        pif_mask, no_valid_pixels = _generate_multiband_pifs(
+            c_ds, r_ds, combined_alpha, c_band_count,
+            pif.generate_robust_pifs_pixel_list, parameters, window,
+            decimation, buffer_pool, prefetch_depth)
+
+        no_total_pixels = c_alpha.size
+        valid_percent = 100.0 * no_valid_pixels / no_total_pixels
+        logging.info(
+            'PIF: Found {} final pifs out of {} pixels ({}%) for all '
+            'bands'.format(no_valid_pixels, no_total_pixels, valid_percent))
+    elif method == 'filter_joint_PCA':
+        c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+            candidate_path, last_band_alpha, window=window,
+            decimation=decimation)
+        r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+            reference_path, last_band_alpha, window=window,
+            decimation=decimation)
+
+        _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
+        combined_alpha = numpy.logical_and(c_alpha, r_alpha)
+
+        if method_options:
+            parameters = method_options
+        else:
+            parameters = pif.DEFAULT_JOINT_PCA_OPTIONS
+
+        pif_mask, no_valid_pixels = _generate_joint_pca_pifs(
+            c_ds, r_ds, combined_alpha, c_band_count, parameters, window,
+            decimation, buffer_pool, prefetch_depth)
 
         no_total_pixels = c_alpha.size
-        no_valid_pixels = len(numpy.nonzero(pif_mask)[0])
         valid_percent = 100.0 * no_valid_pixels / no_total_pixels
         logging.info(
             'PIF: Found {} final pifs out of {} pixels ({}%) for all '
             'bands'.format(no_valid_pixels, no_total_pixels, valid_percent))
     else:
-        raise NotImplementedError('Only "filter_alpha", "filter_PCA" and '
-                                  '"filter_robust" methods are implemented.')
+        raise NotImplementedError('Only "filter_alpha", "filter_PCA", '
+                                  '"filter_robust" and "filter_joint_PCA" '
+                                  'methods are implemented.')
 
+    if cache is not None:
+        cache.put_mask(cache_key, pif_mask)
     return pif_mask
 
 
-def _open_image_and_get_info(path, last_band_alpha):
-    gdal_ds = gdal.Open(path)
-    alpha_band, band_count = gimage.read_alpha_and_band_count(
-        gdal_ds, last_band_alpha=last_band_alpha)
-    return gdal_ds, alpha_band, band_count
+def _generate_multiband_pifs(c_ds, r_ds, combined_alpha, band_count,
+                             pixel_list_filter, parameters, window,
+                             decimation, buffer_pool, prefetch_depth):
+    ''' Filters the valid pixels band by band, each band only evaluating the
+    pixels that passed the bands before it, and scatters the survivors to a
+    mask once at the end.
+
+    :returns: The PIF mask and the number of PIF pixels
+    '''
+    pif_indices = pif.mask_to_pif_indices(combined_alpha)
+    band_reads = [(band_no, window) for band_no in range(1, band_count + 1)]
+    for (band_no, _), (c_band, r_band) in zip(
+            band_reads, gimage.prefetch_bands(
+                [c_ds, r_ds], band_reads, prefetch_depth, buffer_pool,
+                decimation)):
+        logging.info('PIF: Band {} ({} candidate pixels)'.format(
+            band_no, len(pif_indices)))
+        if len(pif_indices):
+            pif_indices = pif.filter_pif_indices(
+                c_band, r_band, pif_indices, pixel_list_filter, parameters)
+        buffer_pool.release(c_band)
+        buffer_pool.release(r_band)
+
+    return (pif.pif_indices_to_mask(pif_indices, combined_alpha.shape),
+            len(pif_indices))
+
+
+def _generate_joint_pca_pifs(c_ds, r_ds, combined_alpha, band_count,
+                             parameters, window, decimation, buffer_pool,
+                             prefetch_depth, block_rows=JOINT_PCA_BLOCK_ROWS):
+    ''' Fits a PCA to the joint (candidate bands, reference bands) vectors of
+    the valid pixels and keeps the pixels close to its principal subspace.
+
+    The image is streamed twice a strip of all bands at a time: once to
+    accumulate the covariance and once to measure each pixel's distance from
+    the principal subspace, so only a strip of every band is held at once.
+
+    :returns: The PIF mask and the number of PIF pixels
+    '''
+    pif_mask = numpy.zeros(combined_alpha.shape, dtype=numpy.bool)
+
+    covariance = pca_filter.JointCovariance(band_count)
+    for rows, candidate_data, reference_data in _iter_joint_strips(
+            c_ds, r_ds, combined_alpha, band_count, window, decimation,
+            buffer_pool, prefetch_depth, block_rows):
+        covariance.update(candidate_data, reference_data)
+    if covariance.count < 2:
+        logging.info('PIF: Too few valid pixels for a joint PCA.')
+        return pif_mask, 0
+
+    joint_pca = covariance.fit()
+    for rows, candidate_data, reference_data in _iter_joint_strips(
+            c_ds, r_ds, combined_alpha, band_count, window, decimation,
+            buffer_pool, prefetch_depth, block_rows):
+        distances = pca_filter.joint_pca_distance(
+            joint_pca, candidate_data, reference_data)
+        strip_mask = pif_mask[rows]
+        strip_mask[combined_alpha[rows]] = distances <= parameters.threshold
+
+    return pif_mask, numpy.count_nonzero(pif_mask)
+
+
+def _iter_joint_strips(c_ds, r_ds, combined_alpha, band_count, window,
+                       decimation, buffer_pool, prefetch_depth, block_rows):
+    ''' Reads all bands of both images a strip at a time.
+
+    :returns: A generator of (row slice of combined_alpha, candidate data,
+        reference data) tuples, the data being lists (one per band) of the
+        valid pixels in the strip
+    '''
+    if window is None:
+        window = gimage.Window(0, 0, c_ds.RasterXSize, c_ds.RasterYSize)
+    if decimation > 1:
+        # Strips of a decimated read would not sample the same rows as the
+        # whole window read of the alpha, so read the (small) raster at once
+        strips = [(slice(None), window)]
+    else:
+        strips = [
+            (slice(yoff, yoff + rows),
+             gimage.Window(window.xoff, window.yoff + yoff, window.xsize,
+                           rows))
+            for yoff, rows in gimage.iter_row_blocks(window.ysize,
+                                                     block_rows)]
+
+    band_reads = [(band_no, strip_window)
+                  for _, strip_window in strips
+                  for band_no in range(1, band_count + 1)]
+    bands = gimage.prefetch_bands(
+        [c_ds, r_ds], band_reads, prefetch_depth * band_count, buffer_pool,
+        decimation)
+    try:
+        for rows, _ in strips:
+            valid = combined_alpha[rows]
+            candidate_data = []
+            reference_data = []
+            for _ in range(band_count):
+                c_band, r_band = next(bands)
+                candidate_data.append(c_band[valid])
+                reference_data.append(r_band[valid])
+                buffer_pool.release(c_band)
+                buffer_pool.release(r_band)
+            yield rows, candidate_data, reference_data
+    finally:
+        bands.close()
 
 
 def _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count):
@@ -0,0 +1,358 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import csv
+import logging
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+
+from radiometric_normalization import gimage
+from radiometric_normalization import instrumentation
+from radiometric_normalization import profiling
+from radiometric_normalization import validation
+from radiometric_normalization.wrappers import histogram_wrapper
+from radiometric_normalization.wrappers import normalize_wrapper
+from radiometric_normalization.wrappers import pif_wrapper
+from radiometric_normalization.wrappers import transformation_wrapper
+
+
+PipelineResult = namedtuple(
+    'PipelineResult',
+    'candidate_path, reference_path, output_path, transformations, rmse, '
+    'timings')
+
+# How far a fit on a decimated raster is from the full resolution fit. The
+# errors are the largest over the bands; max_dn_error is the largest
+# difference in normalized value over the range of each candidate band's
+# valid pixels in the window.
+DecimationReport = namedtuple(
+    'DecimationReport',
+    'decimation, wall_time, speedup, transformations, max_gain_error, '
+    'max_offset_error, max_dn_error')
+
+
+def run(candidate_path, reference_path, output_path,
+        pif_method='filter_alpha', pif_options=None,
+        transformation_method='linear_relationship',
+        last_band_alpha=False, block_rows=None, writer_options=None,
+        validate=True, prefetch_depth=1, window=None, bbox=None,
+        fit_decimation=1, cache=None, checkpoint_path=None,
+        grid_cell_size=None, grid_smoothing=1, histogram_bin_width=None):
+    ''' Runs PIF generation, transformation calculation, normalization and
+    (optionally) validation for a single candidate/reference pair, timing
+    each stage.
+
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param str output_path: Path to write the normalized candidate image to
+    :param str pif_method: Passed through to pif_wrapper.generate
+    :param object pif_options: Passed through to pif_wrapper.generate
+    :param str transformation_method: Passed through to
+        transformation_wrapper.generate
+    :param int block_rows: [Optional] If given, the normalized image is
+        written a strip of block_rows rows at a time instead of being held in
+        memory
+    :param gimage.writer_options writer_options: [Optional] How to lay out
+        the normalized image file
+    :param bool validate: Whether to score the normalized image against the
+        reference image
+    :param int prefetch_depth: The number of bands (or strips) each stage
+        reads ahead on background threads
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        of the candidate to normalize instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to normalize (instead of window)
+    :param int fit_decimation: [Optional] Generate the PIFs and fit the
+        transformations on a raster reduced by this factor (see
+        compare_fit_decimation); normalization is always at full resolution
+    :param result_cache.ResultCache cache: [Optional] A cache of PIF masks
+        and transformations, so a rerun of an unchanged pair skips PIF
+        generation and the fit
+    :param str checkpoint_path: [Optional] If block_rows is given, record
+        the strips written in this file so a rerun after an interruption
+        resumes writing after them (see normalize_wrapper.generate_to_file)
+    :param int grid_cell_size: [Optional] Fit a transformation for each cell
+        of a grid of cells this many pixels square instead of one for the
+        whole image (see transformation_wrapper.generate_gridded); only the
+        linear_relationship method can be gridded
+    :param int grid_smoothing: How many cells either side of a cell to fit
+        it to
+    :param number histogram_bin_width: [Optional] Fit the transformations to
+        joint histograms of the PIFs with bins this wide (1 is exact for
+        integer images) built by histogram_wrapper.generate, which are kept
+        in histogram.DEFAULT_HISTOGRAM_CACHE so later calls for the same PIFs
+        (e.g. display_wrapper plots) do not read the images again; only the
+        linear_relationship method can be fitted to them
+
+    :returns: A PipelineResult (rmse is None if validate is False)
+    '''
+    if grid_cell_size and (fit_decimation != 1 or
+                           transformation_method != 'linear_relationship'):
+        raise ValueError('Gridded transformations are only fitted with the '
+                         '"linear_relationship" method at full resolution.')
+    if histogram_bin_width and (grid_cell_size or
+                                transformation_method !=
+                                'linear_relationship'):
+        raise ValueError('Only ungridded "linear_relationship" '
+                         'transformations are fitted to joint histograms.')
+    timings = []
+    # The reference is on the same grid as the candidate, so one window
+    # serves both
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+    # Every stage reads the same sized bands, so one pool serves them all
+    buffer_pool = gimage.BufferPool()
+
+    with profiling.timed_stage('pif', timings):
+        pif_mask = pif_wrapper.generate(
+            candidate_path, reference_path, method=pif_method,
+            method_options=pif_options, last_band_alpha=last_band_alpha,
+            buffer_pool=buffer_pool, prefetch_depth=prefetch_depth,
+            window=window, decimation=fit_decimation, cache=cache)
+
+    with profiling.timed_stage('transformation', timings):
+        if grid_cell_size:
+            transformations = transformation_wrapper.generate_gridded(
+                candidate_path, reference_path, pif_mask, grid_cell_size,
+                smoothing=grid_smoothing, last_band_alpha=last_band_alpha,
+                buffer_pool=buffer_pool, prefetch_depth=prefetch_depth,
+                window=window)
+        elif histogram_bin_width:
+            joint_histograms = histogram_wrapper.generate(
+                candidate_path, reference_path, mask=pif_mask,
+                bin_width=histogram_bin_width,
+                last_band_alpha=last_band_alpha, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window,
+                decimation=fit_decimation)
+            transformations = transformation_wrapper.generate(
+                candidate_path, reference_path, pif_mask,
+                method=transformation_method,
+                joint_histograms=joint_histograms)
+        else:
+            transformations = transformation_wrapper.generate(
+                candidate_path, reference_path, pif_mask,
+                method=transformation_method,
+                last_band_alpha=last_band_alpha, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window,
+                decimation=fit_decimation, cache=cache)
+    del pif_mask
+
+    if block_rows:
+        with profiling.timed_stage('normalize', timings):
+            normalize_wrapper.generate_to_file(
+                candidate_path, output_path, transformations,
+                last_band_alpha=last_band_alpha, block_rows=block_rows,
+                options=writer_options, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window,
+                checkpoint_path=checkpoint_path)
+    else:
+        with profiling.timed_stage('normalize', timings):
+            normalized_gimg = normalize_wrapper.generate(
+                candidate_path, transformations,
+                last_band_alpha=last_band_alpha, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window)
+        with profiling.timed_stage('save', timings):
+            gimage.save(normalized_gimg, output_path, options=writer_options)
+        del normalized_gimg
+
+    rmse = None
+    if validate:
+        with profiling.timed_stage('validate', timings):
+            # The normalized image always has an alpha band
+            normalized_gimg = gimage.load(output_path)
+            reference_gimg = gimage.load(
+                reference_path, last_band_alpha=last_band_alpha,
+                window=window)
+            rmse = validation.sum_of_rmse(normalized_gimg, reference_gimg)
+    buffer_pool.clear()
+
+    # Worker processes can exit without flushing, so flush after every pair
+    instrumentation.flush()
+
+    return PipelineResult(candidate_path, reference_path, output_path,
+                          transformations, rmse, timings)
+
+
+def compare_fit_decimation(candidate_path, reference_path,
+                           decimations=(2, 4, 8), pif_method='filter_alpha',
+                           pif_options=None,
+                           transformation_method='linear_relationship',
+                           last_band_alpha=False, window=None, bbox=None):
+    ''' Generates PIFs and fits transformations at full resolution and on
+    rasters reduced by each decimation factor, reporting how much faster each
+    reduced fit is and how far its transformations are from the full
+    resolution ones.
+
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param list decimations: The decimation factors to compare
+    :param str pif_method: Passed through to pif_wrapper.generate
+    :param object pif_options: Passed through to pif_wrapper.generate
+    :param str transformation_method: Passed through to
+        transformation_wrapper.generate
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to fit instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        to fit (instead of window)
+
+    :returns: A list of DecimationReports, the first for the full resolution
+        fit
+    '''
+    # The errors are of the gain and offset of LinearTransformations
+    if transformation_method != 'linear_relationship':
+        raise Exception('Only the "linear_relationship" method makes '
+                        'LinearTransformations to compare, not '
+                        '"{}"'.format(transformation_method))
+    c_ds = gimage.open_dataset(candidate_path)
+    window = gimage.resolve_window(c_ds, window, bbox)
+
+    reports = []
+    for decimation in [1] + list(decimations):
+        start = time.time()
+        pif_mask = pif_wrapper.generate(
+            candidate_path, reference_path, method=pif_method,
+            method_options=pif_options, last_band_alpha=last_band_alpha,
+            window=window, decimation=decimation)
+        transformations = transformation_wrapper.generate(
+            candidate_path, reference_path, pif_mask,
+            method=transformation_method, last_band_alpha=last_band_alpha,
+            window=window, decimation=decimation)
+        wall_time = time.time() - start
+        del pif_mask
+
+        if not reports:
+            full_transformations = transformations
+            full_time = wall_time
+            # The range of the fitted pixels, read at the finest decimation
+            # compared (from overviews where the file has them) as it is
+            # much cheaper than full resolution
+            band_ranges = _band_ranges(
+                candidate_path, last_band_alpha, window,
+                min(decimations) if decimations else 1)
+
+        gain_errors = []
+        offset_errors = []
+        dn_errors = []
+        for full, reduced, band_range in zip(
+                full_transformations, transformations, band_ranges):
+            gain_error = reduced.gain - full.gain
+            offset_error = reduced.offset - full.offset
+            gain_errors.append(abs(gain_error))
+            offset_errors.append(abs(offset_error))
+            # The difference is linear in the input value, so it is largest
+            # at one end of the range
+            dn_errors.extend(abs(gain_error * value + offset_error)
+                             for value in band_range)
+
+        reports.append(DecimationReport(
+            decimation, wall_time, full_time / wall_time if wall_time else 0,
+            transformations, max(gain_errors), max(offset_errors),
+            max(dn_errors)))
+        logging.info(
+            'Pipeline: Fit at decimation {} took {:.3f}s (max DN error '
+            '{:.3f})'.format(decimation, wall_time, reports[-1].max_dn_error))
+    return reports
+
+
+def _band_ranges(image_path, last_band_alpha, window, decimation):
+    # The (min, max) of the valid pixels of each band in the window
+    img_ds, img_alpha, band_count = gimage.open_image_and_get_info(
+        image_path, last_band_alpha, window=window, decimation=decimation)
+    band_ranges = []
+    band_reads = [(band_no, window) for band_no in range(1, band_count + 1)]
+    for band, in gimage.prefetch_bands([img_ds], band_reads,
+                                       decimation=decimation):
+        valid = band[img_alpha] if img_alpha.any() else band
+        band_ranges.append((valid.min(), valid.max()))
+    return band_ranges
+
+
+def format_decimation_report(reports, title=None):
+    ''' Formats a list of DecimationReports as a plain text table.
+
+    :param list reports: A list of DecimationReports
+    :param str title: [Optional] A line to print above the table
+
+    :returns: The table as a string
+    '''
+    row_format = '{:>10} {:>14} {:>8} {:>12} {:>12} {:>12}'
+    lines = []
+    if title:
+        lines.append(title)
+    lines.append(row_format.format(
+        'decimation', 'wall time (s)', 'speedup', 'gain error',
+        'offset error', 'DN error'))
+    for report in reports:
+        lines.append(row_format.format(
+            report.decimation, '{:.3f}'.format(report.wall_time),
+            '{:.1f}x'.format(report.speedup),
+            '{:.5f}'.format(report.max_gain_error),
+            '{:.3f}'.format(report.max_offset_error),
+            '{:.3f}'.format(report.max_dn_error)))
+    return '\n'.join(lines)
+
+
+def run_manifest(manifest_path, workers=1, **kwargs):
+    ''' Runs the pipeline for every pair in a manifest.
+
+    The manifest is a CSV file with one candidate_path, reference_path,
+    output_path row per pair. Pairs are run in a pool of worker processes so
+    each pair's peak RSS is measured in its own process.
+
+    :param str manifest_path: Path to the manifest
+    :param int workers: The number of worker processes
+    :param kwargs: Passed through to run
+
+    :returns: A list of PipelineResults in manifest order
+    '''
+    jobs = [(pair, kwargs) for pair in read_manifest(manifest_path)]
+    logging.info('Pipeline: Running {} pairs with {} workers'.format(
+        len(jobs), workers))
+
+    if workers <= 1:
+        return [_run_job(job) for job in jobs]
+
+    # maxtasksperchild keeps the peak RSS of one pair from leaking into the
+    # next pair's report
+    pool = Pool(workers, maxtasksperchild=1)
+    try:
+        return pool.map(_run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_manifest(manifest_path):
+    ''' Reads a manifest of candidate_path, reference_path, output_path rows,
+    skipping blank lines and lines starting with #.
+
+    :param str manifest_path: Path to the manifest
+
+    :returns: A list of (candidate_path, reference_path, output_path) tuples
+    '''
+    pairs = []
+    with open(manifest_path) as manifest_file:
+        for row in csv.reader(manifest_file):
+            if not row or row[0].strip().startswith('#'):
+                continue
+            if len(row) != 3:
+                raise Exception(
+                    'Manifest row {} does not have three columns '
+                    '(candidate, reference, output)'.format(row))
+            pairs.append(tuple(column.strip() for column in row))
+    return pairs
+
+
+def _run_job(job):
+    (candidate_path, reference_path, output_path), kwargs = job
+    return run(candidate_path, reference_path, output_path, **kwargs)
@@ -0,0 +1,346 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import logging
+
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization import histogram
+from radiometric_normalization import instrumentation
+from radiometric_normalization import pif
+from radiometric_normalization import profiling
+from radiometric_normalization import time_stack
+from radiometric_normalization import transformation
+from radiometric_normalization import validation
+from radiometric_normalization.wrappers import normalize_wrapper
+from radiometric_normalization.wrappers import pipeline_wrapper
+
+
+'''
+Normalization of a candidate to the mean of a time stack, with the time stack
+fused into PIF generation and the fit.
+
+The unfused workflow writes the reference with time_stack.generate and reads
+it back in pif_wrapper.generate and transformation_wrapper.generate. Here each
+strip of the reference is used as soon as it has been averaged:
+
+- With the filter_alpha PIF method and a linear (or gridded) transformation,
+  the PIF mask and the fit's statistics are accumulated strip by strip, so
+  neither the reference nor the time stack's sums are ever held whole.
+- The filter_PCA and filter_robust methods and histogram matching fit to all
+  of a band's PIFs at once, so the reference bands are assembled in memory
+  (as the unfused path reads them) but never written and read back.
+
+The reference is only written to disk if a reference_path is given.
+'''
+
+# The number of rows of the time stack averaged at a time
+TIME_STACK_BLOCK_ROWS = 256
+
+# The pixel list filter of each PIF method that fits to whole bands
+_PIF_FILTERS = {
+    'filter_PCA': (pif.generate_pca_pifs_pixel_list,
+                   pif.DEFAULT_PCA_OPTIONS),
+    'filter_robust': (pif.generate_robust_pifs_pixel_list,
+                      pif.DEFAULT_ROBUST_OPTIONS),
+}
+
+
+def run(candidate_path, image_paths, output_path, reference_path=None,
+        pif_method='filter_alpha', pif_options=None,
+        transformation_method='linear_relationship', last_band_alpha=False,
+        block_rows=None, writer_options=None, validate=True,
+        prefetch_depth=1, window=None, bbox=None, image_nodata=None,
+        grid_cell_size=None, grid_smoothing=1):
+    ''' Runs the pipeline (as pipeline_wrapper.run) for a candidate against
+    the mean of a time stack of images (as time_stack.generate), without
+    writing the mean to disk unless reference_path is given.
+
+    :param str candidate_path: Path to the candidate image
+    :param list image_paths: Paths to the time stack images (on the
+        candidate's grid)
+    :param str output_path: Path to write the normalized candidate image to
+    :param str reference_path: [Optional] Path to write the time stack mean
+        to (as time_stack.generate does)
+    :param str pif_method: 'filter_alpha', 'filter_PCA' or 'filter_robust'
+    :param object pif_options: The options of the PIF method
+    :param str transformation_method: 'linear_relationship' or
+        'histogram_matching'
+    :param bool last_band_alpha: Treat the candidate's last band as an alpha
+        band
+    :param int block_rows: [Optional] If given, the normalized image is
+        written a strip of block_rows rows at a time
+    :param gimage.writer_options writer_options: [Optional] How to lay out
+        the normalized image file
+    :param bool validate: Whether to score the normalized image against the
+        reference (only if reference_path is given, as the reference is not
+        kept otherwise)
+    :param int prefetch_depth: The number of candidate bands (or strips) to
+        read ahead on background threads
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        of the candidate to normalize instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to normalize (instead of window)
+    :param int image_nodata: [Optional] A no data value of the time stack
+        images
+    :param int grid_cell_size: [Optional] Fit a linear relationship for each
+        cell of a grid of cells this many pixels square (see
+        transformation_wrapper.generate_gridded)
+    :param int grid_smoothing: How many cells either side of a cell to fit
+        it to
+
+    :returns: A PipelineResult (its reference_path is None if the reference
+        was not written, and rmse is None if it was not validated)
+    '''
+    if pif_method != 'filter_alpha' and pif_method not in _PIF_FILTERS:
+        raise ValueError('Only the "filter_alpha", "filter_PCA" and '
+                         '"filter_robust" methods can be used with time '
+                         'stacks.')
+    if transformation_method not in ('linear_relationship',
+                                     'histogram_matching'):
+        raise NotImplementedError('Only the "linear_relationship" and '
+                                  '"histogram_matching" methods are '
+                                  'implemented.')
+    if grid_cell_size and transformation_method != 'linear_relationship':
+        raise ValueError('Gridded transformations are only fitted with the '
+                         '"linear_relationship" method.')
+
+    timings = []
+    c_ds = gimage.open_dataset(candidate_path)
+    window = gimage.resolve_window(c_ds, window, bbox)
+    if window is None:
+        window = gimage.Window(0, 0, c_ds.RasterXSize, c_ds.RasterYSize)
+    buffer_pool = gimage.BufferPool()
+
+    with profiling.timed_stage('time_stack_pif', timings):
+        streamed = pif_method == 'filter_alpha' and \
+            transformation_method == 'linear_relationship'
+        reference_strips = _reference_strips(
+            image_paths, reference_path, window, image_nodata)
+        if streamed:
+            transformations = _fit_streamed(
+                candidate_path, reference_strips, window, last_band_alpha,
+                grid_cell_size, grid_smoothing, buffer_pool, prefetch_depth)
+        else:
+            reference_bands, combined_alpha = _assemble_reference(
+                candidate_path, reference_strips, window, last_band_alpha)
+            pif_mask = _generate_pifs(
+                c_ds, reference_bands, combined_alpha, pif_method,
+                pif_options, window, buffer_pool, prefetch_depth)
+
+    if not streamed:
+        with profiling.timed_stage('transformation', timings):
+            transformations = _fit_in_memory(
+                c_ds, reference_bands, pif_mask, transformation_method,
+                grid_cell_size, grid_smoothing, window, buffer_pool,
+                prefetch_depth)
+        del reference_bands, pif_mask
+
+    if block_rows:
+        with profiling.timed_stage('normalize', timings):
+            normalize_wrapper.generate_to_file(
+                candidate_path, output_path, transformations,
+                last_band_alpha=last_band_alpha, block_rows=block_rows,
+                options=writer_options, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window)
+    else:
+        with profiling.timed_stage('normalize', timings):
+            normalized_gimg = normalize_wrapper.generate(
+                candidate_path, transformations,
+                last_band_alpha=last_band_alpha, buffer_pool=buffer_pool,
+                prefetch_depth=prefetch_depth, window=window)
+        with profiling.timed_stage('save', timings):
+            gimage.save(normalized_gimg, output_path, options=writer_options)
+        del normalized_gimg
+
+    rmse = None
+    if validate and reference_path is not None:
+        with profiling.timed_stage('validate', timings):
+            rmse = validation.sum_of_rmse(gimage.load(output_path),
+                                          gimage.load(reference_path))
+    buffer_pool.clear()
+    instrumentation.flush()
+
+    return pipeline_wrapper.PipelineResult(
+        candidate_path, reference_path, output_path, transformations, rmse,
+        timings)
+
+
+def _reference_strips(image_paths, reference_path, window, image_nodata):
+    ''' Averages the time stack a strip at a time, writing each strip to
+    reference_path (if given) as it is made.
+
+    :returns: A generator of (yoff, bands, alpha) tuples (see
+        time_stack.mean_with_uniform_weight_blocks)
+    '''
+    strips = time_stack.mean_with_uniform_weight_blocks(
+        image_paths, numpy.uint16, image_nodata, window,
+        TIME_STACK_BLOCK_ROWS)
+    if reference_path is None:
+        for strip in strips:
+            yield strip
+        return
+
+    metadata = gimage.window_metadata(
+        gimage.read_metadata(gimage.open_dataset(image_paths[0])), window)
+    band_count = gimage.image_band_count(
+        gimage.open_dataset(image_paths[0]))
+    # Written uncompressed, as time_stack.generate does
+    with gimage.GImageWriter(
+            reference_path, window.xsize, window.ysize, band_count,
+            metadata, options=gimage.DEFAULT_WRITER_OPTIONS._replace(
+                compression=None)) as writer:
+        for yoff, bands, alpha in strips:
+            writer.write_block(bands, alpha, 0, yoff)
+            yield yoff, bands, alpha
+
+
+def _fit_streamed(candidate_path, reference_strips, window, last_band_alpha,
+                  grid_cell_size, grid_smoothing, buffer_pool,
+                  prefetch_depth):
+    ''' Fits the transformations to every pixel valid in both the candidate
+    and the reference (the filter_alpha PIFs) as the reference strips are
+    made, keeping only a joint histogram (or the cell moments) of each band.
+
+    :returns: A list of transformations (one for each band)
+    '''
+    c_ds, c_alpha, band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window)
+    if grid_cell_size:
+        statistics = [transformation.CellMoments(c_alpha.shape,
+                                                 grid_cell_size)
+                      for _ in range(band_count)]
+    else:
+        statistics = [histogram.JointHistogram() for _ in range(band_count)]
+
+    strip_reads = [(band_no, (window.xoff, window.yoff + yoff, window.xsize,
+                              rows))
+                   for yoff, rows in gimage.iter_row_blocks(
+                       window.ysize, TIME_STACK_BLOCK_ROWS)
+                   for band_no in range(1, band_count + 1)]
+    c_bands = gimage.prefetch_bands([c_ds], strip_reads,
+                                    prefetch_depth * band_count, buffer_pool)
+    no_pifs = 0
+    try:
+        for yoff, r_bands, r_alpha in reference_strips:
+            _assert_consistent(band_count, r_bands)
+            rows = r_alpha.shape[0]
+            pif_mask = numpy.logical_and(c_alpha[yoff:yoff + rows],
+                                         r_alpha != 0)
+            no_pifs += numpy.count_nonzero(pif_mask)
+            for band_statistics, r_band in zip(statistics, r_bands):
+                c_band, = next(c_bands)
+                if grid_cell_size:
+                    band_statistics.update(c_band, r_band, pif_mask,
+                                           yoff=yoff)
+                else:
+                    band_statistics.update(c_band[pif_mask],
+                                           r_band[pif_mask])
+                buffer_pool.release(c_band)
+    finally:
+        c_bands.close()
+    logging.info('PIF: Found {} final pifs out of {} pixels'.format(
+        no_pifs, c_alpha.size))
+
+    if grid_cell_size:
+        return [transformation.generate_gridded_linear_relationship(
+            cell_moments, smoothing=grid_smoothing)
+            for cell_moments in statistics]
+    return [transformation.generate_linear_relationship_histogram(
+        joint_histogram) for joint_histogram in statistics]
+
+
+def _assemble_reference(candidate_path, reference_strips, window,
+                        last_band_alpha):
+    ''' Collects the reference strips into whole bands.
+
+    :returns: The reference bands and the mask of pixels valid in both the
+        candidate and the reference
+    '''
+    _, c_alpha, band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window)
+    reference_bands = [numpy.empty(c_alpha.shape, dtype=numpy.uint16)
+                       for _ in range(band_count)]
+    combined_alpha = numpy.array(c_alpha, dtype=numpy.bool)
+    for yoff, r_bands, r_alpha in reference_strips:
+        _assert_consistent(band_count, r_bands)
+        rows = r_alpha.shape[0]
+        for reference_band, r_band in zip(reference_bands, r_bands):
+            reference_band[yoff:yoff + rows] = r_band
+        combined_alpha[yoff:yoff + rows] &= r_alpha != 0
+    return reference_bands, combined_alpha
+
+
+def _generate_pifs(c_ds, reference_bands, combined_alpha, pif_method,
+                   pif_options, window, buffer_pool, prefetch_depth):
+    ''' Filters the valid pixels band by band (as pif_wrapper.generate does)
+    against the reference bands in memory.
+
+    :returns: The PIF mask
+    '''
+    if pif_method == 'filter_alpha':
+        return pif.generate_mask_pifs(combined_alpha)
+
+    pixel_list_filter, default_options = _PIF_FILTERS[pif_method]
+    parameters = pif_options if pif_options else default_options
+    pif_indices = pif.mask_to_pif_indices(combined_alpha)
+    band_reads = [(band_no, window)
+                  for band_no in range(1, len(reference_bands) + 1)]
+    for reference_band, (c_band,) in zip(
+            reference_bands, gimage.prefetch_bands(
+                [c_ds], band_reads, prefetch_depth, buffer_pool)):
+        if len(pif_indices):
+            pif_indices = pif.filter_pif_indices(
+                c_band, reference_band, pif_indices, pixel_list_filter,
+                parameters)
+        buffer_pool.release(c_band)
+    logging.info('PIF: Found {} final pifs out of {} pixels'.format(
+        len(pif_indices), combined_alpha.size))
+    return pif.pif_indices_to_mask(pif_indices, combined_alpha.shape)
+
+
+def _fit_in_memory(c_ds, reference_bands, pif_mask, transformation_method,
+                   grid_cell_size, grid_smoothing, window, buffer_pool,
+                   prefetch_depth):
+    ''' Fits the transformations to the PIFs against the reference bands in
+    memory.
+
+    :returns: A list of transformations (one for each band)
+    '''
+    transformations = []
+    band_reads = [(band_no, window)
+                  for band_no in range(1, len(reference_bands) + 1)]
+    for reference_band, (c_band,) in zip(
+            reference_bands, gimage.prefetch_bands(
+                [c_ds], band_reads, prefetch_depth, buffer_pool)):
+        if grid_cell_size:
+            cell_moments = transformation.CellMoments(pif_mask.shape,
+                                                      grid_cell_size)
+            cell_moments.update(c_band, reference_band, pif_mask)
+            transformations.append(
+                transformation.generate_gridded_linear_relationship(
+                    cell_moments, smoothing=grid_smoothing))
+        elif transformation_method == 'histogram_matching':
+            transformations.append(
+                transformation.generate_histogram_matching(
+                    c_band, reference_band, pif_mask))
+        else:
+            transformations.append(
+                transformation.generate_linear_relationship(
+                    c_band, reference_band, pif_mask))
+        buffer_pool.release(c_band)
+    return transformations
+
+
+def _assert_consistent(band_count, reference_bands):
+    assert band_count == len(reference_bands)
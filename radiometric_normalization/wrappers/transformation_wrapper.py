@@ -10,52 +10,181 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-from osgeo import gdal
+import logging
 
 from radiometric_normalization import gimage
 from radiometric_normalization import transformation
 
 
+# The function that fits each band for each method
+_BAND_METHODS = {
+    'linear_relationship': transformation.generate_linear_relationship,
+    'histogram_matching': transformation.generate_histogram_matching,
+}
+
+
 def generate(candidate_path, reference_path, pif_mask,
-             method='linear_relationship', last_band_alpha=False):
+             method='linear_relationship', last_band_alpha=False,
+             buffer_pool=None, prefetch_depth=1, window=None, bbox=None,
+             decimation=1, joint_histograms=None, cache=None):
     ''' Calculates the transformations between the PIF pixels of the candidate
     image and PIF pixels of the reference image.
 
     :param str candidate_path: Path to the candidate image
     :param str reference_path: Path to the reference image
     :param array pif_mask: A boolean array in the same coordinate system of the
-        candidate/reference image (True for the PIF)
-    :param str method: Which method to find the transformation
+        candidate/reference image (or of the window, decimated) (True for
+        the PIF)
+    :param str method: Which method to find the transformation:
+        'linear_relationship' (a LinearTransformation per band) or
+        'histogram_matching' (a LutTransformation per band, for integer
+        images of 16 bits or fewer)
+    :param gimage.BufferPool buffer_pool: [Optional] A pool to read bands
+        into (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of bands to read ahead on background
+        threads (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to process instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to process (instead of window)
+    :param int decimation: [Optional] Work on a reduced raster of every
+        decimation-th row and column (read from overviews where the files
+        have them)
+    :param list joint_histograms: [Optional] Joint histograms of the PIF
+        pixels of each band (see histogram_wrapper.generate). If given, the
+        transformations are calculated from them without reading the images
+    :param result_cache.ResultCache cache: [Optional] A cache to serve the
+        transformations from if they have been fitted to the same images,
+        PIF mask and method before (and to store them in otherwise)
 
-    :returns: A list of linear transformations (one for each band)
+    :returns: A list of transformations (one for each band)
     '''
-    if method == 'linear_relationship':
-        c_ds, c_alpha, c_band_count = _open_image_and_get_info(
-            candidate_path, last_band_alpha)
-        r_ds, r_alpha, r_band_count = _open_image_and_get_info(
-            reference_path, last_band_alpha)
-
-        _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
-
-        transformations = []
-        for band_no in range(1, c_band_count + 1):
-            c_band = gimage.read_single_band(c_ds, band_no)
-            r_band = gimage.read_single_band(r_ds, band_no)
-            transformations.append(
-                transformation.generate_linear_relationship(
-                    c_band, r_band, pif_mask))
-    else:
-        raise NotImplementedError('Only "linear_relationship" '
-                                  'method is implemented.')
+    if joint_histograms is not None:
+        if method != 'linear_relationship':
+            raise ValueError('Only the "linear_relationship" method can use '
+                             'joint histograms.')
+        return [
+            transformation.generate_linear_relationship_histogram(
+                joint_histogram)
+            for joint_histogram in joint_histograms]
+
+    if method not in _BAND_METHODS:
+        raise NotImplementedError('Only the "linear_relationship" and '
+                                  '"histogram_matching" methods are '
+                                  'implemented.')
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+
+    # Only linear transformations are cached
+    if cache is not None and method != 'linear_relationship':
+        cache = None
+    if cache is not None:
+        cache_key = cache.key(
+            'transformations', [candidate_path, reference_path],
+            pif_mask=pif_mask, method=method,
+            last_band_alpha=last_band_alpha, window=window,
+            decimation=decimation)
+        transformations = cache.get_transformations(cache_key)
+        if transformations is not None:
+            logging.info('Transformation: Using the cached transformations')
+            return transformations
+
+    c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window,
+        decimation=decimation)
+    r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+        reference_path, last_band_alpha, window=window,
+        decimation=decimation)
 
+    _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
+
+    transformations = []
+    band_reads = [(band_no, window)
+                  for band_no in range(1, c_band_count + 1)]
+    for c_band, r_band in gimage.prefetch_bands(
+            [c_ds, r_ds], band_reads, prefetch_depth, buffer_pool,
+            decimation):
+        transformations.append(
+            _BAND_METHODS[method](c_band, r_band, pif_mask))
+        buffer_pool.release(c_band)
+        buffer_pool.release(r_band)
+
+    if cache is not None:
+        cache.put_transformations(cache_key, transformations)
     return transformations
 
 
-def _open_image_and_get_info(path, last_band_alpha):
-    gdal_ds = gdal.Open(path)
-    alpha_band, band_count = gimage.read_alpha_and_band_count(
-        gdal_ds, last_band_alpha=last_band_alpha)
-    return gdal_ds, alpha_band, band_count
+def generate_gridded(candidate_path, reference_path, pif_mask, cell_size,
+                     smoothing=1, min_pifs=100, last_band_alpha=False,
+                     block_rows=256, buffer_pool=None, prefetch_depth=1,
+                     window=None, bbox=None):
+    ''' Calculates spatially varying transformations between the PIF pixels
+    of the candidate image and PIF pixels of the reference image: a linear
+    relationship for each cell of a grid over the images, so drifts in
+    illumination across a large scene are corrected.
+
+    The images are read once, a strip of rows at a time, and only the sums
+    of the PIF values in each cell are kept.
+
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param array pif_mask: A boolean array in the same coordinate system of the
+        candidate/reference image (or of the window) (True for the PIF)
+    :param int cell_size: The width and height of the grid cells in pixels
+    :param int smoothing: How many cells either side of a cell to fit it to
+        (see transformation.generate_gridded_linear_relationship)
+    :param int min_pifs: The fewest PIFs a cell is fitted to
+    :param int block_rows: The number of rows to read at a time
+    :param gimage.BufferPool buffer_pool: [Optional] A pool for the strip
+        buffers (a pool is made for the call if one is not given)
+    :param int prefetch_depth: The number of strips to read ahead on a
+        background thread (0 to read in the calling thread)
+    :param tuple window: [Optional] An (xoff, yoff, xsize, ysize) pixel window
+        to process instead of the whole image
+    :param tuple bbox: [Optional] A (min_x, min_y, max_x, max_y) bounding box
+        in the candidate's coordinate system to process (instead of window)
+
+    :returns: A list of GriddedTransformations (one for each band)
+    '''
+    if buffer_pool is None:
+        buffer_pool = gimage.BufferPool()
+    window = gimage.resolve_window(
+        gimage.open_dataset(candidate_path), window, bbox)
+    c_ds, c_alpha, c_band_count = gimage.open_image_and_get_info(
+        candidate_path, last_band_alpha, window=window)
+    r_ds, r_alpha, r_band_count = gimage.open_image_and_get_info(
+        reference_path, last_band_alpha, window=window)
+
+    _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count)
+
+    if window is None:
+        window = gimage.Window(0, 0, c_ds.RasterXSize, c_ds.RasterYSize)
+    cell_moments = [transformation.CellMoments(pif_mask.shape, cell_size)
+                    for _ in range(c_band_count)]
+    strips = list(gimage.iter_row_blocks(window.ysize, block_rows))
+    strip_reads = [(band_no, (window.xoff, window.yoff + yoff,
+                              window.xsize, rows))
+                   for yoff, rows in strips
+                   for band_no in range(1, c_band_count + 1)]
+    band_iterator = gimage.prefetch_bands(
+        [c_ds, r_ds], strip_reads, prefetch_depth * c_band_count,
+        buffer_pool)
+    try:
+        for yoff, rows in strips:
+            for moments in cell_moments:
+                c_band, r_band = next(band_iterator)
+                moments.update(c_band, r_band, pif_mask[yoff:yoff + rows],
+                               yoff=yoff)
+                buffer_pool.release(c_band)
+                buffer_pool.release(r_band)
+    finally:
+        band_iterator.close()
+
+    return [transformation.generate_gridded_linear_relationship(
+        moments, smoothing=smoothing, min_pifs=min_pifs)
+        for moments in cell_moments]
 
 
 def _assert_consistent(c_alpha, r_alpha, c_band_count, r_band_count):
@@ -0,0 +1,364 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import json
+import logging
+import os
+import time
+import traceback
+import uuid
+from multiprocessing import Pool
+
+from radiometric_normalization import gimage
+from radiometric_normalization import instrumentation
+from radiometric_normalization import pif
+from radiometric_normalization import transformation
+from radiometric_normalization.wrappers import pipeline_wrapper
+
+
+'''
+A job queue in a directory, served by a long lived worker (serve) that runs
+the pipeline (pipeline_wrapper.run) for each job.
+
+Each job is a JSON file that moves through four subdirectories:
+
+- pending: Submitted jobs, claimed oldest first
+- running: Jobs a worker has claimed
+- done: Finished jobs, with their results and latencies
+- failed: Jobs that raised, with the traceback
+
+Files are written under a temporary name and renamed into place, and a job is
+claimed by renaming it from pending to running, so several submitters and
+workers can share a queue without locks.
+
+The worker's processes live as long as it does, so the imports are paid once
+and each process keeps the datasets and alpha masks of the images it has
+read open (see gimage.DatasetCache). Jobs that share a reference scene only
+read its alpha mask once per process.
+'''
+
+QUEUE_STATES = ['pending', 'running', 'done', 'failed']
+
+# The pif_options type of each PIF method, to rebuild them from JSON
+_PIF_OPTION_TYPES = {
+    'filter_PCA': pif.pca_options,
+    'filter_robust': pif.robust_options,
+    'filter_joint_PCA': pif.joint_pca_options,
+}
+
+
+def init_queue(queue_dir):
+    ''' Creates the queue's subdirectories (if they do not already exist).
+
+    :param str queue_dir: The queue directory
+    '''
+    for state in QUEUE_STATES:
+        path = os.path.join(queue_dir, state)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def submit(queue_dir, candidate_path, reference_path, output_path,
+           max_pending=None, **kwargs):
+    ''' Adds a job to the queue.
+
+    :param str queue_dir: The queue directory
+    :param str candidate_path: Path to the candidate image
+    :param str reference_path: Path to the reference image
+    :param str output_path: Path to write the normalized candidate image to
+    :param int max_pending: [Optional] Refuse the job if this many jobs are
+        already waiting, so submitters cannot outrun the workers
+    :param kwargs: Passed through to pipeline_wrapper.run
+
+    :returns: The job's id
+    '''
+    init_queue(queue_dir)
+    if max_pending is not None and \
+            len(_job_ids(queue_dir, 'pending')) >= max_pending:
+        raise Exception('Queue {} already has {} pending jobs'.format(
+            queue_dir, max_pending))
+
+    # Ids sort in submission order
+    job_id = '{:017.6f}-{}'.format(time.time(), uuid.uuid4().hex[:8])
+    job = {'id': job_id,
+           'candidate_path': os.path.abspath(candidate_path),
+           'reference_path': os.path.abspath(reference_path),
+           'output_path': os.path.abspath(output_path),
+           'options': _encode_options(kwargs),
+           'submitted_at': time.time()}
+    _write_record(queue_dir, 'pending', job_id, job)
+    logging.info('Worker: Submitted job {}'.format(job_id))
+    return job_id
+
+
+def claim(queue_dir):
+    ''' Claims the oldest pending job by moving it to running.
+
+    :param str queue_dir: The queue directory
+
+    :returns: The job (a dict) or None if no job is pending
+    '''
+    for job_id in _job_ids(queue_dir, 'pending'):
+        running_path = _record_path(queue_dir, 'running', job_id)
+        try:
+            os.rename(_record_path(queue_dir, 'pending', job_id),
+                      running_path)
+        except OSError:
+            # Another worker claimed it first
+            continue
+        with open(running_path) as job_file:
+            return json.load(job_file)
+    return None
+
+
+def complete(queue_dir, job, result=None, error=None):
+    ''' Records a claimed job's outcome, moving it to done (or to failed if
+    an error is given).
+
+    :param str queue_dir: The queue directory
+    :param dict job: The claimed job
+    :param dict result: [Optional] The job's result
+    :param str error: [Optional] The traceback of a failed job
+
+    :returns: The completed job (a dict)
+    '''
+    job = dict(job, finished_at=time.time())
+    if error is None:
+        job['result'] = result
+        state = 'done'
+    else:
+        job['error'] = error
+        state = 'failed'
+    _write_record(queue_dir, state, job['id'], job)
+    os.remove(_record_path(queue_dir, 'running', job['id']))
+    return job
+
+
+def status(queue_dir):
+    ''' Counts the jobs in each state.
+
+    :param str queue_dir: The queue directory
+
+    :returns: A dict of the number of jobs in each of QUEUE_STATES
+    '''
+    return dict((state, len(_job_ids(queue_dir, state)))
+                for state in QUEUE_STATES)
+
+
+def read_job(queue_dir, job_id):
+    ''' Finds a job in the queue.
+
+    :param str queue_dir: The queue directory
+    :param str job_id: The job's id (from submit)
+
+    :returns: The job's state and the job (a dict), or (None, None) if the
+        job is not in the queue
+    '''
+    for state in QUEUE_STATES:
+        try:
+            with open(_record_path(queue_dir, state, job_id)) as job_file:
+                return state, json.load(job_file)
+        except (IOError, OSError):
+            continue
+    return None, None
+
+
+def requeue_running(queue_dir):
+    ''' Moves the running jobs back to pending, e.g. after a worker was
+    killed. Only call this when no worker is serving the queue.
+
+    :param str queue_dir: The queue directory
+
+    :returns: The number of jobs requeued
+    '''
+    job_ids = _job_ids(queue_dir, 'running')
+    for job_id in job_ids:
+        os.rename(_record_path(queue_dir, 'running', job_id),
+                  _record_path(queue_dir, 'pending', job_id))
+    if job_ids:
+        logging.info('Worker: Requeued {} running jobs'.format(len(job_ids)))
+    return len(job_ids)
+
+
+def serve(queue_dir, workers=1, poll_interval=0.1, max_jobs=None,
+          idle_timeout=None, dataset_cache_size=16):
+    ''' Runs queued jobs until stopped (or until max_jobs have run or the
+    queue has been idle for idle_timeout seconds).
+
+    At most workers jobs are claimed at a time, so the rest stay pending
+    (and can be claimed by other workers) until a process is free.
+
+    A done record holds the job's submission, start and finish times. Its
+    queue wait, run time and latency (submission to completion) are logged
+    and, if an instrumentation sink is installed, recorded as the
+    worker.queue_wait, worker.run_time and worker.latency timers.
+
+    :param str queue_dir: The queue directory
+    :param int workers: The number of jobs to run at once (each in its own
+        long lived process)
+    :param float poll_interval: Seconds to wait between checks of the queue
+        when nothing has changed
+    :param int max_jobs: [Optional] Stop after this many jobs
+    :param float idle_timeout: [Optional] Stop once no job has been pending
+        or running for this many seconds
+    :param int dataset_cache_size: The number of images each process keeps
+        open
+
+    :returns: The number of jobs run
+    '''
+    init_queue(queue_dir)
+    logging.info('Worker: Serving {} with {} processes'.format(
+        queue_dir, workers))
+    pool = Pool(workers, initializer=_initialize_process,
+                initargs=(dataset_cache_size,))
+    running = []
+    jobs_run = 0
+    last_busy = time.time()
+    try:
+        while True:
+            changed = False
+            for job, pending_result in list(running):
+                if pending_result.ready():
+                    running.remove((job, pending_result))
+                    try:
+                        outcome = pending_result.get()
+                    except Exception:
+                        # E.g. a result that could not be sent back from the
+                        # process; only this job fails
+                        outcome = {'error': traceback.format_exc()}
+                    _finish(queue_dir, job, outcome)
+                    jobs_run += 1
+                    changed = True
+
+            while len(running) < workers and (
+                    max_jobs is None or jobs_run + len(running) < max_jobs):
+                job = claim(queue_dir)
+                if job is None:
+                    break
+                job['started_at'] = time.time()
+                running.append((job, pool.apply_async(_run_job, (job,))))
+                changed = True
+
+            if running:
+                last_busy = time.time()
+            elif max_jobs is not None and jobs_run >= max_jobs:
+                break
+            elif idle_timeout is not None and \
+                    time.time() - last_busy > idle_timeout:
+                break
+            if not changed:
+                time.sleep(poll_interval)
+    finally:
+        pool.close()
+        pool.join()
+    logging.info('Worker: Ran {} jobs'.format(jobs_run))
+    return jobs_run
+
+
+def _initialize_process(dataset_cache_size):
+    gimage.DEFAULT_DATASET_CACHE.max_entries = dataset_cache_size
+
+
+def _run_job(job):
+    # Runs in a pool process, so errors are returned rather than raised to
+    # keep their tracebacks
+    try:
+        result = pipeline_wrapper.run(
+            job['candidate_path'], job['reference_path'], job['output_path'],
+            **_decode_options(job['options']))
+        # Built here too, so a result that cannot be encoded fails the job
+        return {
+            'transformations': [transformation.transformation_to_json(t)
+                                for t in result.transformations],
+            'rmse': None if result.rmse is None else float(result.rmse),
+            'timings': [dict(timing._asdict()) for timing in result.timings]}
+    except Exception:
+        return {'error': traceback.format_exc()}
+
+
+def _finish(queue_dir, job, outcome):
+    error = outcome.pop('error', None)
+    try:
+        job = complete(queue_dir, job, None if error else outcome, error)
+    except Exception:
+        # A result that cannot be recorded fails the job rather than the
+        # worker
+        error = traceback.format_exc()
+        job = complete(queue_dir, job, error=error)
+    if error:
+        instrumentation.increment('worker.jobs_failed')
+        logging.error('Worker: Job {} failed:\n{}'.format(job['id'], error))
+        return
+
+    latencies = {
+        'queue_wait': job['started_at'] - job['submitted_at'],
+        'run_time': job['finished_at'] - job['started_at'],
+        'latency': job['finished_at'] - job['submitted_at']}
+    for name, seconds in latencies.items():
+        instrumentation.record_time('worker.{}'.format(name), seconds)
+    instrumentation.increment('worker.jobs_done')
+    instrumentation.flush()
+    logging.info('Worker: Job {} done in {:.3f}s ({:.3f}s queued, {:.3f}s '
+                 'running)'.format(job['id'], latencies['latency'],
+                                   latencies['queue_wait'],
+                                   latencies['run_time']))
+
+
+def _encode_options(kwargs):
+    options = {}
+    for name, value in kwargs.items():
+        if name in ('window', 'bbox') and value is not None:
+            value = list(value)
+        elif hasattr(value, '_asdict'):
+            value = dict(value._asdict())
+        options[name] = value
+    return options
+
+
+def _decode_options(options):
+    options = dict(options)
+    if options.get('pif_options') is not None:
+        option_type = _PIF_OPTION_TYPES[options.get('pif_method')]
+        options['pif_options'] = option_type(**options['pif_options'])
+    if options.get('writer_options') is not None:
+        options['writer_options'] = gimage.writer_options(
+            **options['writer_options'])
+    for name in ('window', 'bbox'):
+        if options.get(name) is not None:
+            options[name] = tuple(options[name])
+    return options
+
+
+def _job_ids(queue_dir, state):
+    try:
+        names = os.listdir(os.path.join(queue_dir, state))
+    except OSError:
+        return []
+    return sorted(name[:-len('.json')] for name in names
+                  if name.endswith('.json'))
+
+
+def _record_path(queue_dir, state, job_id):
+    return os.path.join(queue_dir, state, '{}.json'.format(job_id))
+
+
+def _write_record(queue_dir, state, job_id, record):
+    # Written outside the state directories and renamed in, so a record is
+    # never seen half written
+    temporary_path = os.path.join(
+        queue_dir, '.{}.{}.tmp'.format(job_id, os.getpid()))
+    # Encoded before the file is opened, so a record that cannot be encoded
+    # does not leave a temporary file behind
+    contents = json.dumps(record, indent=2, sort_keys=True)
+    with open(temporary_path, 'w') as record_file:
+        record_file.write(contents)
+    os.rename(temporary_path, _record_path(queue_dir, state, job_id))
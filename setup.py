@@ -24,13 +24,21 @@ VERSION = '0.1.%s' % patch
 
 config = dict(
     name='radiometric_normalization',
-    packages=['radiometric_normalization'],
+    packages=['radiometric_normalization',
+              'radiometric_normalization.wrappers'],
     version=VERSION,
     url='https://github.com/planetlabs/radiometric_normalization',
     description='Radiometric Normalization',
     author='Arin Jumpasut',
     author_email='arin.jumpasut@planet.com',
     install_requires=parse_requirements(),
+    entry_points={
+        'console_scripts': [
+            'radiometric_normalization = radiometric_normalization.cli:main',
+            'radiometric_normalization_worker = '
+            'radiometric_normalization.worker_cli:main',
+        ],
+    },
     classifiers=[
         "Development Status :: 1 - Planning",
         "License :: OSI Approved :: Apache Software License",
@@ -0,0 +1,120 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import pif
+from radiometric_normalization import transformation
+from radiometric_normalization.transformation import LinearTransformation
+from radiometric_normalization.wrappers import batch_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.directory, 'state')
+        os.makedirs(self.state_dir)
+        self.pair = tuple(os.path.join(self.directory, name) for name in
+                          ('candidate.tif', 'reference.tif', 'output.tif'))
+        for path in self.pair:
+            with open(path, 'w') as image_file:
+                image_file.write('image')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_completed(self):
+        options = {'pif_method': 'filter_PCA',
+                   'pif_options': pif.pca_options(30, False)}
+        self.assertEqual(
+            batch_wrapper.completed(self.state_dir, self.pair, **options),
+            None)
+
+        batch_wrapper._write_record(self.state_dir, self.pair, {
+            'inputs': batch_wrapper._input_identity(self.pair, options),
+            'transformations': [[1.5, -2.0]],
+            'rmse': 3.0,
+            'timings': [{'stage': 'pif', 'wall_time': 0.5,
+                         'peak_rss': 1024}]})
+
+        result = batch_wrapper.completed(self.state_dir, self.pair, **options)
+        self.assertEqual(result.output_path, self.pair[2])
+        self.assertEqual(result.transformations,
+                         [LinearTransformation(1.5, -2.0)])
+        self.assertEqual(result.rmse, 3.0)
+        self.assertEqual(result.timings[0].stage, 'pif')
+
+        # Options that do not change the output do not matter
+        self.assertNotEqual(batch_wrapper.completed(
+            self.state_dir, self.pair, prefetch_depth=4, **options), None)
+
+        # Other options, rewritten images and missing outputs do
+        self.assertEqual(batch_wrapper.completed(
+            self.state_dir, self.pair, pif_method='filter_PCA',
+            pif_options=pif.pca_options(20, False)), None)
+        os.remove(self.pair[2])
+        self.assertEqual(
+            batch_wrapper.completed(self.state_dir, self.pair, **options),
+            None)
+
+    def test_completed_any_transformation(self):
+        options = {'grid_cell_size': 30}
+        transformations = [
+            transformation.LutTransformation(
+                numpy.arange(65536, dtype=numpy.uint16)),
+            transformation.GriddedTransformation(
+                numpy.array([[1.0, 2.0]]), numpy.array([[0.0, -1.5]]), 30)]
+        batch_wrapper._write_record(self.state_dir, self.pair, {
+            'inputs': batch_wrapper._input_identity(self.pair, options),
+            'transformations': [transformation.transformation_to_json(t)
+                                for t in transformations],
+            'rmse': None,
+            'timings': []})
+
+        result = batch_wrapper.completed(self.state_dir, self.pair, **options)
+        lut, gridded = result.transformations
+        numpy.testing.assert_array_equal(lut.lut, transformations[0].lut)
+        self.assertEqual(lut.lut.dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(gridded.gain, [[1.0, 2.0]])
+        numpy.testing.assert_array_equal(gridded.offset, [[0.0, -1.5]])
+        self.assertEqual(gridded.cell_size, 30)
+
+    def test_failures_are_not_recorded(self):
+        manifest_path = os.path.join(self.directory, 'pairs.csv')
+        missing_pair = (os.path.join(self.directory, 'missing.tif'),) + \
+            self.pair[1:]
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write(','.join(missing_pair) + '\n')
+
+        self.assertRaises(Exception, batch_wrapper.run, manifest_path,
+                          self.state_dir, validate=False)
+        self.assertFalse(os.path.exists(
+            batch_wrapper._record_path(self.state_dir, missing_pair)))
+
+    def test_run_rejects_checkpoint_path(self):
+        manifest_path = os.path.join(self.directory, 'pairs.csv')
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write(','.join(self.pair) + '\n')
+
+        self.assertRaises(ValueError, batch_wrapper.run, manifest_path,
+                          self.state_dir, checkpoint_path='pair.checkpoint')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import cli
+from radiometric_normalization import gimage
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        candidate_band = numpy.random.randint(100, 1000, (6, 8))
+        alpha = numpy.ones((6, 8), dtype='uint16') * 65535
+        self.candidate_path = os.path.join(self.directory, 'candidate.tif')
+        gimage.save(gimage.GImage([candidate_band.astype('uint16')], alpha,
+                                  {}), self.candidate_path)
+        self.reference_path = os.path.join(self.directory, 'reference.tif')
+        gimage.save(gimage.GImage(
+            [(2 * candidate_band + 10).astype('uint16')], alpha, {}),
+            self.reference_path)
+        self.output_path = os.path.join(self.directory, 'output.tif')
+        self.pair = ['--candidate', self.candidate_path,
+                     '--reference', self.reference_path,
+                     '--output', self.output_path]
+
+        # The report is written to stdout
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def test_build_parser(self):
+        options = cli._build_parser().parse_args(
+            self.pair + ['--pif-method', 'filter_PCA', '--pif-threshold',
+                         '20', '--window', '1', '2', '3', '4',
+                         '--deduplicate-pairs'])
+
+        self.assertEqual(options.candidate, self.candidate_path)
+        self.assertEqual(options.pif_method, 'filter_PCA')
+        self.assertEqual(options.pif_threshold, 20.0)
+        self.assertEqual(options.window, [1, 2, 3, 4])
+        self.assertTrue(options.deduplicate_pairs)
+        self.assertEqual(options.transformation_method,
+                         'linear_relationship')
+        self.assertEqual(options.fit_decimation, 1)
+
+        pif_options = cli._pif_options(options.pif_method,
+                                       options.pif_threshold,
+                                       options.deduplicate_pairs)
+        self.assertEqual(pif_options.threshold, 20.0)
+        self.assertTrue(pif_options.deduplicate)
+
+    def test_main_rejects_ignored_options(self):
+        for extra_args in [
+                ['--pif-threshold', '20'],
+                ['--deduplicate-pairs'],
+                ['--pif-method', 'filter_PCA', '--deduplicate-pairs',
+                 '--lazy'],
+                ['--cache-dir', self.directory, '--lazy'],
+                ['--cache-dir', self.directory, '--compare-decimation', '2'],
+                ['--grid-cell-size', '4', '--fit-decimation', '2'],
+                ['--window', '0', '0', '2', '2', '--bbox', '0', '0', '1',
+                 '1']]:
+            self.assertRaises(SystemExit, cli.main, self.pair + extra_args)
+        # A pair or a manifest is needed
+        self.assertRaises(SystemExit, cli.main, [])
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def test_main(self):
+        self.assertEqual(cli.main(self.pair), 0)
+
+        output = gimage.load(self.output_path)
+        reference = gimage.load(self.reference_path)
+        numpy.testing.assert_allclose(output.bands[0], reference.bands[0],
+                                      atol=1)
+
+    def test_main_compare_decimation(self):
+        self.assertEqual(cli.main(self.pair + ['--compare-decimation', '2']),
+                         0)
+        # Only the report is made
+        self.assertFalse(os.path.exists(self.output_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
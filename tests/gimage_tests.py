@@ -45,8 +45,19 @@ class Tests(unittest.TestCase):
         test_band = numpy.array([[0, 1, 2], [1, 2, 3]], dtype=numpy.uint16)
         test_mask = gimage._nodata_to_mask([test_band], 3)
 
-        expected_mask = numpy.array([[1, 1, 1], [1, 1, 0]], dtype=numpy.uint16)
+        expected_mask = numpy.array([[1, 1, 1], [1, 1, 0]], dtype=numpy.bool)
         numpy.testing.assert_array_equal(test_mask, expected_mask)
+        self.assertEqual(test_mask.dtype, numpy.bool)
+
+        # Combined with an existing alpha in place, compared a row at a time
+        other_band = numpy.array([[3, 1, 2], [1, 2, 1]], dtype=numpy.uint16)
+        alpha = numpy.array([[1, 1, 0], [1, 1, 1]], dtype=numpy.bool)
+        test_mask = gimage._nodata_to_mask(
+            [test_band, other_band], 3, out=alpha, block_rows=1)
+
+        expected_mask = numpy.array([[0, 1, 0], [1, 1, 0]], dtype=numpy.bool)
+        numpy.testing.assert_array_equal(alpha, expected_mask)
+        self.assertTrue(test_mask is alpha)
 
     def test_read_metadata(self):
         gdal_ds = gdal.Open(self.test_photometric_alpha_image)
@@ -65,6 +76,185 @@ class Tests(unittest.TestCase):
         band = gimage.read_single_band(gdal_ds, 3)
         numpy.testing.assert_array_equal(band, self.band)
 
+    def test_read_single_band_window(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        band = gimage.read_single_band(gdal_ds, 1, window=(1, 0, 1, 2))
+        numpy.testing.assert_array_equal(band, self.band[:, 1:])
+
+    def test_read_single_band_buf_obj(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        band = gimage.read_single_band(gdal_ds, 1)
+        self.assertEqual(band.dtype, numpy.uint16)
+
+        buf_obj = numpy.zeros((2, 2), dtype=numpy.float32)
+        band = gimage.read_single_band(gdal_ds, 1, buf_obj=buf_obj)
+        self.assertIs(band, buf_obj)
+        numpy.testing.assert_array_equal(band, self.band)
+
+        band = gimage.read_single_band(gdal_ds, 1, dtype=numpy.float64)
+        self.assertEqual(band.dtype, numpy.float64)
+        numpy.testing.assert_array_equal(band, self.band)
+
+    def test_save_native_dtype(self):
+        output_file = 'test_save_native_dtype.tif'
+        test_band = numpy.array([[-5, 0.5], [2.25, 100]], dtype=numpy.float32)
+        test_gimage = gimage.GImage([test_band], self.mask, self.metadata)
+        gimage.save(test_gimage, output_file)
+
+        result_gimg = gimage.load(output_file)
+        self.assertEqual(result_gimg.bands[0].dtype, numpy.float32)
+        numpy.testing.assert_array_equal(result_gimg.bands[0], test_band)
+
+        os.unlink(output_file)
+
+    def test_read_decimated(self):
+        self.assertEqual(gimage.decimated_shape((5, 4), 2), (3, 2))
+
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        band = gimage.read_single_band(gdal_ds, 1, decimation=2)
+        self.assertEqual(band.shape, (1, 1))
+        self.assertEqual(band.dtype, numpy.uint16)
+        self.assertIn(band[0, 0], self.band)
+
+        alpha, band_count = gimage.read_alpha_and_band_count(
+            gdal_ds, decimation=2)
+        self.assertEqual(band_count, 3)
+        self.assertEqual(alpha.shape, (1, 1))
+        packed_alpha, _ = gimage.read_packed_alpha_and_band_count(
+            gdal_ds, decimation=2)
+        self.assertEqual(packed_alpha.shape, (1, 1))
+
+    def test_read_packed_alpha_and_band_count(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        packed_alpha, band_count = gimage.read_packed_alpha_and_band_count(
+            gdal_ds)
+
+        self.assertEqual(band_count, 3)
+        self.assertEqual(packed_alpha.shape, (2, 1))
+        numpy.testing.assert_array_equal(
+            gimage.unpack_alpha(packed_alpha, 2), self.mask)
+
+    def test_buffer_pool(self):
+        pool = gimage.BufferPool()
+        first = pool.acquire((2, 3), numpy.uint16)
+        self.assertEqual(first.shape, (2, 3))
+        self.assertEqual(first.dtype, numpy.uint16)
+        pool.release(first)
+
+        self.assertIs(pool.acquire((2, 3), numpy.uint16), first)
+        self.assertIsNot(pool.acquire((2, 3), numpy.uint16), first)
+        pool.release(first)
+        self.assertIsNot(pool.acquire((2, 3), numpy.float32), first)
+
+        with pool.buffer((3, 2)) as second:
+            pass
+        self.assertIs(pool.acquire((3, 2)), second)
+
+        small_pool = gimage.BufferPool(max_bytes=8)
+        small_pool.release(numpy.empty((2, 3), dtype=numpy.uint16))
+        self.assertEqual(small_pool._free_bytes, 0)
+
+    def test_buffer_pool_read_band(self):
+        pool = gimage.BufferPool()
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        band = pool.read_band(gdal_ds, 1)
+        numpy.testing.assert_array_equal(band, self.band)
+        pool.release(band)
+
+        self.assertIs(pool.read_band(gdal_ds, 2), band)
+
+    def test_prefetch_bands(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        other_ds = gdal.Open(self.test_photometric_alpha_image)
+        reads = [(1, None), (2, (1, 0, 1, 2)), (3, None)]
+
+        for depth in [0, 1, 3]:
+            results = list(gimage.prefetch_bands(
+                [gdal_ds, other_ds, gdal_ds], reads, depth))
+            self.assertEqual(len(results), 3)
+            for arrays in results[::2]:
+                for array in arrays:
+                    numpy.testing.assert_array_equal(array, self.band)
+            for array in results[1]:
+                numpy.testing.assert_array_equal(array, self.band[:, 1:])
+
+    def test_prefetch_bands_error(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        with self.assertRaises(Exception):
+            list(gimage.prefetch_bands([gdal_ds], [(1, (0, 0, 5, 5))], 1))
+
+    def test_dataset_cache(self):
+        cache = gimage.DatasetCache(max_entries=1)
+        gdal_ds, alpha, band_count = gimage.open_image_and_get_info(
+            self.test_photometric_alpha_image, cache=cache)
+        self.assertEqual(band_count, 3)
+        numpy.testing.assert_array_equal(alpha, self.mask)
+        self.assertFalse(alpha.flags.writeable)
+
+        cached_ds, cached_alpha, _ = gimage.open_image_and_get_info(
+            self.test_photometric_alpha_image, cache=cache)
+        self.assertIs(cached_ds, gdal_ds)
+        self.assertIs(cached_alpha, alpha)
+
+        _, packed_alpha, band_count = gimage.open_image_and_get_packed_alpha(
+            self.test_photometric_alpha_image, cache=cache)
+        self.assertEqual(band_count, 3)
+        numpy.testing.assert_array_equal(
+            gimage.unpack_alpha(packed_alpha, 2), self.mask)
+
+        # A window is cut from the cached alpha
+        _, window_alpha, _ = gimage.open_image_and_get_info(
+            self.test_photometric_alpha_image, cache=cache,
+            window=gimage.Window(1, 0, 1, 2))
+        numpy.testing.assert_array_equal(window_alpha, self.mask[:, 1:])
+
+        cache.clear()
+        cached_ds, _, _ = gimage.open_image_and_get_info(
+            self.test_photometric_alpha_image, cache=cache)
+        self.assertIsNot(cached_ds, gdal_ds)
+
+    def test_resolve_window(self):
+        gdal_ds = gdal.Open(self.test_photometric_alpha_image)
+        self.assertEqual(gimage.resolve_window(gdal_ds), None)
+        self.assertEqual(gimage.resolve_window(gdal_ds, (1, 0, 5, 5)),
+                         gimage.Window(1, 0, 1, 2))
+        self.assertEqual(
+            gimage.resolve_window(gdal_ds, bbox=(1.5, -0.8, 2.5, -0.2)),
+            gimage.Window(1, 1, 1, 1))
+        self.assertEqual(
+            gimage.resolve_window(gdal_ds, bbox=(-10, -10, 10, 10)),
+            gimage.Window(0, 0, 2, 2))
+        with self.assertRaises(Exception):
+            gimage.resolve_window(gdal_ds, bbox=(10, 10, 20, 20))
+        with self.assertRaises(Exception):
+            gimage.resolve_window(gdal_ds, (0, 0, 1, 1), (0, 0, 1, 1))
+
+    def test_window_metadata(self):
+        metadata = dict(self.metadata,
+                        rpc={'LINE_OFF': '10', 'SAMP_OFF': '20'})
+        window_metadata = gimage.window_metadata(
+            metadata, gimage.Window(1, 2, 1, 1))
+        self.assertEqual(window_metadata['geotransform'],
+                         (1.0, 2.0, 0.0, -1.0, 0.0, -1.0))
+        self.assertEqual(window_metadata['rpc'],
+                         {'LINE_OFF': '8.0', 'SAMP_OFF': '19.0'})
+        self.assertEqual(metadata['rpc']['LINE_OFF'], '10')
+
+    def test_load_window(self):
+        test_gimage = gimage.load(self.test_photometric_alpha_image,
+                                  window=(1, 0, 1, 2))
+        self.assertEqual(len(test_gimage.bands), 3)
+        numpy.testing.assert_array_equal(test_gimage.bands[0],
+                                         self.band[:, 1:])
+        numpy.testing.assert_array_equal(test_gimage.alpha, self.mask[:, 1:])
+        self.assertEqual(test_gimage.metadata['geotransform'],
+                         (1.0, 2.0, 0.0, 1.0, 0.0, -1.0))
+
+    def test_iter_row_blocks(self):
+        self.assertEqual(list(gimage.iter_row_blocks(5, 2)),
+                         [(0, 2), (2, 2), (4, 1)])
+        self.assertEqual(list(gimage.iter_row_blocks(4, 8)), [(0, 4)])
+
     def test_read_alpha_and_band_count(self):
         gdal_ds = gdal.Open(self.test_photometric_alpha_image)
         alpha, band_count = gimage.read_alpha_and_band_count(gdal_ds)
@@ -103,6 +293,126 @@ class Tests(unittest.TestCase):
 
         os.unlink(output_file)
 
+    def test_save_tiled_with_mask_band(self):
+        output_file = 'test_save_tiled_with_mask_band.tif'
+        test_band = numpy.arange(40 * 20, dtype=numpy.uint16).reshape(40, 20)
+        test_alpha = numpy.zeros((40, 20), dtype=numpy.bool)
+        test_alpha[5:30, 2:18] = True
+        test_gimage = gimage.GImage([test_band, test_band, test_band],
+                                    test_alpha, self.metadata)
+        options = gimage.DEFAULT_WRITER_OPTIONS._replace(
+            tiled=True, block_size=16, compression='LZW', mask='mask')
+        gimage.save(test_gimage, output_file, options=options)
+
+        test_ds = gdal.Open(output_file)
+        self.assertEqual(test_ds.RasterCount, 3)
+        self.assertEqual(test_ds.GetRasterBand(1).GetBlockSize(), [16, 16])
+        test_ds = None
+
+        result_gimg = gimage.load(output_file)
+        numpy.testing.assert_array_equal(result_gimg.bands[0], test_band)
+        numpy.testing.assert_array_equal(result_gimg.bands[2], test_band)
+        numpy.testing.assert_array_equal(result_gimg.alpha, test_alpha)
+        self.assertEqual(result_gimg.metadata, self.metadata)
+
+        os.unlink(output_file)
+
+    def test_save_cog(self):
+        output_file = 'test_save_cog.tif'
+        test_band = numpy.arange(40 * 40, dtype=numpy.uint16).reshape(40, 40)
+        test_alpha = numpy.ones((40, 40), dtype=numpy.bool)
+        test_alpha[:, :3] = False
+        test_gimage = gimage.GImage([test_band, test_band, test_band],
+                                    test_alpha, self.metadata)
+        options = gimage.DEFAULT_WRITER_OPTIONS._replace(
+            block_size=16, cog=True)
+        gimage.save(test_gimage, output_file, options=options)
+
+        self.assertFalse(os.path.exists(output_file + '.tmp.tif'))
+        test_ds = gdal.Open(output_file)
+        self.assertEqual(test_ds.GetRasterBand(1).GetBlockSize(), [16, 16])
+        self.assertEqual(test_ds.GetRasterBand(1).GetOverviewCount(), 2)
+        test_ds = None
+
+        result_gimg = gimage.load(output_file)
+        numpy.testing.assert_array_equal(result_gimg.bands[0], test_band)
+        numpy.testing.assert_array_equal(result_gimg.alpha, test_alpha)
+
+        os.unlink(output_file)
+
+    def test_overview_levels(self):
+        self.assertEqual(gimage.overview_levels(10000, 8000, 512),
+                         [2, 4, 8, 16, 32])
+        self.assertEqual(gimage.overview_levels(512, 100, 512), [])
+
+    def test_gimage_writer(self):
+        output_file = 'test_gimage_writer.tif'
+        test_band = numpy.array([[5, 2, 2], [1, 6, 8]], dtype=numpy.uint16)
+        test_alpha = numpy.array([[0, 1, 1], [1, 1, 0]], dtype=numpy.bool)
+
+        with gimage.GImageWriter(output_file, 3, 2, 1, self.metadata) as w:
+            w.write_block([test_band[:1]], test_alpha[:1], 0, 0)
+            w.write_block([test_band[1:]], test_alpha[1:], 0, 1)
+
+        result_gimg = gimage.load(output_file)
+        numpy.testing.assert_array_equal(result_gimg.bands[0], test_band)
+        numpy.testing.assert_array_equal(result_gimg.alpha, test_alpha)
+
+        os.unlink(output_file)
+
+    def test_gimage_writer_error(self):
+        output_file = 'test_gimage_writer_error.tif'
+        test_band = numpy.array([[5, 2, 2], [1, 6, 8]], dtype=numpy.uint16)
+        cog_options = gimage.DEFAULT_WRITER_OPTIONS._replace(
+            block_size=16, cog=True)
+
+        # An unfinished file is removed, and not copied to a COG
+        for options in [None, cog_options]:
+            with self.assertRaises(ValueError):
+                with gimage.GImageWriter(output_file, 3, 2, 1, self.metadata,
+                                         options=options) as w:
+                    w.write_block([test_band[:1]], None, 0, 0)
+                    raise ValueError('Failed')
+            self.assertFalse(os.path.exists(output_file))
+            self.assertFalse(os.path.exists(output_file + '.tmp.tif'))
+
+        # Unless its blocks are kept to be resumed
+        with self.assertRaises(ValueError):
+            with gimage.GImageWriter(output_file, 3, 2, 1, self.metadata,
+                                     keep_partial=True) as w:
+                w.write_block([test_band[:1]], None, 0, 0)
+                raise ValueError('Failed')
+        writer = gimage.GImageWriter(output_file, 3, 2, 1, self.metadata,
+                                     resume=True)
+        self.assertTrue(writer.resumed)
+        writer.write_block([test_band[1:]], None, 0, 1)
+        writer.close()
+        result_gimg = gimage.load(output_file)
+        numpy.testing.assert_array_equal(result_gimg.bands[0], test_band)
+
+        os.unlink(output_file)
+
+    def test_save_error(self):
+        output_file = 'test_save_error.tif'
+        test_band = numpy.array([[5, 2, 2], [1, 6, 8]], dtype=numpy.uint16)
+        # An alpha wider than the bands cannot be written
+        test_gimage = gimage.GImage([test_band],
+                                    numpy.ones((2, 5), dtype=bool),
+                                    self.metadata)
+        cog_options = gimage.DEFAULT_WRITER_OPTIONS._replace(
+            block_size=16, cog=True)
+
+        for options in [None, cog_options]:
+            with self.assertRaises(Exception):
+                gimage.save(test_gimage, output_file, options=options)
+            self.assertFalse(os.path.exists(output_file))
+            self.assertFalse(os.path.exists(output_file + '.tmp.tif'))
+
+        with self.assertRaises(ValueError):
+            gimage.save(test_gimage, output_file,
+                        options=gimage.DEFAULT_WRITER_OPTIONS._replace(
+                            mask='nodata'))
+
     def test__save_to_ds(self):
         output_file = 'test_save_to_ds.tif'
 
@@ -0,0 +1,113 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import unittest
+import numpy
+
+from radiometric_normalization import histogram
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.candidate = numpy.random.randint(
+            0, 50, 1000).astype(numpy.uint16)
+        self.reference = (2 * self.candidate +
+                          numpy.random.randint(0, 10, 1000)).astype(
+                              numpy.uint16)
+
+    def test_joint_histogram_streaming(self):
+        streamed = histogram.JointHistogram()
+        for block in [slice(0, 300), slice(300, 300), slice(300, 1000)]:
+            streamed.update(self.candidate[block], self.reference[block])
+
+        whole = histogram.JointHistogram()
+        whole.update(self.candidate, self.reference)
+
+        self.assertEqual(streamed.count, 1000)
+        numpy.testing.assert_array_equal(streamed.counts, whole.counts)
+        numpy.testing.assert_array_equal(streamed.candidate_values,
+                                         whole.candidate_values)
+        numpy.testing.assert_array_equal(streamed.reference_values,
+                                         whole.reference_values)
+
+    def test_joint_histogram_statistics(self):
+        joint_histogram = histogram.JointHistogram()
+        joint_histogram.update(self.candidate, self.reference)
+
+        # An exact histogram has the same statistics as the pixels
+        numpy.testing.assert_array_almost_equal(
+            joint_histogram.mean(),
+            (self.candidate.mean(), self.reference.mean()))
+        numpy.testing.assert_array_almost_equal(
+            joint_histogram.std(),
+            (self.candidate.std(), self.reference.std()))
+        numpy.testing.assert_array_almost_equal(
+            joint_histogram.covariance(),
+            numpy.cov(self.candidate, self.reference, bias=True))
+        self.assertAlmostEqual(
+            joint_histogram.corrcoef(),
+            numpy.corrcoef(self.candidate, self.reference)[0, 1])
+
+        H, c_bins, r_bins = joint_histogram.histogram2d(7)
+        golden_H, golden_c_bins, golden_r_bins = numpy.histogram2d(
+            self.candidate, self.reference, bins=7)
+        numpy.testing.assert_array_equal(H, golden_H)
+        numpy.testing.assert_array_almost_equal(c_bins, golden_c_bins)
+        numpy.testing.assert_array_almost_equal(r_bins, golden_r_bins)
+
+    def test_joint_histogram_bin_width(self):
+        joint_histogram = histogram.JointHistogram(bin_width=4)
+        joint_histogram.update(
+            numpy.array([0, 1, 3, 4, 9], dtype=numpy.int16),
+            numpy.array([-1, 2, 2, 7, 7], dtype=numpy.int16))
+
+        # Bins of integers hold 4 values, so are centred 1.5 above their
+        # lower edge
+        numpy.testing.assert_array_equal(joint_histogram.candidate_values,
+                                         [1.5, 1.5, 5.5, 9.5])
+        numpy.testing.assert_array_equal(joint_histogram.reference_values,
+                                         [-2.5, 1.5, 5.5, 5.5])
+        numpy.testing.assert_array_equal(joint_histogram.counts,
+                                         [1, 2, 1, 1])
+
+    def test_unique_pairs(self):
+        for dtype in [numpy.uint16, numpy.float32]:
+            candidate_values, reference_values, counts = \
+                histogram.unique_pairs(
+                    numpy.array([3, 1, 3, 2, 3], dtype=dtype),
+                    numpy.array([5, 4, 5, 4, 6], dtype=dtype))
+            numpy.testing.assert_array_equal(candidate_values, [1, 2, 3, 3])
+            numpy.testing.assert_array_equal(reference_values, [4, 4, 5, 6])
+            numpy.testing.assert_array_equal(counts, [1, 1, 2, 1])
+
+    def test_joint_histogram_cache(self):
+        cache = histogram.JointHistogramCache(max_entries=2)
+        cache.put('a', [1])
+        cache.put('b', [2])
+        self.assertEqual(cache.get('a'), [1])
+
+        # 'b' is the least recently used entry
+        cache.put('c', [3])
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), [1])
+        self.assertEqual(cache.get('c'), [3])
+
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
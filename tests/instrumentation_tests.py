@@ -0,0 +1,94 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import json
+import os
+import unittest
+
+from radiometric_normalization import instrumentation
+
+
+@instrumentation.instrumented
+def _add(a, b):
+    instrumentation.increment('instrumentation_tests.additions')
+    return a + b
+
+
+class Tests(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.set_sink(None)
+        instrumentation.set_diagnostics(False)
+
+    def test_no_sink(self):
+        self.assertEqual(_add(1, 2), 3)
+
+    def test_memory_sink(self):
+        sink = instrumentation.MemorySink()
+        instrumentation.set_sink(sink)
+
+        _add(1, 2)
+        _add(3, 4)
+        with instrumentation.timer('block'):
+            pass
+
+        total, count, maximum = sink.timers['instrumentation_tests._add']
+        self.assertEqual(count, 2)
+        self.assertTrue(maximum <= total)
+        self.assertEqual(sink.timers['block'][1], 1)
+        self.assertEqual(sink.counters['instrumentation_tests.additions'], 2)
+
+    def test_json_lines_sink(self):
+        output_file = 'test_metrics.jsonl'
+        instrumentation.set_sink(instrumentation.JsonLinesSink(output_file))
+
+        _add(1, 2)
+        instrumentation.flush()
+
+        with open(output_file) as metrics_file:
+            events = [json.loads(line) for line in metrics_file]
+        self.assertEqual(
+            [(e['type'], e['name']) for e in events],
+            [('counter', 'instrumentation_tests.additions'),
+             ('timer', 'instrumentation_tests._add')])
+
+        os.unlink(output_file)
+
+    def test_prometheus_textfile_sink(self):
+        output_file = 'test_metrics.prom'
+        instrumentation.set_sink(
+            instrumentation.PrometheusTextfileSink(output_file, prefix='rn'))
+
+        _add(1, 2)
+        instrumentation.flush()
+
+        with open(output_file) as metrics_file:
+            lines = metrics_file.read().split('\n')
+        self.assertTrue(
+            'rn_call_seconds_count{name="instrumentation_tests._add"} 1' in
+            lines)
+        self.assertTrue(
+            'rn_events_total{name="instrumentation_tests.additions"} 1' in
+            lines)
+
+        os.unlink(output_file)
+
+    def test_set_diagnostics(self):
+        self.assertFalse(instrumentation.diagnostics_enabled())
+        instrumentation.set_diagnostics(True)
+        self.assertTrue(instrumentation.diagnostics_enabled())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import unittest
+import numpy
+
+from radiometric_normalization import kernels
+
+
+BACKENDS = [kernels.NUMPY] + ([kernels.NUMBA] if kernels.HAVE_NUMBA else [])
+
+
+class Tests(unittest.TestCase):
+    def test_residual_mask(self):
+        candidate_data = numpy.array([1, 2, 3, 4, 5], dtype=numpy.uint16)
+        reference_data = numpy.array([3, 5, 9, 9, 11], dtype=numpy.uint16)
+
+        # Distances from y = 2x + 1 are 0, 0, 2, 0 and 0 over sqrt(5)
+        golden_mask = numpy.array([1, 1, 0, 1, 1], dtype=numpy.bool)
+        for backend in BACKENDS:
+            mask = kernels.residual_mask(
+                candidate_data, reference_data, numpy.array([2.0]), 1.0, 0.5,
+                backend=backend)
+            numpy.testing.assert_array_equal(mask, golden_mask)
+
+    def test_apply_lut(self):
+        for dtype in [numpy.uint8, numpy.int16]:
+            info = numpy.iinfo(dtype)
+            lut = numpy.arange(info.min, info.max + 1)[::-1].astype(dtype)
+            band = numpy.array([[info.min, -1 if info.min else 1],
+                                [0, info.max]], dtype=dtype)
+            for backend in BACKENDS:
+                output = kernels.apply_lut(band, lut, backend=backend)
+                numpy.testing.assert_array_equal(
+                    output, (info.max + info.min - band.astype(int)))
+
+    def test_apply_lut_short_lut(self):
+        # Values past the end of the lut take its last entry
+        lut = numpy.array([5, 6, 7], dtype=numpy.uint16)
+        band = numpy.array([0, 2, 3, 1000], dtype=numpy.uint16)
+        out = numpy.zeros(4, dtype=numpy.uint16)
+        for backend in BACKENDS:
+            output = kernels.apply_lut(band, lut, out=out, backend=backend)
+            self.assertTrue(output is out)
+            numpy.testing.assert_array_equal(output, [5, 7, 7, 7])
+
+    def test_accumulate_masked(self):
+        for backend in BACKENDS:
+            sums = numpy.zeros((2, 2))
+            counts = numpy.zeros((2, 2), dtype=numpy.uint32)
+            for band, valid in [([[1, 2], [3, 4]], [[1, 0], [1, 1]]),
+                                ([[5, 6], [7, 8]], [[1, 0], [0, 1]])]:
+                kernels.accumulate_masked(
+                    sums, counts, numpy.array(band, dtype=numpy.uint16),
+                    numpy.array(valid, dtype=numpy.bool), backend=backend)
+
+            numpy.testing.assert_array_equal(sums, [[6, 0], [3, 12]])
+            numpy.testing.assert_array_equal(counts, [[2, 0], [1, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import unittest
+import numpy
+
+from radiometric_normalization import lazy
+from radiometric_normalization import pif
+from radiometric_normalization import transformation
+from radiometric_normalization.transformation import LinearTransformation
+
+if lazy.HAVE_DASK:
+    import dask.array as da
+
+
+def _lazy_image(bands, alpha, chunks=2):
+    return lazy.LazyImage(
+        [da.from_array(numpy.array(band, dtype=numpy.uint16), chunks=chunks)
+         for band in bands],
+        da.from_array(numpy.array(alpha, dtype=bool), chunks=chunks),
+        {})
+
+
+@unittest.skipUnless(lazy.HAVE_DASK, 'Dask is not installed')
+class Tests(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.candidate_band = numpy.random.randint(0, 100, (5, 7))
+        self.reference_band = 2 * self.candidate_band + \
+            numpy.random.randint(0, 20, (5, 7))
+        self.alpha = numpy.random.rand(5, 7) > 0.2
+
+    def test_masked_moments(self):
+        moments = lazy.masked_moments(
+            da.from_array(self.candidate_band, chunks=2),
+            da.from_array(self.reference_band, chunks=2),
+            da.from_array(self.alpha, chunks=2)).compute()
+
+        candidate_data = self.candidate_band[self.alpha]
+        reference_data = self.reference_band[self.alpha]
+        covariance = numpy.cov(candidate_data, reference_data, bias=True)
+        numpy.testing.assert_array_almost_equal(
+            moments, [len(candidate_data), candidate_data.mean(),
+                      reference_data.mean(), covariance[0, 0],
+                      covariance[1, 1], covariance[0, 1]])
+
+    def test_linear_relationships(self):
+        candidate = _lazy_image([self.candidate_band], self.alpha)
+        reference = _lazy_image([self.reference_band], self.alpha)
+
+        pif_mask = lazy.pif_mask(candidate, reference, 'filter_alpha')
+        transformations = lazy.linear_relationships(
+            candidate, reference, pif_mask)
+
+        golden = transformation.generate_linear_relationship(
+            self.candidate_band, self.reference_band, self.alpha)
+        self.assertAlmostEqual(transformations[0].gain, golden.gain)
+        self.assertAlmostEqual(transformations[0].offset, golden.offset)
+
+    def test_pif_mask_pca(self):
+        candidate_band = numpy.arange(36).reshape(6, 6)
+        reference_band = candidate_band.copy()
+        reference_band[1, 1] = 30
+        alpha = numpy.ones((6, 6), dtype=bool)
+        alpha[5, 5] = False
+
+        pif_mask = lazy.pif_mask(
+            _lazy_image([candidate_band], alpha),
+            _lazy_image([reference_band], alpha), 'filter_PCA',
+            pif.pca_options(threshold=5)).compute()
+
+        golden_mask = alpha.copy()
+        golden_mask[1, 1] = False
+        numpy.testing.assert_array_equal(pif_mask, golden_mask)
+
+    def test_normalize_image(self):
+        image = _lazy_image([[[1, 2], [3, 60000]]], [[1, 1], [1, 0]])
+
+        normalized = lazy.normalize_image(
+            image, [LinearTransformation(gain=2, offset=1)])
+
+        numpy.testing.assert_array_equal(
+            normalized.bands[0].compute(), [[3, 5], [7, 65535]])
+        self.assertTrue(normalized.alpha is image.alpha)
+
+    def test_mean_with_uniform_weight(self):
+        images = [_lazy_image([[[2, 4], [6, 8]]], [[1, 1], [0, 0]]),
+                  _lazy_image([[[4, 5], [9, 9]]], [[1, 0], [1, 0]])]
+
+        mean = lazy.mean_with_uniform_weight(images)
+
+        numpy.testing.assert_array_equal(mean.bands[0].compute(),
+                                         [[3, 4], [9, 0]])
+        numpy.testing.assert_array_equal(mean.alpha.compute(),
+                                         [[1, 1], [1, 0]])
+        self.assertEqual(mean.bands[0].dtype, numpy.uint16)
+
+
+if __name__ == '__main__':
+    unittest.main()
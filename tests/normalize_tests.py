@@ -17,7 +17,9 @@ import unittest
 import numpy
 
 from radiometric_normalization import normalize
+from radiometric_normalization.transformation import GriddedTransformation
 from radiometric_normalization.transformation import LinearTransformation
+from radiometric_normalization.transformation import LutTransformation
 
 
 class Tests(unittest.TestCase):
@@ -48,6 +50,16 @@ class Tests(unittest.TestCase):
             [[0, 0], [500, 65035]], dtype=numpy.uint16)
         numpy.testing.assert_array_equal(output_band4, expected_band4)
 
+    def test_apply_out(self):
+        test_band = numpy.array([[0, 100], [1000, 65535]], dtype=numpy.uint16)
+        output_band = numpy.zeros(test_band.shape, dtype=numpy.uint16)
+
+        result = normalize.apply(
+            test_band, LinearTransformation(0.5, 0), out=output_band)
+        self.assertIs(result, output_band)
+        numpy.testing.assert_array_equal(
+            output_band, numpy.array([[0, 50], [500, 32767]]))
+
     def test_linear_transformation_to_lut(self):
         test_linear_transform = LinearTransformation(gain=1, offset=2)
 
@@ -58,6 +70,67 @@ class Tests(unittest.TestCase):
         expected_lut = numpy.array(expected_values)
         numpy.testing.assert_array_equal(lut, expected_lut)
 
+    def test_apply_using_lut_native_dtypes(self):
+        test_transformation = LinearTransformation(2, -10)
+
+        uint8_band = numpy.array([[0, 10], [100, 255]], dtype=numpy.uint8)
+        output_band = normalize.apply_using_lut(
+            uint8_band, test_transformation)
+        self.assertEqual(output_band.dtype, numpy.uint8)
+        numpy.testing.assert_array_equal(
+            output_band, numpy.array([[0, 10], [190, 255]]))
+
+        int16_band = numpy.array(
+            [[-32768, -5], [100, 32767]], dtype=numpy.int16)
+        output_band = normalize.apply_using_lut(
+            int16_band, test_transformation)
+        self.assertEqual(output_band.dtype, numpy.int16)
+        numpy.testing.assert_array_equal(
+            output_band, numpy.array([[-32768, -20], [190, 32767]]))
+
+        float_band = numpy.array([[0.25, 0.5]], dtype=numpy.float32)
+        output_band = normalize.apply_using_lut(
+            float_band, test_transformation)
+        self.assertEqual(output_band.dtype, numpy.float32)
+        numpy.testing.assert_array_almost_equal(
+            output_band, numpy.array([[-9.5, -9]]))
+
+    def test_apply_lut_transformation(self):
+        test_band = numpy.array([[0, 100], [1000, 65535]], dtype=numpy.uint16)
+        lut = numpy.arange(65536, dtype=numpy.uint16)[::-1].copy()
+
+        output_band = normalize.apply(test_band, LutTransformation(lut))
+        numpy.testing.assert_array_equal(
+            output_band, [[65535, 65435], [64535, 0]])
+
+        # The look up table is used whichever method is asked for
+        output_band = normalize.apply(test_band, LutTransformation(lut),
+                                      method='direct')
+        self.assertEqual(output_band.dtype, numpy.uint16)
+
+        self.assertRaises(Exception, normalize.apply_using_lut,
+                          test_band.astype(numpy.uint8),
+                          LutTransformation(lut))
+
+    def test_apply_gridded(self):
+        test_band = numpy.full((4, 6), 100, dtype=numpy.uint16)
+        test_transformation = GriddedTransformation(
+            numpy.array([[1.0, 2.0, 3.0]]), numpy.array([[0.0, 0.0, -500.0]]),
+            2)
+
+        output_band = normalize.apply_gridded(test_band, test_transformation)
+        self.assertEqual(output_band.dtype, numpy.uint16)
+        # Interpolated between the cell centres (between columns 0 and 1, 2
+        # and 3 and 4 and 5) and clipped at 0
+        numpy.testing.assert_array_equal(
+            output_band, [[100, 125, 175, 100, 0, 0]] * 4)
+
+        # A block of the band gets the same values as the whole band
+        output_block = numpy.zeros((2, 6), dtype=numpy.uint16)
+        normalize.apply_gridded(test_band[1:3], test_transformation, yoff=1,
+                                out=output_block)
+        numpy.testing.assert_array_equal(output_block, output_band[1:3])
+
 
 if __name__ == '__main__':
     unittest.main()
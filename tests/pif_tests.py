@@ -34,6 +34,89 @@ class Tests(unittest.TestCase):
         numpy.testing.assert_array_equal(pif_mask,
                                          golden_pif_mask)
 
+    def test_filter_pif_indices(self):
+        alpha = numpy.array([[1, 1, 0], [1, 1, 1]], dtype=numpy.bool)
+        pif_indices = pif.mask_to_pif_indices(alpha)
+        numpy.testing.assert_array_equal(pif_indices, [0, 1, 3, 4, 5])
+
+        evaluated = []
+
+        def threshold_filter(candidate_data, reference_data, threshold):
+            evaluated.append(len(candidate_data))
+            return candidate_data - reference_data < threshold
+
+        band_1 = numpy.array([[1, 9, 1], [1, 1, 1]], dtype=numpy.uint16)
+        band_2 = numpy.array([[1, 1, 1], [9, 1, 1]], dtype=numpy.uint16)
+        reference = numpy.zeros((2, 3), dtype=numpy.uint16)
+        for band in [band_1, band_2]:
+            pif_indices = pif.filter_pif_indices(
+                band, reference, pif_indices, threshold_filter, 5)
+
+        # The second band only evaluates the pixels that passed the first
+        self.assertEqual(evaluated, [5, 4])
+        numpy.testing.assert_array_equal(
+            pif.pif_indices_to_mask(pif_indices, alpha.shape),
+            numpy.array([[1, 0, 0], [0, 1, 1]], dtype=numpy.bool))
+
+    def test_generate_joint_pca_pifs(self):
+        # Both bands are linearly related between the images, apart from
+        # pixel [1, 1] which has changed in the second band
+        c_band_1 = numpy.arange(36, dtype=numpy.uint16).reshape(6, 6)
+        c_band_2 = (numpy.arange(36, dtype=numpy.uint16) * 7 % 36).reshape(
+            6, 6)
+        r_band_1 = 2 * c_band_1 + 10
+        r_band_2 = c_band_2 + 100
+        r_band_2[1, 1] += 30
+        combined_alpha = numpy.ones((6, 6), dtype=numpy.bool)
+        combined_alpha[5, 5] = False
+
+        pif_mask = pif.generate_joint_pca_pifs(
+            [c_band_1, c_band_2], [r_band_1, r_band_2], combined_alpha,
+            pif.joint_pca_options(threshold=10))
+
+        golden_pif_mask = numpy.ones((6, 6), dtype=numpy.bool)
+        golden_pif_mask[1, 1] = False
+        golden_pif_mask[5, 5] = False
+        numpy.testing.assert_array_equal(pif_mask, golden_pif_mask)
+
+    def test_joint_covariance_streaming(self):
+        numpy.random.seed(0)
+        candidate = [numpy.random.randint(0, 1000, 100) for _ in range(3)]
+        reference = [numpy.random.randint(0, 1000, 100) for _ in range(3)]
+
+        streamed = pca_filter.JointCovariance(3)
+        for block in [slice(0, 30), slice(30, 100)]:
+            streamed.update([data[block] for data in candidate],
+                            [data[block] for data in reference])
+        joint_pca = streamed.fit()
+
+        X = numpy.array(candidate + reference, dtype=numpy.float64)
+        numpy.testing.assert_array_almost_equal(joint_pca.mean,
+                                                X.mean(axis=1))
+        # The principal and minor subspaces split the sample covariance
+        eigenvalues = numpy.linalg.eigvalsh(numpy.cov(X))
+        components = numpy.hstack([joint_pca.minor_components,
+                                   joint_pca.components])
+        numpy.testing.assert_array_almost_equal(
+            numpy.diag(numpy.dot(components.T,
+                                 numpy.dot(numpy.cov(X), components))),
+            eigenvalues)
+
+    def test_generate_pca_pifs_pixel_list_deduplicate(self):
+        numpy.random.seed(0)
+        candidate_data = numpy.random.randint(0, 50, 2000).astype(
+            numpy.uint16)
+        reference_data = (2 * candidate_data + numpy.random.randint(
+            0, 20, 2000)).astype(numpy.uint16)
+
+        passed = pif.generate_pca_pifs_pixel_list(
+            candidate_data, reference_data,
+            pca_options(threshold=3, deduplicate=True))
+        golden_passed = pif.generate_pca_pifs_pixel_list(
+            candidate_data, reference_data, pca_options(threshold=3))
+
+        numpy.testing.assert_array_equal(passed, golden_passed)
+
     def test__PCA_fit_single_band(self):
         test_pca = pca_filter._pca_fit_single_band(numpy.array([1, 2, 3, 4, 5]),
                                             numpy.array([1, 2, 3, 4, 5]))
@@ -0,0 +1,111 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization import pif
+from radiometric_normalization.wrappers import pif_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        candidate_bands = [numpy.random.randint(100, 1000, (30, 40))
+                           for _ in range(3)]
+        reference_bands = [
+            2 * band + 10 + numpy.random.randint(0, 20, (30, 40))
+            for band in candidate_bands]
+        # Each band has its own outliers
+        for band in reference_bands:
+            band[numpy.random.rand(30, 40) > 0.9] += 500
+        # The bands as they are read from the files
+        self.candidate_bands = [band.astype('uint16')
+                                for band in candidate_bands]
+        self.reference_bands = [band.astype('uint16')
+                                for band in reference_bands]
+        self.candidate_alpha = numpy.random.rand(30, 40) > 0.1
+        self.reference_alpha = numpy.random.rand(30, 40) > 0.1
+        self.combined_alpha = numpy.logical_and(self.candidate_alpha,
+                                                self.reference_alpha)
+        self.candidate_path = self._save(
+            'candidate.tif', self.candidate_bands, self.candidate_alpha)
+        self.reference_path = self._save(
+            'reference.tif', self.reference_bands, self.reference_alpha)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, name, bands, alpha):
+        path = os.path.join(self.directory, name)
+        gimage.save(gimage.GImage(bands, alpha.astype('uint16') * 65535, {}),
+                    path)
+        return path
+
+    def test_generate_multiband(self):
+        # Each band only filters the survivors of the bands before it, the
+        # same as feeding each band's PIF mask into the next band in memory
+        for method, single_band_pifs, parameters in [
+                ('filter_PCA', pif.generate_pca_pifs,
+                 pif.DEFAULT_PCA_OPTIONS),
+                ('filter_robust', pif.generate_robust_pifs,
+                 pif.DEFAULT_ROBUST_OPTIONS)]:
+            pif_mask = pif_wrapper.generate(
+                self.candidate_path, self.reference_path, method=method)
+
+            golden_pif_mask = self.combined_alpha
+            for candidate_band, reference_band in zip(
+                    self.candidate_bands, self.reference_bands):
+                golden_pif_mask = single_band_pifs(
+                    candidate_band, reference_band, golden_pif_mask,
+                    parameters)
+            numpy.testing.assert_array_equal(pif_mask, golden_pif_mask)
+            # The outliers of every band are filtered out
+            self.assertLess(numpy.count_nonzero(pif_mask),
+                            0.8 * numpy.count_nonzero(self.combined_alpha))
+
+    def test_generate_joint_pca(self):
+        # Tall enough to be streamed in more than one strip
+        rows = pif_wrapper.JOINT_PCA_BLOCK_ROWS + 20
+        candidate_bands = [
+            numpy.random.randint(100, 1000, (rows, 6)).astype('uint16')
+            for _ in range(2)]
+        reference_bands = [
+            (2 * band + 10 + numpy.random.randint(0, 20, (rows, 6)))
+            .astype('uint16') for band in candidate_bands]
+        reference_bands[1][numpy.random.rand(rows, 6) > 0.9] += 500
+        alpha = numpy.random.rand(rows, 6) > 0.1
+        candidate_path = self._save('tall_candidate.tif', candidate_bands,
+                                    alpha)
+        reference_path = self._save('tall_reference.tif', reference_bands,
+                                    alpha)
+
+        pif_mask = pif_wrapper.generate(candidate_path, reference_path,
+                                        method='filter_joint_PCA')
+
+        golden_pif_mask = pif.generate_joint_pca_pifs(
+            candidate_bands, reference_bands, alpha)
+        numpy.testing.assert_array_equal(pif_mask, golden_pif_mask)
+        self.assertLess(numpy.count_nonzero(pif_mask),
+                        numpy.count_nonzero(alpha))
+
+
+if __name__ == '__main__':
+    unittest.main()
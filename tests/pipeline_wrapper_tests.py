@@ -0,0 +1,146 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization.wrappers import pipeline_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        self.candidate_bands = [
+            numpy.random.randint(100, 1000, (12, 16)).astype('uint16')
+            for _ in range(2)]
+        self.reference_bands = [
+            (2 * band + 10 + numpy.random.randint(0, 20, (12, 16)))
+            .astype('uint16') for band in self.candidate_bands]
+        self.alpha = numpy.random.rand(12, 16) > 0.1
+        # Pixels two units square with the origin at (100, 500)
+        self.metadata = {'geotransform': (100.0, 2.0, 0.0, 500.0, 0.0, -2.0)}
+        self.candidate_path = self._save('candidate.tif', self.candidate_bands,
+                                         self.alpha, self.metadata)
+        self.reference_path = self._save('reference.tif', self.reference_bands,
+                                         self.alpha, self.metadata)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, name, bands, alpha, metadata=None):
+        path = os.path.join(self.directory, name)
+        gimage.save(gimage.GImage(bands, alpha.astype('uint16') * 65535,
+                                  metadata or {}), path)
+        return path
+
+    def _assert_same_output(self, result, golden_result):
+        for transformation, golden_transformation in zip(
+                result.transformations, golden_result.transformations):
+            self.assertAlmostEqual(transformation.gain,
+                                   golden_transformation.gain)
+            self.assertAlmostEqual(transformation.offset,
+                                   golden_transformation.offset)
+        output = gimage.load(result.output_path)
+        golden_output = gimage.load(golden_result.output_path)
+        numpy.testing.assert_array_equal(output.alpha, golden_output.alpha)
+        for band, golden_band in zip(output.bands, golden_output.bands):
+            numpy.testing.assert_array_equal(band, golden_band)
+
+    def test_run_window(self):
+        # The same as a run on copies of the window of each image
+        xoff, yoff, xsize, ysize = (3, 2, 8, 6)
+        rows = slice(yoff, yoff + ysize)
+        columns = slice(xoff, xoff + xsize)
+        cropped_candidate_path = self._save(
+            'cropped_candidate.tif',
+            [band[rows, columns] for band in self.candidate_bands],
+            self.alpha[rows, columns])
+        cropped_reference_path = self._save(
+            'cropped_reference.tif',
+            [band[rows, columns] for band in self.reference_bands],
+            self.alpha[rows, columns])
+        golden_result = pipeline_wrapper.run(
+            cropped_candidate_path, cropped_reference_path,
+            os.path.join(self.directory, 'golden_output.tif'),
+            validate=False)
+
+        result = pipeline_wrapper.run(
+            self.candidate_path, self.reference_path,
+            os.path.join(self.directory, 'window_output.tif'),
+            validate=False, window=(xoff, yoff, xsize, ysize))
+        self._assert_same_output(result, golden_result)
+
+        # The bounding box of the window's pixel centres
+        result = pipeline_wrapper.run(
+            self.candidate_path, self.reference_path,
+            os.path.join(self.directory, 'bbox_output.tif'),
+            validate=False, bbox=(107.0, 485.0, 121.0, 495.0))
+        self._assert_same_output(result, golden_result)
+
+        # Streamed a strip at a time
+        result = pipeline_wrapper.run(
+            self.candidate_path, self.reference_path,
+            os.path.join(self.directory, 'strip_output.tif'),
+            validate=False, window=(xoff, yoff, xsize, ysize), block_rows=4)
+        self._assert_same_output(result, golden_result)
+
+    def test_run_fit_decimation(self):
+        golden_result = pipeline_wrapper.run(
+            self.candidate_path, self.reference_path,
+            os.path.join(self.directory, 'golden_output.tif'),
+            validate=False)
+        result = pipeline_wrapper.run(
+            self.candidate_path, self.reference_path,
+            os.path.join(self.directory, 'decimated_output.tif'),
+            validate=False, fit_decimation=2)
+        reports = pipeline_wrapper.compare_fit_decimation(
+            self.candidate_path, self.reference_path, decimations=[2])
+
+        # The first report is of the full resolution fit
+        self.assertEqual([report.decimation for report in reports], [1, 2])
+        self.assertEqual(reports[0].max_gain_error, 0)
+        self.assertEqual(reports[0].max_offset_error, 0)
+        self.assertEqual(reports[0].max_dn_error, 0)
+        for reports_index, run_result in [(0, golden_result), (1, result)]:
+            for reported, transformation in zip(
+                    reports[reports_index].transformations,
+                    run_result.transformations):
+                self.assertAlmostEqual(reported.gain, transformation.gain)
+                self.assertAlmostEqual(reported.offset, transformation.offset)
+
+        # Only the fit is decimated, so the output is at full resolution and
+        # no further from the full resolution fit's than the reported errors
+        # allow (the candidate values are below 1000, plus one for rounding)
+        tolerance = 1000 * reports[1].max_gain_error + \
+            reports[1].max_offset_error + 1
+        output = gimage.load(result.output_path)
+        golden_output = gimage.load(golden_result.output_path)
+        numpy.testing.assert_array_equal(output.alpha, golden_output.alpha)
+        for band, golden_band in zip(output.bands, golden_output.bands):
+            self.assertEqual(band.shape, golden_band.shape)
+            numpy.testing.assert_allclose(band, golden_band, atol=tolerance)
+        for transformation, golden_transformation in zip(
+                result.transformations, golden_result.transformations):
+            self.assertAlmostEqual(transformation.gain,
+                                   golden_transformation.gain, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import unittest
+import numpy
+
+from radiometric_normalization import profiling
+
+
+class Tests(unittest.TestCase):
+    def test_timed_stage(self):
+        timings = []
+        with profiling.timed_stage('first', timings):
+            pass
+
+        self.assertRaises(ValueError, self._failing_stage, timings)
+
+        self.assertEqual([t.stage for t in timings], ['first', 'second'])
+        for timing in timings:
+            self.assertTrue(timing.wall_time >= 0)
+            self.assertTrue(timing.peak_rss > 0)
+
+    @unittest.skipUnless(profiling.reset_peak_rss(),
+                         'The peak RSS cannot be reset here')
+    def test_timed_stage_peak_rss(self):
+        timings = []
+        with profiling.timed_stage('heavy', timings):
+            # 200 MB, touched so that it is resident
+            heavy = numpy.ones(25 * 1024 * 1024)
+            del heavy
+        with profiling.timed_stage('light', timings):
+            pass
+
+        heavy_timing, light_timing = timings
+        self.assertTrue(heavy_timing.peak_rss -
+                        light_timing.peak_rss > 100)
+
+    def _failing_stage(self, timings):
+        with profiling.timed_stage('second', timings):
+            raise ValueError()
+
+    def test_format_timings(self):
+        timings = [profiling.StageTiming('pif', 1.5, 10.0),
+                   profiling.StageTiming('normalize', 0.25, 20.0)]
+
+        table = profiling.format_timings(timings, title='pair').split('\n')
+
+        self.assertEqual(table[0], 'pair')
+        self.assertEqual(table[2].split(), ['pif', '1.500', '10.0'])
+        self.assertEqual(table[3].split(), ['normalize', '0.250', '20.0'])
+        self.assertEqual(table[4].split(), ['total', '1.750', '20.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import pif
+from radiometric_normalization import result_cache
+from radiometric_normalization.transformation import LinearTransformation
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = result_cache.ResultCache(
+            os.path.join(self.directory, 'cache'))
+        self.image_path = os.path.join(self.directory, 'image.tif')
+        with open(self.image_path, 'w') as image_file:
+            image_file.write('image')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mask(self):
+        mask = numpy.random.rand(5, 11) > 0.5
+        key = self.cache.key('pif_mask', [self.image_path])
+        self.assertEqual(self.cache.get_mask(key), None)
+
+        self.cache.put_mask(key, mask)
+
+        cached_mask = self.cache.get_mask(key)
+        self.assertEqual(cached_mask.dtype, bool)
+        numpy.testing.assert_array_equal(cached_mask, mask)
+
+    def test_transformations(self):
+        transformations = [LinearTransformation(1.5, numpy.array([-2.0])),
+                           LinearTransformation(numpy.float64(0.5), 3)]
+        key = self.cache.key('transformations', [self.image_path])
+
+        self.cache.put_transformations(key, transformations)
+
+        self.assertEqual(self.cache.get_transformations(key),
+                         [LinearTransformation(1.5, -2.0),
+                          LinearTransformation(0.5, 3.0)])
+
+    def test_key(self):
+        def key(**parameters):
+            return self.cache.key('pif_mask', [self.image_path],
+                                  **parameters)
+
+        golden_key = key(method='filter_PCA',
+                         method_options=pif.pca_options(30, False),
+                         window=(0, 0, 5, 5))
+        self.assertEqual(key(method='filter_PCA',
+                             method_options=pif.pca_options(30, False),
+                             window=(0, 0, 5, 5)), golden_key)
+        self.assertNotEqual(key(method='filter_PCA',
+                                method_options=pif.pca_options(20, False),
+                                window=(0, 0, 5, 5)), golden_key)
+        self.assertNotEqual(
+            key(pif_mask=numpy.ones((2, 2), dtype=bool)),
+            key(pif_mask=numpy.eye(2, dtype=bool)))
+
+        # A rewritten input gets a new key
+        with open(self.image_path, 'w') as image_file:
+            image_file.write('rewritten image')
+        self.assertNotEqual(key(method='filter_PCA',
+                                method_options=pif.pca_options(30, False),
+                                window=(0, 0, 5, 5)), golden_key)
+
+    def test_eviction(self):
+        transformations = [LinearTransformation(1.0, 0.0)]
+        keys = [self.cache.key('transformations', [self.image_path], index=i)
+                for i in range(3)]
+        for age, key in enumerate(keys):
+            self.cache.put_transformations(key, transformations)
+            path = self.cache._entry_path(key, '.json')
+            os.utime(path, (age, age))
+
+        # Reading the oldest entry makes it the most recently used
+        self.cache.get_transformations(keys[0])
+        self.cache.max_bytes = 2 * os.path.getsize(path)
+        self.cache.put_transformations(keys[2], transformations)
+
+        self.assertEqual(self.cache.get_transformations(keys[1]), None)
+        self.assertEqual(self.cache.get_transformations(keys[0]),
+                         transformations)
+        self.assertEqual(self.cache.size(), 2 * os.path.getsize(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
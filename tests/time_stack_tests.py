@@ -18,6 +18,7 @@ import numpy
 import os
 
 from radiometric_normalization import time_stack, gimage
+from radiometric_normalization import instrumentation
 
 
 class Tests(unittest.TestCase):
@@ -81,119 +82,70 @@ class Tests(unittest.TestCase):
         for image in image_paths:
             os.unlink(image)
 
-    def test__sum_masked_array_list(self):
-        # Two masked_arrays with two bands of 2 by 2 pixels
-        band_one_1 = numpy.ma.masked_array(
-            numpy.array([[1, 2], [5, 1]],
-                        dtype='uint16'),
-            mask=numpy.array([[False, True],
-                              [False, False]],
-                             dtype='bool'))
-
-        band_two_1 = numpy.ma.masked_array(
-            numpy.array([[9, 2], [3, 6]],
-                        dtype='uint16'),
-            mask=numpy.array([[False, False],
-                              [False, False]],
-                             dtype='bool'))
-
-        band_one_2 = numpy.ma.masked_array(
-            numpy.array([[6, 3], [7, 8]],
-                        dtype='uint16'),
-            mask=numpy.array([[True, True],
-                              [False, False]],
-                             dtype='bool'))
-
-        band_two_2 = numpy.ma.masked_array(
-            numpy.array([[8, 9], [3, 4]],
-                        dtype='uint16'),
-            mask=numpy.array([[True, True],
-                              [False, True]],
-                             dtype='bool'))
-
-        sum_masked_array = [band_one_1, band_two_1]
-        new_masked_array = [band_one_2, band_two_2]
-        frequency_array = [numpy.array([[1, 0], [1, 1]]),
-                           numpy.array([[1, 1], [1, 1]])]
-
-        golden_band_one = numpy.ma.masked_array(
-            numpy.array([[1, 0], [12, 9]],
-                        dtype='uint16'),
-            mask=numpy.array([[False, True],
-                              [False, False]],
-                             dtype='bool'))
+    def test_mean_with_uniform_weight_blocks(self):
+        numpy.random.seed(0)
+        image_paths = []
+        for index in range(3):
+            image_path = 'gimage_{}.tif'.format(index)
+            gimage.save(gimage.GImage(
+                [numpy.random.randint(0, 1000, (5, 4)).astype('uint16')
+                 for _ in range(2)],
+                (numpy.random.rand(5, 4) > 0.3).astype('uint16') * 65535,
+                {}), image_path)
+            image_paths.append(image_path)
+
+        golden_output = time_stack.mean_with_uniform_weight(image_paths,
+                                                            numpy.uint16,
+                                                            None)
 
-        golden_band_two = numpy.ma.masked_array(
-            numpy.array([[9, 2], [6, 6]],
-                        dtype='uint16'),
-            mask=numpy.array([[False, False],
-                              [False, False]],
-                             dtype='bool'))
+        # Strips of two rows, the last of one row, each timed
+        sink = instrumentation.MemorySink()
+        instrumentation.set_sink(sink)
+        try:
+            strips = list(time_stack.mean_with_uniform_weight_blocks(
+                image_paths, numpy.uint16, block_rows=2))
+        finally:
+            instrumentation.set_sink(None)
+        self.assertEqual([yoff for yoff, _, _ in strips], [0, 2, 4])
+        self.assertEqual(
+            sink.timers['time_stack.mean_with_uniform_weight_blocks'][1], 3)
+        for band in range(2):
+            numpy.testing.assert_array_equal(
+                numpy.vstack([bands[band] for _, bands, _ in strips]),
+                golden_output.bands[band])
+        numpy.testing.assert_array_equal(
+            numpy.vstack([alpha for _, _, alpha in strips]),
+            golden_output.alpha)
+
+        # A nodata value masks pixels of every image, not just the first
+        for index, image_path in enumerate(image_paths):
+            image_bands = [
+                numpy.random.randint(10, 1000, (5, 4)).astype('uint16')
+                for _ in range(2)]
+            image_bands[1][0, 0] = 5 if index == 0 else 7
+            gimage.save(gimage.GImage(
+                image_bands, numpy.ones((5, 4), dtype='uint16') * 65535, {}),
+                image_path)
+            if index == 0:
+                first_pixel = image_bands[0][0, 0]
+
+        golden_output = time_stack.mean_with_uniform_weight(image_paths,
+                                                            numpy.uint16, 7)
+        self.assertEqual(golden_output.bands[0][0, 0], first_pixel)
+        self.assertEqual(golden_output.bands[1][0, 0], 5)
+
+        strips = list(time_stack.mean_with_uniform_weight_blocks(
+            image_paths, numpy.uint16, image_nodata=7, block_rows=2))
+        for band in range(2):
+            numpy.testing.assert_array_equal(
+                numpy.vstack([bands[band] for _, bands, _ in strips]),
+                golden_output.bands[band])
+        numpy.testing.assert_array_equal(
+            numpy.vstack([alpha for _, _, alpha in strips]),
+            golden_output.alpha)
 
-        golden_sum_masked_array = [golden_band_one, golden_band_two]
-        golden_frequency_array = [numpy.array([[1, 0], [2, 2]]),
-                                  numpy.array([[1, 1], [2, 1]])]
-
-        sum_masked_array_output, frequency_array_output = \
-            time_stack._sum_masked_array_list(sum_masked_array,
-                                              frequency_array,
-                                              new_masked_array)
-
-        numpy.testing.assert_array_equal(sum_masked_array_output[0],
-                                         golden_sum_masked_array[0])
-        numpy.testing.assert_array_equal(sum_masked_array_output[1],
-                                         golden_sum_masked_array[1])
-        numpy.testing.assert_array_equal(frequency_array_output,
-                                         golden_frequency_array)
-
-    def test__masked_arrays_from_gimg(self):
-        # Gimages of four bands of 3 by 3 pixels
-        test_gimage = gimage.GImage(
-            [numpy.array([[5, 9, 6],
-                          [1, 2, 7],
-                          [6, 2, 3]], dtype='uint16'),
-             numpy.array([[3, 1, 8],
-                          [2, 3, 9],
-                          [1, 7, 1]], dtype='uint16'),
-             numpy.array([[6, 6, 3],
-                          [7, 2, 7],
-                          [8, 2, 2]], dtype='uint16')],
-            numpy.array([[65535, 0, 65535],
-                         [65535, 65535, 65535],
-                         [0, 65535, 65535]], dtype='uint16'), {})
-
-        golden_masked_array_list = \
-            [numpy.ma.masked_array(numpy.array([[5, 9, 6],
-                                                [1, 2, 7],
-                                                [6, 2, 3]], dtype='double'),
-                                   mask=numpy.array([[False, True, False],
-                                                     [False, False, False],
-                                                     [True, False, False]],
-                                                    dtype='bool')),
-             numpy.ma.masked_array(numpy.array([[3, 1, 8],
-                                                [2, 3, 9],
-                                                [1, 7, 1]], dtype='double'),
-                                   mask=numpy.array([[False, True, False],
-                                                     [False, False, False],
-                                                     [True, False, False]],
-                                                    dtype='bool')),
-             numpy.ma.masked_array(numpy.array([[6, 6, 3],
-                                                [7, 2, 7],
-                                                [8, 2, 2]], dtype='double'),
-                                   mask=numpy.array([[False, True, False],
-                                                     [False, False, False],
-                                                     [True, False, False]],
-                                                    dtype='bool'))]
-
-        masked_array_list = time_stack._masked_arrays_from_gimg(test_gimage,
-                                                                numpy.double)
-
-        numpy.testing.assert_array_equal(masked_array_list[0],
-                                         golden_masked_array_list[0])
-        numpy.testing.assert_array_equal(masked_array_list[1],
-                                         golden_masked_array_list[1])
-        numpy.testing.assert_array_equal(masked_array_list[2],
-                                         golden_masked_array_list[2])
+        for image in image_paths:
+            os.unlink(image)
 
     def test__mean_from_sum(self):
         # A masked array with four bands of 3 by 3 pixels
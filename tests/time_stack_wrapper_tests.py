@@ -0,0 +1,116 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization import time_stack
+from radiometric_normalization.wrappers import pipeline_wrapper
+from radiometric_normalization.wrappers import time_stack_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Several strips of the time stack in a small image
+        self.block_rows = time_stack_wrapper.TIME_STACK_BLOCK_ROWS
+        time_stack_wrapper.TIME_STACK_BLOCK_ROWS = 4
+
+        numpy.random.seed(0)
+        candidate_bands = [numpy.random.randint(100, 1000, (10, 12))
+                           for _ in range(2)]
+        self.candidate_path = self._save(
+            'candidate.tif', candidate_bands,
+            numpy.random.rand(10, 12) > 0.1)
+        self.stack = [([2 * band + 50 + numpy.random.randint(0, 5, (10, 12))
+                        for band in candidate_bands],
+                       numpy.random.rand(10, 12) > 0.2)
+                      for _ in range(3)]
+        self.image_paths = [
+            self._save('stack_{}.tif'.format(index), bands, alpha)
+            for index, (bands, alpha) in enumerate(self.stack)]
+
+    def tearDown(self):
+        time_stack_wrapper.TIME_STACK_BLOCK_ROWS = self.block_rows
+        shutil.rmtree(self.directory)
+
+    def _save(self, name, bands, alpha):
+        path = os.path.join(self.directory, name)
+        gimage.save(gimage.GImage(
+            [band.astype('uint16') for band in bands],
+            alpha.astype('uint16') * 65535, {}), path)
+        return path
+
+    def _assert_matches_two_steps(self, image_nodata=None, **options):
+        # The fused run against time_stack.generate then pipeline_wrapper.run
+        name = options['pif_method']
+        golden_reference_path = os.path.join(
+            self.directory, '{}_golden_reference.tif'.format(name))
+        time_stack.generate(self.image_paths, golden_reference_path,
+                            image_nodata=image_nodata)
+        golden_output_path = os.path.join(
+            self.directory, '{}_golden_output.tif'.format(name))
+        golden = pipeline_wrapper.run(
+            self.candidate_path, golden_reference_path, golden_output_path,
+            validate=False, **options)
+
+        reference_path = os.path.join(self.directory,
+                                      '{}_reference.tif'.format(name))
+        output_path = os.path.join(self.directory,
+                                   '{}_output.tif'.format(name))
+        result = time_stack_wrapper.run(
+            self.candidate_path, self.image_paths, output_path,
+            reference_path=reference_path, validate=False,
+            image_nodata=image_nodata, **options)
+
+        gimage.check_equal([gimage.load(reference_path),
+                            gimage.load(golden_reference_path)])
+        for fused, unfused in zip(result.transformations,
+                                  golden.transformations):
+            self.assertAlmostEqual(fused.gain, unfused.gain)
+            self.assertAlmostEqual(fused.offset, unfused.offset)
+        output = gimage.load(output_path)
+        golden_output = gimage.load(golden_output_path)
+        numpy.testing.assert_array_equal(output.alpha, golden_output.alpha)
+        # The streamed fit sums in a different order, which can round a
+        # normalized value the other way
+        for band, golden_band in zip(output.bands, golden_output.bands):
+            numpy.testing.assert_allclose(band, golden_band, atol=1)
+
+    def test_run_streamed(self):
+        self._assert_matches_two_steps(pif_method='filter_alpha')
+
+    def test_run_in_memory(self):
+        self._assert_matches_two_steps(pif_method='filter_PCA')
+
+    def test_run_image_nodata(self):
+        # The nodata value is masked in every image of the stack, not just
+        # the first (see time_stack_tests)
+        bands, alpha = self.stack[1]
+        bands[0][2:5, 3:7] = 7
+        self._save('stack_1.tif', bands, alpha)
+
+        self._assert_matches_two_steps(image_nodata=7,
+                                       pif_method='filter_alpha')
+        self._assert_matches_two_steps(image_nodata=7,
+                                       pif_method='filter_PCA')
+
+
+if __name__ == '__main__':
+    unittest.main()
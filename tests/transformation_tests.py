@@ -13,9 +13,12 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
+import json
 import unittest
 import numpy
 
+from radiometric_normalization import histogram
+from radiometric_normalization import normalize
 from radiometric_normalization import transformation
 
 
@@ -39,5 +42,161 @@ class Tests(unittest.TestCase):
         expected_offset = 0
         self.assertEqual(transform.offset, expected_offset)
 
+    def test_generate_linear_relationship_histogram(self):
+        test_candidate = numpy.array([1, 2, 4, 4, 4], dtype=numpy.uint16)
+        test_reference = numpy.array([2, 4, 8, 8, 9], dtype=numpy.uint16)
+        joint_histogram = histogram.JointHistogram()
+        joint_histogram.update(test_candidate, test_reference)
+
+        transform = transformation.generate_linear_relationship_histogram(
+            joint_histogram)
+        golden_transform = \
+            transformation.generate_linear_relationship_pixel_list(
+                test_candidate, test_reference)
+
+        self.assertAlmostEqual(transform.gain, golden_transform.gain)
+        self.assertAlmostEqual(transform.offset, golden_transform.offset)
+
+    def test_generate_ols_regression_deduplicate(self):
+        numpy.random.seed(0)
+        test_candidate = numpy.random.randint(0, 20, 500).astype(
+            numpy.uint16)
+        test_reference = (3 * test_candidate + numpy.random.randint(
+            0, 5, 500)).astype(numpy.uint16)
+
+        transform = transformation.generate_ols_regression_pixel_list(
+            test_candidate, test_reference, deduplicate=True)
+        golden_transform = transformation.generate_ols_regression_pixel_list(
+            test_candidate, test_reference)
+
+        self.assertAlmostEqual(transform.gain, golden_transform.gain)
+        self.assertAlmostEqual(transform.offset, golden_transform.offset)
+
+    def test_generate_histogram_matching(self):
+        numpy.random.seed(0)
+        test_candidate = numpy.random.randint(
+            0, 1000, (20, 30)).astype(numpy.uint16)
+        # A monotonic reference has the same ranks, so is matched exactly
+        test_reference = (test_candidate * 3 + 7).astype(numpy.uint16)
+        test_pifs = numpy.random.rand(20, 30) > 0.2
+
+        transform = transformation.generate_histogram_matching(
+            test_candidate, test_reference, test_pifs)
+
+        self.assertEqual(transform.lut.shape, (65536,))
+        self.assertEqual(transform.lut.dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(
+            transform.lut[test_candidate[test_pifs]],
+            test_reference[test_pifs])
+        # The look up table does not decrease
+        self.assertTrue((numpy.diff(transform.lut.astype(int)) >= 0).all())
+
+        # Values outside the range of the PIFs map to the ends of the
+        # reference range
+        transform = transformation.generate_histogram_matching_pixel_list(
+            numpy.arange(1000, 1301, dtype=numpy.uint16),
+            numpy.arange(2000, 2301, dtype=numpy.uint16))
+        out = normalize.apply_using_lut(
+            numpy.array([[0, 500, 999, 1000], [1150, 1300, 1301, 4000]],
+                        dtype=numpy.uint16), transform)
+        numpy.testing.assert_array_equal(
+            out, [[2000, 2000, 2000, 2000], [2150, 2300, 2300, 2300]])
+
+        # Signed data is offset to the minimum of its type
+        transform = transformation.generate_histogram_matching_pixel_list(
+            numpy.array([-5, 0, 5], dtype=numpy.int16),
+            numpy.array([10, 20, 30], dtype=numpy.int16))
+        self.assertEqual(transform.lut.dtype, numpy.int16)
+        numpy.testing.assert_array_equal(
+            transform.lut[numpy.array([-5, 0, 5]) + 32768], [10, 20, 30])
+
+        # Reference values outside the candidate's type are clipped to it
+        transform = transformation.generate_histogram_matching_pixel_list(
+            numpy.array([1, 2, 3], dtype=numpy.uint8),
+            numpy.array([-5, 100, 300]))
+        numpy.testing.assert_array_equal(transform.lut[[1, 2, 3]],
+                                         [0, 100, 255])
+
+        self.assertRaises(
+            Exception, transformation.generate_histogram_matching_pixel_list,
+            numpy.array([0.5]), numpy.array([1.5]))
+
+    def test_transformation_json(self):
+        transformations = [
+            transformation.LinearTransformation(numpy.array([1.5]), -2),
+            transformation.LutTransformation(
+                numpy.arange(-3, 3, dtype=numpy.int16)),
+            transformation.GriddedTransformation(
+                numpy.array([[1.0, 2.0]]), numpy.array([[0.0, -1.5]]), 30)]
+
+        values = json.loads(json.dumps(
+            [transformation.transformation_to_json(t)
+             for t in transformations]))
+        linear, lut, gridded = [transformation.transformation_from_json(value)
+                                for value in values]
+
+        self.assertEqual(linear, transformation.LinearTransformation(1.5, -2))
+        self.assertEqual(lut.lut.dtype, numpy.int16)
+        numpy.testing.assert_array_equal(lut.lut, transformations[1].lut)
+        numpy.testing.assert_array_equal(gridded.gain, [[1.0, 2.0]])
+        numpy.testing.assert_array_equal(gridded.offset, [[0.0, -1.5]])
+        self.assertEqual(gridded.cell_size, 30)
+
+        # Linear transformations written as [gain, offset]
+        self.assertEqual(transformation.transformation_from_json([0.5, 3]),
+                         transformation.LinearTransformation(0.5, 3))
+
+    def test_generate_gridded_linear_relationship(self):
+        numpy.random.seed(0)
+        test_candidate = numpy.random.randint(
+            100, 1000, (40, 60)).astype(numpy.uint16)
+        test_gain = numpy.where(numpy.arange(60) < 30, 1.0, 2.0)
+        test_reference = (test_candidate * test_gain + 10).astype(
+            numpy.uint16)
+        test_pifs = numpy.ones((40, 60), dtype=numpy.bool)
+        # Too few PIFs in the first cell to fit it
+        test_pifs[:30, :30] = False
+        test_pifs[0, 0] = True
+
+        cell_moments = transformation.CellMoments((40, 60), 30)
+        # Streamed in strips
+        for yoff in range(0, 40, 15):
+            cell_moments.update(test_candidate[yoff:yoff + 15],
+                                test_reference[yoff:yoff + 15],
+                                test_pifs[yoff:yoff + 15], yoff=yoff)
+        self.assertEqual(cell_moments.grid_shape, (2, 2))
+        numpy.testing.assert_array_equal(cell_moments.counts,
+                                         [[1, 900], [300, 300]])
+
+        transform = transformation.generate_gridded_linear_relationship(
+            cell_moments, smoothing=0, min_pifs=10)
+        self.assertEqual(transform.cell_size, 30)
+        numpy.testing.assert_array_almost_equal(transform.gain[:, 1],
+                                                [2, 2], decimal=2)
+        numpy.testing.assert_array_almost_equal(transform.gain[1, 0], 1,
+                                                decimal=2)
+        numpy.testing.assert_array_almost_equal(transform.offset[1, 0], 10,
+                                                decimal=0)
+
+        # The sparse cell gets the relationship of the whole band
+        golden_transform = transformation.generate_linear_relationship(
+            test_candidate, test_reference, test_pifs)
+        self.assertAlmostEqual(transform.gain[0, 0], golden_transform.gain)
+        self.assertAlmostEqual(transform.offset[0, 0],
+                               golden_transform.offset)
+
+        # A cell without PIFs is not fitted to them, whatever min_pifs is
+        test_pifs[:30, :30] = False
+        cell_moments = transformation.CellMoments((40, 60), 30)
+        cell_moments.update(test_candidate, test_reference, test_pifs)
+        transform = transformation.generate_gridded_linear_relationship(
+            cell_moments, smoothing=0, min_pifs=0)
+        self.assertTrue(numpy.isfinite(transform.gain).all())
+        self.assertTrue(numpy.isfinite(transform.offset).all())
+        golden_transform = transformation.generate_linear_relationship(
+            test_candidate, test_reference, test_pifs)
+        self.assertAlmostEqual(transform.gain[0, 0], golden_transform.gain)
+
+
 if __name__ == '__main__':
     unittest.main()
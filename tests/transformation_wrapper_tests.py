@@ -0,0 +1,91 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import gimage
+from radiometric_normalization import normalize
+from radiometric_normalization import transformation
+from radiometric_normalization.wrappers import normalize_wrapper
+from radiometric_normalization.wrappers import transformation_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        # The reference is twice as bright on the right as on the left
+        gain = numpy.where(numpy.arange(60) < 30, 1.0, 2.0)
+        self.candidate_bands = [
+            numpy.random.randint(100, 1000, (40, 60)).astype(numpy.uint16)
+            for _ in range(2)]
+        self.reference_bands = [(band * gain + 10).astype(numpy.uint16)
+                                for band in self.candidate_bands]
+        alpha = numpy.ones((40, 60), dtype=numpy.uint16) * 65535
+        self.candidate_path = os.path.join(self.directory, 'candidate.tif')
+        gimage.save(gimage.GImage(self.candidate_bands, alpha, {}),
+                    self.candidate_path)
+        self.reference_path = os.path.join(self.directory, 'reference.tif')
+        gimage.save(gimage.GImage(self.reference_bands, alpha, {}),
+                    self.reference_path)
+        self.pif_mask = numpy.random.rand(40, 60) > 0.2
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_generate_gridded(self):
+        # Read in strips that do not line up with the cells
+        transformations = transformation_wrapper.generate_gridded(
+            self.candidate_path, self.reference_path, self.pif_mask, 30,
+            smoothing=0, min_pifs=10, block_rows=15)
+
+        self.assertEqual(len(transformations), 2)
+        for band_transformation, candidate_band, reference_band in zip(
+                transformations, self.candidate_bands, self.reference_bands):
+            cell_moments = transformation.CellMoments((40, 60), 30)
+            cell_moments.update(candidate_band, reference_band,
+                                self.pif_mask)
+            golden_transformation = \
+                transformation.generate_gridded_linear_relationship(
+                    cell_moments, smoothing=0, min_pifs=10)
+            numpy.testing.assert_array_almost_equal(
+                band_transformation.gain, golden_transformation.gain)
+            numpy.testing.assert_array_almost_equal(
+                band_transformation.offset, golden_transformation.offset)
+            numpy.testing.assert_array_almost_equal(
+                band_transformation.gain, [[1, 2], [1, 2]], decimal=2)
+
+        # Applied to the whole image, and a strip at a time as it is written
+        normalized = normalize_wrapper.generate(self.candidate_path,
+                                                transformations)
+        output_path = os.path.join(self.directory, 'output.tif')
+        normalize_wrapper.generate_to_file(
+            self.candidate_path, output_path, transformations, block_rows=16)
+        written = gimage.load(output_path)
+        for band_no, band_transformation in enumerate(transformations):
+            golden_band = normalize.apply_gridded(
+                self.candidate_bands[band_no], band_transformation)
+            numpy.testing.assert_array_equal(normalized.bands[band_no],
+                                             golden_band)
+            numpy.testing.assert_array_equal(written.bands[band_no],
+                                             golden_band)
+
+
+if __name__ == '__main__':
+    unittest.main()
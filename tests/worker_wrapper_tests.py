@@ -0,0 +1,100 @@
+'''
+Copyright 2015 Planet Labs, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from radiometric_normalization import pif
+from radiometric_normalization.wrappers import worker_wrapper
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    def test_job_lifecycle(self):
+        first_id = worker_wrapper.submit(
+            self.queue_dir, 'c1.tif', 'r.tif', 'o1.tif',
+            pif_method='filter_PCA', pif_options=pif.pca_options(25),
+            window=(0, 0, 10, 20))
+        second_id = worker_wrapper.submit(
+            self.queue_dir, 'c2.tif', 'r.tif', 'o2.tif')
+        self.assertEqual(worker_wrapper.status(self.queue_dir),
+                         {'pending': 2, 'running': 0, 'done': 0, 'failed': 0})
+
+        # Jobs are claimed in submission order
+        job = worker_wrapper.claim(self.queue_dir)
+        self.assertEqual(job['id'], first_id)
+        self.assertEqual(
+            worker_wrapper._decode_options(job['options']),
+            {'pif_method': 'filter_PCA',
+             'pif_options': pif.pca_options(25, False),
+             'window': (0, 0, 10, 20)})
+
+        worker_wrapper.complete(self.queue_dir, job, result={'rmse': 1.5})
+        state, record = worker_wrapper.read_job(self.queue_dir, first_id)
+        self.assertEqual(state, 'done')
+        self.assertEqual(record['result'], {'rmse': 1.5})
+
+        job = worker_wrapper.claim(self.queue_dir)
+        self.assertEqual(job['id'], second_id)
+        self.assertEqual(worker_wrapper.claim(self.queue_dir), None)
+        worker_wrapper.complete(self.queue_dir, job, error='Traceback')
+        self.assertEqual(worker_wrapper.status(self.queue_dir),
+                         {'pending': 0, 'running': 0, 'done': 1, 'failed': 1})
+
+    def test_max_pending(self):
+        worker_wrapper.submit(self.queue_dir, 'c.tif', 'r.tif', 'o.tif',
+                              max_pending=1)
+        self.assertRaises(Exception, worker_wrapper.submit, self.queue_dir,
+                          'c.tif', 'r.tif', 'o.tif', max_pending=1)
+
+    def test_unrecordable_result(self):
+        job_id = worker_wrapper.submit(self.queue_dir, 'c.tif', 'r.tif',
+                                       'o.tif')
+        job = worker_wrapper.claim(self.queue_dir)
+        job['started_at'] = job['submitted_at']
+
+        # A result that cannot be written as JSON fails the job, rather than
+        # raising in the worker and leaving the job running
+        worker_wrapper._finish(self.queue_dir, job,
+                               {'rmse': numpy.arange(2)})
+
+        state, record = worker_wrapper.read_job(self.queue_dir, job_id)
+        self.assertEqual(state, 'failed')
+        self.assertTrue('error' in record)
+        self.assertFalse([name for name in os.listdir(self.queue_dir)
+                          if name.endswith('.tmp')])
+        self.assertEqual(worker_wrapper.status(self.queue_dir),
+                         {'pending': 0, 'running': 0, 'done': 0, 'failed': 1})
+
+    def test_requeue_running(self):
+        job_id = worker_wrapper.submit(self.queue_dir, 'c.tif', 'r.tif',
+                                       'o.tif')
+        worker_wrapper.claim(self.queue_dir)
+
+        self.assertEqual(worker_wrapper.requeue_running(self.queue_dir), 1)
+        self.assertEqual(worker_wrapper.read_job(self.queue_dir, job_id)[0],
+                         'pending')
+
+
+if __name__ == '__main__':
+    unittest.main()